@@ -1,21 +1,490 @@
 """Access and update the sqlite3 database."""
 
+import asyncio
+import collections
+import functools
 import logging
 import os.path
+import queue
 import sqlite3
+import sys
+import threading
+import time
+
+from . import metrics
 
 _log = logging.getLogger()
 
+# Values allowed for the sqlite journal_mode and synchronous settings.
+journal_modes = ["delete", "truncate", "persist", "memory", "wal", "off"]
+synchronous_modes = ["off", "normal", "full", "extra"]
+
+# The most writes the DB writer commits in one transaction.
+_MAX_WRITE_BATCH = 500
+# How long in seconds to wait for queued writes to be committed at shutdown.
+_FLUSH_TIMEOUT = 10
+
+def open_db(db_file, journal_mode, synchronous):
+    if journal_mode not in journal_modes:
+        raise Exception("unknown journal mode: {}".format(journal_mode))
+    if synchronous not in synchronous_modes:
+        raise Exception("unknown synchronous setting: {}".format(synchronous))
+
+    conn = sqlite3.connect(db_file)
+    conn.execute("PRAGMA journal_mode = {}".format(journal_mode))
+    conn.execute("PRAGMA synchronous = {}".format(synchronous))
+    return conn
+
+
+class DBWriter():
+    """Persists DB writes on a background thread with its own connection, so
+    that sqlite I/O never blocks the event loop. Writes are committed in
+    batches of everything queued since the last commit. Each write gets a
+    sequence number, and coroutines can wait until a write is committed.
+
+    When a write to a row fails, `write_failed` is called on the loop thread
+    with the table and in-memory key of the row, so that the row in memory can
+    be made to match the DB again."""
+
+    def __init__(self, db_file, journal_mode, synchronous, write_failed=None):
+        self.db_file = db_file
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.write_failed = write_failed
+        self.queue = queue.Queue()
+        self.thread = None
+        self.loop = None
+
+        # The sequence numbers of the last write queued and the last write
+        # committed.
+        self.last_seq = 0
+        self.committed_seq = 0
+        # Queue times of the writes not yet committed, oldest first.
+        self.pending_times = collections.deque()
+        # Tuples of sequence numbers and the futures waiting for them.
+        self.waiters = []
+
+        metrics.db_pending_writes.set_function(lambda: len(self.pending_times),
+                                               db_file)
+        metrics.db_durability_lag.set_function(self.get_durability_lag,
+                                               db_file)
+
+    def get_durability_lag(self):
+        """How long in seconds the oldest uncommitted write has waited."""
+
+        try:
+            return time.monotonic() - self.pending_times[0]
+
+        except IndexError:
+            return 0
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.thread = threading.Thread(target=self.run,
+                                       name="beem DB writer",
+                                       daemon=True)
+        self.thread.start()
+
+    def write(self, table, op, statement, params, row_key=None):
+        """Queue a write, returning its sequence number. `row_key` is the
+        in-memory key of the row the write changes, if any."""
+
+        self.last_seq += 1
+        self.pending_times.append(time.monotonic())
+        self.queue.put((table, op, statement, params, self.last_seq, row_key))
+        return self.last_seq
+
+    @asyncio.coroutine
+    def wait(self, seq):
+        """Wait until the write with the given sequence number is committed."""
+
+        if self.committed_seq >= seq:
+            return
+
+        future = asyncio.Future()
+        self.waiters.append((seq, future))
+        yield from future
+
+    def notify_committed(self, seq, failed, writes, elapsed):
+        """Called on the loop thread when writes up to `seq` are done, with a
+        list of the writes that failed, the table and operation of each write,
+        and the time taken to commit them."""
+
+        for table, op in writes:
+            metrics.db_write_latency.observe(elapsed, table, op)
+
+        for table, op, statement, params, failed_seq, row_key in failed:
+            if row_key is not None and self.write_failed:
+                try:
+                    self.write_failed(table, row_key)
+
+                except Exception:
+                    _log.exception("DB: Error handling failed write to table "
+                                   "%s", table)
+        failed = {w[4] for w in failed}
+
+        waiters = []
+        for waiter_seq, future in self.waiters:
+            if waiter_seq > seq:
+                waiters.append((waiter_seq, future))
+            elif future.done():
+                continue
+            elif waiter_seq in failed:
+                future.set_exception(Exception(
+                    "DB write {} failed".format(waiter_seq)))
+            else:
+                future.set_result(None)
+        self.waiters = waiters
+
+    def flush(self, timeout=_FLUSH_TIMEOUT):
+        """Block until every queued write is committed, or until `timeout`
+        seconds pass. Returns True if every write was committed."""
+
+        time_end = time.monotonic() + timeout
+        while (self.thread and self.thread.is_alive()
+               and self.committed_seq < self.last_seq):
+            if time.monotonic() >= time_end:
+                return False
+            time.sleep(0.01)
+
+        return self.committed_seq >= self.last_seq
+
+    def stop(self, timeout=_FLUSH_TIMEOUT):
+        """Commit any queued writes and stop the writer thread, waiting at
+        most `timeout` seconds. Returns True if every write was committed."""
+
+        if self.thread and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+        self.thread = None
+        return self.committed_seq >= self.last_seq
+
+    def run(self):
+        conn = open_db(self.db_file, self.journal_mode, self.synchronous)
+        try:
+            while True:
+                batch = [self.queue.get()]
+                while len(batch) < _MAX_WRITE_BATCH:
+                    try:
+                        batch.append(self.queue.get_nowait())
+
+                    except queue.Empty:
+                        break
+
+                writes = [w for w in batch if w is not None]
+                if writes:
+                    self.write_batch(conn, writes)
+
+                if len(writes) < len(batch):
+                    return
+
+        finally:
+            conn.close()
+
+    def write_batch(self, conn, writes):
+        start = time.monotonic()
+        failed = []
+        try:
+            for table, op, statement, params, seq, row_key in writes:
+                conn.execute(statement, params)
+            conn.commit()
+
+        except Exception:
+            conn.rollback()
+            _log.exception("DB: Error committing batch of %d writes to %s, "
+                           "retrying each write", len(writes), self.db_file)
+            failed = self.write_each(conn, writes)
+
+        elapsed = time.monotonic() - start
+        for _ in writes:
+            self.pending_times.popleft()
+
+        self.committed_seq = writes[-1][4]
+        try:
+            self.loop.call_soon_threadsafe(
+                self.notify_committed, self.committed_seq, failed,
+                [(w[0], w[1]) for w in writes], elapsed)
+
+        except RuntimeError:
+            # The loop is closed.
+            pass
+
+    def write_each(self, conn, writes):
+        """Commit each write on its own, returning those that failed."""
+
+        failed = []
+        for write in writes:
+            table, op, statement, params, seq, row_key = write
+            try:
+                conn.execute(statement, params)
+                conn.commit()
+
+            except Exception:
+                conn.rollback()
+                _log.exception("DB: Error writing to table %s: %s %s", table,
+                               statement, params)
+                failed.append(write)
+
+        return failed
+
+
+class Row():
+    """An in-memory DB row. Each table gets a subclass from make_row_class()
+    that stores the fields in slots, which takes much less memory than a dict
+    per row. Rows support the parts of the dict interface callers use."""
+
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, values):
+        for field, value in zip(self.fields, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, field):
+        if field not in self.fields:
+            raise KeyError(field)
+
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        if field not in self.fields:
+            raise KeyError(field)
+
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def get(self, field, default=None):
+        if field not in self.fields:
+            return default
+
+        return getattr(self, field)
+
+    def keys(self):
+        return self.fields
+
+    def items(self):
+        return ((f, getattr(self, f)) for f in self.fields)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def make_row_class(table, fields):
+    """Make the Row class of a table given its field definitions."""
+
+    names = tuple(f['name'] for f in fields)
+    for name in names:
+        if hasattr(Row, name):
+            raise Exception("field name {} of table {} not allowed".format(
+                name, table))
+
+    return type("{}_row".format(table), (Row,),
+                {"__slots__" : names, "fields" : names})
+
+
+class RowCache():
+    """An LRU cache of the rows of a table, used in place of a dict of every
+    row when the DB is loaded lazily. Pinned rows are never evicted, and rows
+    for which `can_evict(key)` is false are kept until it's true. Keys that
+    were looked up and not found are remembered, so that repeated lookups of
+    unknown users don't query the DB."""
+
+    def __init__(self, size, can_evict=None):
+        self.size = size
+        self.can_evict = can_evict
+        self.rows = collections.OrderedDict()
+        self.pinned = {}
+        self.missing = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        row = self.pinned.get(key)
+        if row is not None:
+            return row
+
+        row = self.rows.get(key)
+        if row is not None:
+            self.rows.move_to_end(key)
+            return row
+
+        return default
+
+    def __contains__(self, key):
+        return key in self.pinned or key in self.rows
+
+    def __setitem__(self, key, row):
+        self.missing.pop(key, None)
+        if key in self.pinned:
+            self.pinned[key] = row
+            return
+
+        self.rows[key] = row
+        self.rows.move_to_end(key)
+        self.evict()
+
+    def __len__(self):
+        return len(self.pinned) + len(self.rows)
+
+    def pop(self, key, default=None):
+        row = self.pinned.pop(key, None)
+        if row is None:
+            row = self.rows.pop(key, None)
+        return default if row is None else row
+
+    def items(self):
+        yield from self.pinned.items()
+        yield from self.rows.items()
+
+    def values(self):
+        for key, row in self.items():
+            yield row
+
+    def is_missing(self, key):
+        return key in self.missing
+
+    def set_missing(self, key):
+        self.missing[key] = True
+        self.missing.move_to_end(key)
+        if len(self.missing) > self.size:
+            self.missing.popitem(last=False)
+
+    def pin(self, key, row):
+        self.rows.pop(key, None)
+        self.missing.pop(key, None)
+        self.pinned[key] = row
+
+    def unpin(self, key):
+        row = self.pinned.pop(key, None)
+        if row is not None:
+            self.rows[key] = row
+            self.evict()
+
+    def evict(self):
+        # Rows that can't be evicted yet go back to the recent end.
+        checked = 0
+        while len(self.rows) > self.size and checked < len(self.rows):
+            key = next(iter(self.rows))
+            if self.can_evict and not self.can_evict(key):
+                self.rows.move_to_end(key)
+                checked += 1
+                continue
+
+            del self.rows[key]
+
+
 class BotDB():
     """This class allows access and updates to a user table in an sqlite3 DB.
     It loads the data into an in-memory copy that it keeps up to date as
-    changes are made."""
-
-    def __init__(self, db_file, db_tables, user_table=None):
+    changes are made. One connection to the DB is kept open for all writes,
+    by default in WAL mode with synchronous set to normal, so that each write
+    costs a single append to the WAL instead of a new connection and several
+    fsyncs.
+
+    With write-behind enabled, changes are made to the in-memory copy right
+    away and written to the DB by a DBWriter thread. Use wait_written() to
+    wait until the DB has the changes. If a write to a row fails, the row is
+    reloaded from the DB.
+
+    If `cache_size` is set, rows are instead loaded lazily as they're looked
+    up, and at most `cache_size` rows of each table are kept in a RowCache,
+    along with any user table rows having a positive value for one of
+    `pinned_fields`, which are loaded at startup and never evicted.
+
+    Fields defined with "index" set get an index in the DB, and an in-memory
+    index of the rows having each non-default value of the field, which is
+    complete even when loading lazily. See get_indexed_keys().
+
+    The schema version is kept in the DB's user_version. `migrations` is a list
+    of the changes made by each version after the first, each a list of
+    operations: ("add_column", table, field), ("add_index", table, field), or
+    ("sql", statement). Operations must be safe to repeat, since DDL statements
+    aren't always rolled back.
+
+    Tables in `unloaded_tables` are created but never loaded into memory. Their
+    rows are only accessed with select_rows(), replace_row(), and
+    delete_rows().
+
+    When other processes use the same DB, set `change_listener` to a function
+    that's called with the table and a dict of the row whenever a row is added
+    or changed, and give the rows other processes change to apply_row()."""
+
+    def __init__(self, db_file, db_tables, user_table=None,
+                 journal_mode="wal", synchronous="normal", write_behind=False,
+                 cache_size=None, pinned_fields=(), migrations=(),
+                 unloaded_tables=()):
         self.db_file = db_file
         self.db_tables = db_tables
         self.db_data = {}
+        self.row_classes = {t : make_row_class(t, db_tables[t])
+                            for t in db_tables}
+        self.key_indexes = {t : [i for i, f in enumerate(db_tables[t])
+                                 if f.get('primary')]
+                            for t in db_tables}
+        self.migrations = migrations
+        self.unloaded_tables = unloaded_tables
+        self.change_listener = None
+        # The keys of the rows with each non-default value of each indexed
+        # field, keyed by table, field name, and value.
+        self.indexes = {t : {f['name'] : {} for f in db_tables[t]
+                             if f.get('index')}
+                        for t in db_tables if t not in unloaded_tables}
         self.user_table = user_table
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.conn = None
+        self.writer = None
+        if write_behind:
+            self.writer = DBWriter(db_file, journal_mode, synchronous,
+                                   self.reload_row)
+        # The SQL of our statements, keyed by table, field or None, and the
+        # kind of statement, so no field name can collide with another kind.
+        # Reusing the same SQL lets sqlite3 reuse its prepared statements.
+        self.statements = {}
+
+        self.cache_size = cache_size
+        self.pinned_fields = pinned_fields
+        # The sequence number of the last queued write of each cached row, so
+        # that rows aren't evicted before their changes are in the DB.
+        self.dirty = {}
+
+    def connect(self):
+        if self.conn:
+            return
+
+        self.conn = open_db(self.db_file, self.journal_mode, self.synchronous)
+
+    def flush(self):
+        """Block until all writes are in the DB, or until the writer has had
+        long enough."""
+
+        if self.writer and not self.writer.flush():
+            _log.error("DB: Timed out waiting for %d writes to %s",
+                       self.writer.last_seq - self.writer.committed_seq,
+                       self.db_file)
+
+    @asyncio.coroutine
+    def wait_written(self):
+        """Wait until every change made so far is in the DB."""
+
+        if self.writer:
+            yield from self.writer.wait(self.writer.last_seq)
+
+    def close(self):
+        if self.writer and not self.writer.stop():
+            _log.error("DB: Closing %s with %d writes not committed",
+                       self.db_file,
+                       self.writer.last_seq - self.writer.committed_seq)
+
+        if self.conn:
+            self.conn.close()
+            self.conn = None
 
     def get_table_keys(self, table):
         keys = []
@@ -25,140 +494,371 @@ class BotDB():
 
         return keys
 
+    def get_field(self, table, name):
+        for field in self.db_tables[table]:
+            if field['name'] == name:
+                return field
+
+        raise Exception("unknown field {} for table {}".format(name, table))
+
+    def get_column_term(self, field):
+        term = field['name']
+
+        if field['type'] == "text":
+            term += " TEXT COLLATE NOCASE"
+        elif field['type'] == "integer":
+            term += " INT"
+        else:
+            raise Exception("unknown type {} for field {}".format(
+                field['name'], field['type']))
+
+        return term
+
     def create_table(self, cursor, name):
+        keys = self.get_table_keys(name)
         field_terms = []
         for field in self.db_tables[name]:
-            term = field['name']
-
-            if field['type'] == "text":
-                term += " TEXT COLLATE NOCASE"
-            elif field['type'] == "integer":
-                term += " INT"
-            else:
-                raise Exception("unknown type {} for field {}".format(
-                    field['name'], field['type']))
-
-            if field.get('primary'):
+            term = self.get_column_term(field)
+            if field.get('primary') and len(keys) == 1:
                 term += " PRIMARY KEY"
 
             field_terms.append(term)
 
+        # A composite key needs a table constraint.
+        if len(keys) > 1:
+            field_terms.append("PRIMARY KEY ({})".format(", ".join(keys)))
+
         cursor.execute("CREATE TABLE {} ({});".format(name,
             ", ".join(field_terms)))
 
+        for field in self.db_tables[name]:
+            if field.get('index'):
+                self.add_index(cursor, name, field['name'])
+
+    def add_column(self, cursor, table, name):
+        """Add a column for a field to an existing table, giving existing rows
+        the field's default value."""
+
+        columns = [row[1] for row in cursor.execute(
+            "PRAGMA table_info({})".format(table))]
+        if name in columns:
+            return
+
+        field = self.get_field(table, name)
+        term = self.get_column_term(field)
+        default = field.get('default')
+        if type(default) is str:
+            term += " DEFAULT '{}'".format(default.replace("'", "''"))
+        elif default is not None:
+            term += " DEFAULT {}".format(default)
+        cursor.execute("ALTER TABLE {} ADD COLUMN {}".format(table, term))
+
+    def add_index(self, cursor, table, name):
+        cursor.execute("CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})".format(
+            table, name))
+
+    def migrate(self, cursor):
+        """Bring the DB schema up to the latest version by running the
+        migrations newer than its user_version."""
+
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for i in range(version, len(self.migrations)):
+            _log.info("Migrating DB to version %s", i + 1)
+            try:
+                for op in self.migrations[i]:
+                    if op[0] == "add_column":
+                        self.add_column(cursor, op[1], op[2])
+                    elif op[0] == "add_index":
+                        self.add_index(cursor, op[1], op[2])
+                    elif op[0] == "sql":
+                        cursor.execute(op[1])
+                    else:
+                        raise Exception("unknown migration operation {}".format(
+                            op[0]))
+
+                cursor.execute("PRAGMA user_version = {}".format(i + 1))
+                self.conn.commit()
+
+            except Exception:
+                self.conn.rollback()
+                raise
+
     def check_db(self):
         if not os.path.exists(self.db_file):
             _log.info("Sqlite DB didn't exist; creating it now")
 
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+        self.connect()
+        cursor = self.conn.cursor()
 
         try:
+            created = 0
             for t in self.db_tables:
                 query = ("SELECT name FROM sqlite_master WHERE type='table'"
                          " AND name = ?")
                 if not cursor.execute(query, [t]).fetchone():
                     _log.info("Creating table {}".format(t))
                     self.create_table(cursor, t)
+                    created += 1
+
+            # A new DB already has the latest schema.
+            if created == len(self.db_tables):
+                cursor.execute("PRAGMA user_version = {}".format(
+                    len(self.migrations)))
+
+            self.migrate(cursor)
 
         finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.commit()
-                conn.close()
+            cursor.close()
+            self.conn.commit()
+
+    def make_entry(self, table, values):
+        """Make the in-memory key and Row of a row's field values."""
+
+        values = list(values)
+        key_vals = []
+        for i in self.key_indexes[table]:
+            value = values[i]
+            if type(value) is str:
+                value = sys.intern(value.lower())
+                # Share the key string with the row when it's already lower
+                # case.
+                if value == values[i]:
+                    values[i] = value
+            key_vals.append(value)
+
+        row_key = key_vals[0] if len(key_vals) == 1 else tuple(key_vals)
+        return row_key, self.row_classes[table](values)
+
+    def get_select_statement(self, table, where=None):
+        fields_statement = ", ".join([f['name'] for f in self.db_tables[table]])
+        statement = "SELECT {} FROM {}".format(fields_statement, table)
+        if where:
+            statement += " WHERE {}".format(where)
+        return statement
 
     def load_db(self):
         """Load the user database from the sqlite3 DB, creating one if
         necessary. The sqlite3 data are loaded into an in-memory copy that can
-        be retrieved through `get_user_data()`."""
+        be retrieved through `get_user_data()`. When loading lazily, only
+        pinned rows are loaded."""
 
         self.check_db()
 
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
+        cursor = self.conn.cursor()
 
         try:
 
             for t in self.db_tables:
-                keys = self.get_table_keys(t)
-
-                fields = self.db_tables[t]
-                fields_statement = ", ".join([f['name'] for f in fields])
-
-                query = ("SELECT {} FROM {}".format(fields_statement, t))
+                if t in self.unloaded_tables:
+                    continue
+
+                if self.cache_size:
+                    self.db_data[t] = RowCache(
+                        self.cache_size, functools.partial(self.is_clean, t))
+                    if t != self.user_table or not self.pinned_fields:
+                        continue
+
+                    query = self.get_select_statement(t, " OR ".join(
+                        "{} > 0".format(f) for f in self.pinned_fields))
+                    for row in cursor.execute(query):
+                        row_key, db_entry = self.make_entry(t, row)
+                        self.db_data[t].pin(row_key, db_entry)
+                    continue
 
                 self.db_data[t] = {}
-                for row in cursor.execute(query):
-                    key_vals = []
-                    db_entry = {}
-                    for i, f in enumerate(fields):
-                        if f['name'] in keys:
-                            if f['type'] == "text":
-                                key_vals.append(row[i].lower())
-                            else:
-                                key_vals.append(row[i])
+                for row in cursor.execute(self.get_select_statement(t)):
+                    row_key, db_entry = self.make_entry(t, row)
+                    self.db_data[t][row_key] = db_entry
 
-                        db_entry[f['name']] = row[i]
-
-                    self.db_data[t][tuple(key_vals)] = db_entry
+            self.load_indexes(cursor)
 
         finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
+            cursor.close()
+
+        if self.writer:
+            self.writer.start()
+
+    def load_indexes(self, cursor):
+        """Load the in-memory indexes. These only need the rows with
+        non-default values, which the DB indexes find quickly."""
+
+        for t in self.indexes:
+            keys = self.get_table_keys(t)
+            for name in self.indexes[t]:
+                default = self.get_field(t, name).get('default')
+                query = "SELECT {}, {} FROM {} WHERE {} != ?".format(
+                    ", ".join(keys), name, t, name)
+                for row in cursor.execute(query, [default]):
+                    self.update_index(t, self.get_row_key(row[:-1]), name,
+                                      None, row[-1])
+
+    def update_index(self, table, row_key, field, old_value, value):
+        """Update the in-memory index of a field for a change to a row."""
+
+        index = self.indexes[table].get(field)
+        if index is None or old_value == value:
+            return
+
+        if old_value in index:
+            index[old_value].discard(row_key)
+            if not index[old_value]:
+                del index[old_value]
+
+        if value != self.get_field(table, field).get('default'):
+            index.setdefault(value, set()).add(row_key)
+
+    def get_indexed_keys(self, table, field, value):
+        """Get the set of keys of the rows having the given value of an indexed
+        field. Rows having the field's default value aren't indexed."""
+
+        if value == self.get_field(table, field).get('default'):
+            raise Exception("default value of field {} isn't indexed".format(
+                field))
+
+        return self.indexes[table][field].get(value, frozenset())
+
+    def user_has_value(self, user_name, field, value):
+        """Does the user have the given value of an indexed field? This
+        doesn't look the user up in the DB, even when loading lazily."""
+
+        return self.get_row_key([user_name]) in self.get_indexed_keys(
+            self.user_table, field, value)
+
+    def is_clean(self, table, row_key):
+        """Are all changes to the given cached row in the DB?"""
+
+        seq = self.dirty.get((table, row_key))
+        if seq is None:
+            return True
+
+        if seq <= self.writer.committed_seq:
+            del self.dirty[(table, row_key)]
+            return True
+
+        return False
+
+    def lookup_row(self, table, keys):
+        """Look up a row in the DB by its keys, returning its entry or None."""
+
+        key = (table, None, "select")
+        if key not in self.statements:
+            key_terms = " AND ".join(['{} = ?'.format(k)
+                                      for k in self.get_table_keys(table)])
+            self.statements[key] = self.get_select_statement(table, key_terms)
+
+        row = self.conn.execute(self.statements[key], keys).fetchone()
+        if not row:
+            return
+
+        return self.make_entry(table, row)[1]
+
+    def update_pin(self, table, row_key, entry):
+        """Pin or unpin a cached row depending on its pinned field values."""
+
+        if table != self.user_table or not self.pinned_fields:
+            return
+
+        if any(int(entry.get(f) or 0) > 0 for f in self.pinned_fields):
+            self.db_data[table].pin(row_key, entry)
+        else:
+            self.db_data[table].unpin(row_key)
+
+    def get_insert_statement(self, table):
+        key = (table, None, "insert")
+        if key not in self.statements:
+            fields = self.db_tables[table]
+            self.statements[key] = "INSERT INTO {} ({}) VALUES ({})".format(
+                table, ", ".join([f['name'] for f in fields]),
+                ", ".join(['?'] * len(fields)))
+        return self.statements[key]
+
+    def get_update_statement(self, table, field):
+        key = (table, field, "update")
+        if key not in self.statements:
+            key_terms = " AND ".join(['{} = ?'.format(k)
+                                      for k in self.get_table_keys(table)])
+            self.statements[key] = "UPDATE {} SET {} = ? WHERE {}".format(
+                table, field, key_terms)
+        return self.statements[key]
+
+    def execute_write(self, table, op, statement, params, row_key):
+        """Run a statement that changes the DB and commit it, or with
+        write-behind, queue it for the writer."""
+
+        if self.writer:
+            seq = self.writer.write(table, op, statement, params, row_key)
+            if self.cache_size and row_key is not None:
+                self.dirty[(table, row_key)] = seq
+            return
 
+        with metrics.Timer(metrics.db_write_latency, table, op):
+            try:
+                self.conn.execute(statement, params)
+                self.conn.commit()
+
+            except Exception:
+                self.conn.rollback()
+                raise
 
     def add_row(self, table, row):
         """Add a row to the given DB table."""
 
-        key_fields = self.get_table_keys(table)
-        row_key = []
-        for k in key_fields:
+        keys = []
+        for k in self.get_table_keys(table):
             if k not in row:
                 raise Exception("row missing key {}".format(k))
 
-            if type(row[k]) is str:
-                row_key.append(row[k].lower())
-            else:
-                row_key.append(row[k])
+            keys.append(row[k])
 
-        row_key = tuple(row_key)
-        if row_key in self.db_data[table]:
-            raise Exception("row key {} already exists".format(row_key))
+        if self.get_row(table, keys) is not None:
+            raise Exception("row key {} already exists".format(
+                self.get_row_key(keys)))
 
-        row_entry = {}
         vals = []
-        for i, field in enumerate(self.db_tables[table]):
+        for field in self.db_tables[table]:
             if field['name'] not in row:
                 vals.append(field['default'])
             else:
                 vals.append(row[field['name']])
 
-            row_entry[field['name']] = vals[i]
+        row_key, row_entry = self.make_entry(table, vals)
+        self.execute_write(table, "insert", self.get_insert_statement(table),
+                           vals, row_key)
+        self.db_data[table][row_key] = row_entry
+        for field in self.indexes[table]:
+            self.update_index(table, row_key, field, None, row_entry[field])
+        if self.cache_size:
+            self.update_pin(table, row_key, row_entry)
+        self.notify_change(table, row_entry)
+        return row_entry
 
-        field_terms = ", ".join([f['name'] for f in self.db_tables[table]])
-        param_terms = ", ".join(['?'] * len(vals))
+    def select_rows(self, table, where=None, params=()):
+        """Select rows of a table directly from the DB, returning a list of
+        Rows. The `where` clause can also order and limit the rows."""
 
-        try:
-            conn = sqlite3.connect(self.db_file)
+        rows = self.conn.execute(self.get_select_statement(table, where),
+                                 params)
+        return [self.row_classes[table](row) for row in rows]
 
-            statement = "INSERT INTO {} ({}) VALUES ({})".format(table,
-                field_terms, param_terms)
+    def replace_row(self, table, row):
+        """Insert a row into an unloaded table, replacing any row with the same
+        key."""
 
-            cursor = conn.cursor()
-            cursor.execute(statement, vals)
-            conn.commit()
+        key = (table, None, "replace")
+        if key not in self.statements:
+            self.statements[key] = self.get_insert_statement(table).replace(
+                "INSERT", "INSERT OR REPLACE", 1)
 
-        finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
+        vals = [row.get(f['name'], f.get('default'))
+                for f in self.db_tables[table]]
+        self.execute_write(table, "replace", self.statements[key], vals, None)
 
-        self.db_data[table][row_key] = row_entry
-        return row_entry
+    def delete_rows(self, table, where, params=()):
+        """Delete the rows of an unloaded table matching a where clause."""
+
+        self.execute_write(table, "delete",
+                           "DELETE FROM {} WHERE {}".format(table, where),
+                           params, None)
 
     def set_row_field(self, table, keys, field, value):
         """Set a field for the given table and unique row, and update the
@@ -168,37 +868,111 @@ class BotDB():
         if not entry:
             raise Exception("row not found for key {}".format(keys))
 
-        key_fields = self.get_table_keys(table)
-        key_terms = " AND ".join(['WHERE {} = ?'.format(k)
-            for k in key_fields])
-
-        params = [str(value)] + keys
-
-        try:
-            conn = sqlite3.connect(self.db_file)
-
-            statement= "UPDATE {} SET {} = ? " "{}".format(table, field,
-                    key_terms)
-
-            cursor = conn.cursor()
-            cursor.execute(statement, params)
-            conn.commit()
-
-        finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
-
+        row_key = self.get_row_key(keys)
+        params = [str(value)] + list(keys)
+        self.execute_write(table, "update",
+                           self.get_update_statement(table, field), params,
+                           row_key)
+        self.update_index(table, row_key, field, entry[field], value)
         entry[field] = value
+        if self.cache_size:
+            self.update_pin(table, row_key, entry)
+        self.notify_change(table, entry)
+
+    def notify_change(self, table, entry):
+        if self.change_listener:
+            self.change_listener(table, dict(entry.items()))
+
+    def apply_row(self, table, row):
+        """Apply a row another process added or changed to the in-memory copy
+        of the DB. The row isn't written, since the other process does that."""
+
+        row_key, new_entry = self.make_entry(
+            table, [row.get(f['name'], f.get('default'))
+                    for f in self.db_tables[table]])
+        rows = self.db_data[table]
+        entry = rows.get(row_key)
+        for field, index in self.indexes[table].items():
+            old_value = None
+            if entry is not None:
+                old_value = entry[field]
+            else:
+                # The row may be indexed without being loaded.
+                for value, keys in index.items():
+                    if row_key in keys:
+                        old_value = value
+                        break
+            self.update_index(table, row_key, field, old_value,
+                              new_entry[field])
+
+        if entry is None:
+            entry = new_entry
+            rows[row_key] = entry
+        else:
+            for field, value in new_entry.items():
+                entry[field] = value
+        if self.cache_size:
+            self.update_pin(table, row_key, entry)
+
+    def reload_row(self, table, row_key):
+        """Reload a row from the DB after a write to it failed, so that the
+        in-memory copy matches the DB again."""
+
+        if table not in self.db_data:
+            return
+
+        keys = list(row_key) if type(row_key) is tuple else [row_key]
+        entry = self.lookup_row(table, keys)
+        _log.warning("DB: Reloading row %s of table %s after a failed write",
+                     row_key, table)
+        if entry is not None:
+            self.apply_row(table, dict(entry.items()))
+            self.notify_change(table, entry)
+            return
+
+        # The row was never added.
+        old_entry = self.db_data[table].pop(row_key, None)
+        if old_entry is not None:
+            for field in self.indexes[table]:
+                self.update_index(table, row_key, field, old_entry[field],
+                                  self.get_field(table, field).get('default'))
 
     def get_row(self, table, keys):
         """Get the data for the given row in the the given table using the
         row's keys. Handles any case-insensitivity of the lookup. Returns None
         if row not found."""
 
-        row_key = tuple(k.lower() if type(k) is str else k for k in keys)
-        return self.db_data[table].get(row_key)
+        row_key = self.get_row_key(keys)
+        rows = self.db_data[table]
+        entry = rows.get(row_key)
+        if entry is not None or not self.cache_size:
+            return entry
+
+        if rows.is_missing(row_key):
+            metrics.db_cache_lookups.inc(table, "known_missing")
+            return
+
+        entry = self.lookup_row(table, keys)
+        if entry is None:
+            metrics.db_cache_lookups.inc(table, "missing")
+            rows.set_missing(row_key)
+        else:
+            metrics.db_cache_lookups.inc(table, "loaded")
+            rows[row_key] = entry
+            self.update_pin(table, row_key, entry)
+        return entry
+
+    def get_row_key(self, keys):
+        """Get the in-memory key of a row from its key values. Text keys are
+        lower-cased and interned, and tables with a single key use the value
+        itself instead of a tuple."""
+
+        row_key = tuple(sys.intern(k.lower()) if type(k) is str else k
+                        for k in keys)
+        if len(row_key) == 1:
+            return row_key[0]
+
+        return row_key
 
     def get_user_data(self, user_name):
         return self.get_row(self.user_table, [user_name])
@@ -12,6 +12,9 @@ import time
 import traceback
 import sys
 
+from . import metrics
+from . import tracing
+
 _log = logging.getLogger()
 
 class BotCommandException(Exception):
@@ -58,6 +61,17 @@ class ChatWatcher():
         else:
             return user
 
+    def is_bot_user(self, user):
+        """Is the user the bot itself? Chat from the bot is never handled."""
+
+        return user == self.login_user
+
+    def note_command(self, sender, message):
+        """Called for each attempted bot or DCSS command that isn't over the
+        command limit."""
+
+        pass
+
     def get_dcss_nick(self, user):
         """Return the nick we have mapped for a given user."""
 
@@ -255,54 +269,82 @@ class ChatWatcher():
     def read_chat(self, sender, message):
         """Read a chat message and process any bot or DCSS commands"""
 
-        if sender == self.login_user:
+        if self.is_bot_user(sender):
             return
 
         if not self.is_allowed_user(sender):
             return
 
+        metrics.chat_messages.inc(self.manager.service)
+        # Only traces of commands are written.
+        trace = tracing.start_trace(self.manager.service, self.describe(),
+                                    sender, message)
         admin = self.manager.user_is_admin(sender)
         command_time = time.time()
         # We don't return right away so we can log attempts to issue commands
         # over the rate limit.
-        at_limit = self.at_command_limit(command_time)
+        with tracing.span(trace, "rate_limit"):
+            at_limit = self.at_command_limit(command_time)
         invalid_usage = False
         bot_cmd = None
-        try:
-            bot_cmd = self.parse_bot_command(sender, message)
+        is_dcss = False
+        with tracing.span(trace, "parse"):
+            try:
+                bot_cmd = self.parse_bot_command(sender, message)
 
-        except BotCommandException as e:
-            if admin or not at_limit:
-                yield from self.send_chat(e.args[0])
+            except BotCommandException as e:
+                usage_error = e.args[0]
+                invalid_usage = True
+
+            if not invalid_usage and not bot_cmd:
+                is_dcss = self.manager.dcss_manager.is_dcss_message(message)
 
-            invalid_usage = True
+        if invalid_usage and (admin or not at_limit):
+            with tracing.span(trace, "send_chat"):
+                yield from self.send_chat(usage_error)
 
         # Message wasn't a command at all.
-        if (not invalid_usage
-                and not bot_cmd
-                and not self.manager.dcss_manager.is_dcss_message(message)):
+        if not invalid_usage and not bot_cmd and not is_dcss:
             return
 
         if not admin and at_limit:
+             metrics.command_limit_rejections.inc(self.manager.service)
              _log.warn("%s: Attempted command ignored due to command limit "
                      "(source: %s, requester: %s): %s", self.manager.service,
                        self.describe(), sender, message)
+             if trace:
+                 trace.finish("rate_limited")
              return
 
         # This was an attempted command, record it for rate-limiting.
         if not admin:
             self.message_times.append(command_time)
+        self.note_command(sender, message)
+
+        if invalid_usage:
+            command_type = "invalid"
+        elif bot_cmd:
+            command_type = "bot"
+        else:
+            command_type = "dcss"
+        metrics.chat_commands.inc(self.manager.service, command_type)
 
         if invalid_usage:
+            if trace:
+                trace.finish("invalid")
             return
 
         if bot_cmd:
             target_user, command, args = bot_cmd
-            yield from self.run_bot_command(sender, target_user, command, args,
-                    message)
+            with tracing.span(trace, "bot_command", command=command):
+                yield from self.run_bot_command(sender, target_user, command,
+                        args, message)
+            if trace:
+                trace.finish()
         else:
+            # The trace is finished once the query result is sent.
             yield from self.manager.dcss_manager.read_message(self, sender,
-                    message)
+                    message, trace)
 
 
 @asyncio.coroutine
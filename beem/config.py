@@ -5,15 +5,21 @@ from logging.handlers import RotatingFileHandler
 import os
 import os.path
 import pytoml
+import re
 
+from .botdb import journal_modes, synchronous_modes
 from .dcss import bot_services
+from .webtiles import work_queue_policies
 
 class BotConfig():
     """Base class for TOML config parsing for bots."""
 
-    def __init__(self, path):
+    def __init__(self, path, log_index=None):
         self.data = {}
         self.path = path
+        # A worker process logs to its own file, named with this index after
+        # the configured filename, so that processes don't rotate one file.
+        self.log_index = log_index
 
     def __getattr__(self, name):
         try:
@@ -48,9 +54,8 @@ class BotConfig():
                 self.error("In table {}, {}field {} undefined.".format(
                     table_name, condition_text, field))
 
-    def init_logging(self):
-        """Check the logging configuration in the TOML file and initialize the
-        Python logger based on this."""
+    def check_logging(self):
+        """Check the logging configuration in the TOML file."""
 
         if not self.get("logging_config"):
             self.error("logging_config table undefined.")
@@ -60,8 +65,29 @@ class BotConfig():
         self.require_table_fields("logging_config", log_conf,
                                   ["max_bytes", "backup_count"], "filename")
 
+    def check_patterns(self, table_name, field, patterns):
+        """Check that the regular expressions in a field compile."""
+
+        for p in patterns:
+            try:
+                re.compile(p)
+
+            except re.error as e:
+                self.error("In table {}, invalid pattern in {}: {}: "
+                           "{}".format(table_name, field, p, e))
+
+    def init_logging(self):
+        """Check the logging configuration in the TOML file and initialize the
+        Python logger based on this."""
+
+        self.check_logging()
+        log_conf = self.logging_config
+
         if log_conf.get("filename"):
-            handler = RotatingFileHandler(log_conf["filename"],
+            filename = log_conf["filename"]
+            if self.log_index is not None:
+                filename = "{}.{}".format(filename, self.log_index)
+            handler = RotatingFileHandler(filename,
                                           maxBytes=log_conf["max_bytes"],
                                           backupCount=log_conf["backup_count"])
         else:
@@ -103,16 +129,27 @@ class BotConfig():
 
                 if entry.get(field):
                     found_service = True
-                    break
+                    self.check_patterns(table_desc, field, entry[field])
 
             if not found_service:
                 self.error("In {}, at least one of the pattern fields {} "
                         "must be defined.".format(table_desc,
                             ", ".join(pattern_fields)))
 
-    def load(self):
+        self.check_patterns("dcss", "bad_patterns",
+                            self.dcss.get("bad_patterns", []))
+
+        result_cache = self.dcss.get("result_cache")
+        if result_cache:
+            for s in result_cache.get("services", []):
+                if s not in bot_services:
+                    self.error("In dcss.result_cache, unknown service {} in "
+                               "services.".format(s))
+
+    def load(self, reload=False):
         """Read the main TOML configuration data from self.path and check that
-        the configuration is valid."""
+        the configuration is valid. When reloading, the logger is already
+        initialized, so the logging configuration is only checked."""
 
         if not os.path.exists(self.path):
             self.error("Couldn't find file!")
@@ -130,44 +167,147 @@ class BotConfig():
             finally:
                 config_fh.close()
 
-        self.init_logging()
+        if reload:
+            self.check_logging()
+        else:
+            self.init_logging()
 
 
 class BeemConfig(BotConfig):
     """Handle configuration data loading for beem."""
 
-    def check_webtiles(self):
-        """Check that there is a 'dcss' table in the TOML data and that it has
-        the necessary entries."""
+    def check_webtiles_server(self, table_name, webtiles):
+        """Check that the table for a WebTiles server has the necessary
+        entries."""
 
-        webtiles = self.webtiles
-        self.require_table_fields("webtiles", webtiles,
+        self.require_table_fields(table_name, webtiles,
                                   ["server_url", "protocol_version",
-                                   "username", "password", "help_text"])
-
-        if self.get("watch_player"):
-            self.webtiles["max_watched_subscribers"] = 1
-            self.webtiles["max_game_idle"] = float("inf")
-            self.webtiles["game_rewatch_timeout"] = float("inf")
-            self.webtiles["autowatch_enabled"] = False
+                                   "help_text"])
+
+        if not webtiles.get("accounts"):
+            self.require_table_fields(table_name, webtiles,
+                                      ["username", "password"])
+        self.require_table_fields(table_name, webtiles, ["password"],
+                                  "username")
+        for i, entry in enumerate(webtiles.get("accounts", [])):
+            self.require_table_fields(
+                "{}.accounts, entry {}".format(table_name, i + 1), entry,
+                ["username", "password"])
+
+        self.require_table_fields(table_name, webtiles,
+                                  ["account_send_period"],
+                                  "account_send_limit")
+
+        policy = webtiles.get("work_queue_policy")
+        if policy and policy not in work_queue_policies:
+            self.error("In table {}, work_queue_policy must be one of: "
+                       "{}".format(table_name, ", ".join(work_queue_policies)))
+
+        shards = webtiles.get("shards")
+        if shards is not None and (type(shards) is not int or shards < 1):
+            self.error("In table {}, shards must be a positive "
+                       "integer".format(table_name))
+        if shards and shards > 1 and not self.get("workers"):
+            self.error("In table {}, shards can only be used with "
+                       "workers".format(table_name))
+
+        if webtiles.get("watch_player"):
+            if shards and shards > 1:
+                self.error("In table {}, shards can't be used with "
+                           "watch_player".format(table_name))
+
+            webtiles["max_watched_subscribers"] = 1
+            webtiles["max_game_idle"] = float("inf")
+            webtiles["game_rewatch_timeout"] = float("inf")
+            webtiles["autowatch_enabled"] = False
             return
 
-        self.require_table_fields("webtiles", webtiles,
+        self.require_table_fields(table_name, webtiles,
                                   ["max_watched_subscribers", "max_game_idle",
                                    "game_rewatch_timeout"])
 
-        self.require_table_fields("webtiles", webtiles,
+        self.require_table_fields(table_name, webtiles,
                                   ["min_autowatch_spectators"],
                                   "autowatch_enabled")
 
-    def load(self):
+    def check_webtiles(self):
+        """Check the WebTiles server configuration, which is either a single
+        webtiles table or an array of webtiles tables, one per server. Entries
+        in an array take any fields they don't define from the
+        webtiles_defaults table, and have their own DB unless they set
+        db_file. The checked server tables are stored in
+        self.webtiles_servers."""
+
+        if not self.get("webtiles"):
+            self.error("The webtiles table is undefined.")
+
+        if not isinstance(self.webtiles, list):
+            self.check_webtiles_server("webtiles", self.webtiles)
+            self.webtiles_servers = [self.webtiles]
+            return
+
+        defaults = self.get("webtiles_defaults", {})
+        self.webtiles_servers = []
+        names = set()
+        for i, entry in enumerate(self.webtiles):
+            table_desc = "webtiles, entry {}".format(i + 1)
+            server = dict(defaults)
+            server.update(entry)
+
+            self.require_table_fields(table_desc, server, ["name"])
+            if server["name"] in names:
+                self.error("In {}, server name {} is already used.".format(
+                    table_desc, server["name"]))
+            names.add(server["name"])
+
+            # The same username on another server may be someone else, so
+            # each server gets its own DB unless one is set.
+            if "db_file" not in server:
+                base, ext = os.path.splitext(self.db_file)
+                server["db_file"] = "{}-{}{}".format(
+                    base, re.sub(r"[^A-Za-z0-9_-]", "_", server["name"]), ext)
+
+            self.check_webtiles_server(table_desc, server)
+            self.webtiles_servers.append(server)
+
+    def check_metrics(self):
+        """Check the optional metrics table, which needs either a port or a
+        unix socket path to serve metrics on."""
+
+        if not self.get("metrics"):
+            return
+
+        if not self.metrics.get("unix_socket"):
+            self.require_table_fields("metrics", self.metrics, ["port"])
+
+    def load(self, reload=False):
         """Read the main TOML configuration data from self.path and check that
         the configuration is valid."""
 
-        super().load()
+        super().load(reload)
 
         if not self.get("db_file"):
             self.error("Field db_file undefined.")
 
+        if self.get("db_journal_mode", "wal") not in journal_modes:
+            self.error("Field db_journal_mode must be one of: {}".format(
+                ", ".join(journal_modes)))
+        if self.get("db_synchronous", "normal") not in synchronous_modes:
+            self.error("Field db_synchronous must be one of: {}".format(
+                ", ".join(synchronous_modes)))
+        cache_size = self.get("db_cache_size")
+        if cache_size is not None and (type(cache_size) is not int
+                                       or cache_size < 1):
+            self.error("Field db_cache_size must be a positive integer")
+        workers = self.get("workers")
+        if workers is not None:
+            if type(workers) is not int or workers < 1:
+                self.error("Field workers must be a positive integer")
+            if self.get("restart_socket"):
+                self.error("Field restart_socket can't be used with workers")
+
         self.check_webtiles()
         self.check_dcss()
+        self.check_metrics()
+        if self.get("tracing"):
+            self.require_table_fields("tracing", self.tracing, ["filename"])
@@ -7,8 +7,10 @@ else:
     ensure_future = asyncio.ensure_future
 
 import base64
+import collections
 import irc.client
 import irc.functools as irc_functools
+import json
 import logging
 import os
 import signal
@@ -19,6 +21,9 @@ import sys
 import time
 import traceback
 
+from . import metrics
+from . import tracing
+
 _log = logging.getLogger()
 
 # How long to wait in second for a query before ignoring any result from a bot
@@ -29,6 +34,20 @@ _MAX_REQUEST_TIME = 120
 # connection.
 _RECONNECT_TIMEOUT = 5
 
+# Defaults for the result cache settings.
+_RESULT_TTL = 3600
+_RESULT_MAX_ENTRIES = 10000
+_RESULT_COMPACT_INTERVAL = 600
+_RESULT_SERVICES = ["monster", "git"]
+_RESULT_TABLE = "dcss_results"
+# Bots can answer a query with several messages, and there's no sign of the
+# last one, so a cached result is complete once no more of it has arrived for
+# this many seconds. Until then it isn't used or saved.
+_RESULT_SETTLE_TIME = 5
+# DCSS settings applied by a config reload. Changes to other settings need a
+# restart.
+_RELOAD_FIELDS = ["bad_patterns", "bots"]
+
 # Strings for services provided by DCSS bots. Used to match fields in the
 # config andto indicate what type of query was performed.
 bot_services = ["sequell", "monster", "git"]
@@ -41,14 +60,162 @@ _query_prefix_regex = re.compile(r"^([a-zA-Z0-9])")
 _player_var_regex = re.compile(r"\$p(?=\W|$)|\$\{p\}")
 _chat_var_regex = re.compile(r"\$chat(?=\W|$)|\$\{chat\}")
 
+class ResultCache():
+    """Caches the results of queries to DCSS bots for services whose results
+    don't depend on who asked, so repeated queries are answered without asking
+    the bot. Results are used and written to a BotDB table once they're
+    complete, and are loaded at startup, so the cache is warm after a restart.
+    The cache and the table are limited to the most recent max_entries
+    results, and entries older than the TTL are removed by compact()."""
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.ttl = conf.get("ttl", _RESULT_TTL)
+        self.max_entries = conf.get("max_entries", _RESULT_MAX_ENTRIES)
+        self.compact_interval = conf.get("compact_interval",
+                                         _RESULT_COMPACT_INTERVAL)
+        self.services = conf.get("services", _RESULT_SERVICES)
+        # Dicts with the results of each query, keyed by the query's cache
+        # key, least recently used first.
+        self.entries = collections.OrderedDict()
+        # Keys of the entries whose results may still be arriving.
+        self.incomplete = set()
+        self.bot_db = None
+        self.time_compact = time.time() + self.compact_interval
+        metrics.dcss_cached_results.set_function(lambda: len(self.entries))
+
+    def load(self, bot_db):
+        """Load unexpired results from the DB, and save new results there."""
+
+        self.bot_db = bot_db
+        rows = bot_db.select_rows(_RESULT_TABLE,
+                                  "time >= ? ORDER BY time DESC LIMIT ?",
+                                  [int(time.time() - self.ttl),
+                                   self.max_entries])
+        for row in reversed(rows):
+            try:
+                results = [tuple(r) for r in json.loads(row["results"])]
+
+            except ValueError:
+                continue
+
+            self.entries[(row["service"], row["query"])] = {
+                "time" : row["time"],
+                "time_part" : row["time"],
+                "query_time" : None,
+                "complete" : True,
+                "results" : results}
+
+        _log.info("DCSS: Loaded %s cached query results", len(self.entries))
+
+    def get_key(self, service, message):
+        """Get the cache key of a query, or None if it's not cacheable."""
+
+        if service not in self.services:
+            return
+
+        return (service, message.strip())
+
+    def get(self, key):
+        """Get the list of (message, message type) results of a query, or None
+        if they aren't cached. Results still arriving aren't used."""
+
+        self.finish_entries()
+        entry = self.entries.get(key)
+        if entry and time.time() - entry["time"] >= self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry and not entry["complete"]:
+            entry = None
+
+        metrics.dcss_result_cache.inc(key[0], "hit" if entry else "miss")
+        if not entry:
+            return
+
+        self.entries.move_to_end(key)
+        return entry["results"]
+
+    def add_result(self, query, message, message_type):
+        """Add a result message for a query. Later messages for the same query
+        are added to the same entry, which is incomplete until they stop
+        arriving."""
+
+        key = query["cache_key"]
+        entry = self.entries.get(key)
+        if not entry or entry["query_time"] != query["time"]:
+            entry = {"time" : time.time(),
+                     "query_time" : query["time"],
+                     "results" : []}
+            self.entries[key] = entry
+        entry["results"].append((message, message_type))
+        entry["time_part"] = time.time()
+        entry["complete"] = False
+        self.incomplete.add(key)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.incomplete.discard(old_key)
+
+    def finish_entries(self):
+        """Mark the entries whose results have stopped arriving as complete,
+        saving them to the DB."""
+
+        if not self.incomplete:
+            return
+
+        current_time = time.time()
+        for key in list(self.incomplete):
+            entry = self.entries.get(key)
+            if (entry and current_time - entry["time_part"]
+                    < _RESULT_SETTLE_TIME):
+                continue
+
+            self.incomplete.discard(key)
+            if not entry:
+                continue
+
+            entry["complete"] = True
+            if self.bot_db:
+                self.bot_db.replace_row(
+                    _RESULT_TABLE,
+                    {"service" : key[0],
+                     "query" : key[1],
+                     "time" : int(entry["time"]),
+                     "results" : json.dumps(entry["results"])})
+
+    def compact(self):
+        """Remove expired entries from the cache and the DB, and keep the DB
+        table from growing beyond max_entries rows."""
+
+        current_time = time.time()
+        self.time_compact = current_time + self.compact_interval
+        for key, entry in list(self.entries.items()):
+            if current_time - entry["time"] >= self.ttl:
+                del self.entries[key]
+                self.incomplete.discard(key)
+
+        if not self.bot_db:
+            return
+
+        self.bot_db.delete_rows(_RESULT_TABLE, "time < ?",
+                                [int(current_time - self.ttl)])
+        self.bot_db.delete_rows(_RESULT_TABLE,
+                                "rowid NOT IN (SELECT rowid FROM {} ORDER BY "
+                                "time DESC LIMIT ?)".format(_RESULT_TABLE),
+                                [self.max_entries])
+
+
 class IRCBot():
     """Coodrinate queries for a bot."""
 
     def __init__(self, manager, conf):
         self.manager = manager
         self.conf = conf
+        self.queries = {}
 
         self.init_services()
+        metrics.dcss_queries_in_flight.set_function(lambda: len(self.queries),
+                                                    conf["nick"])
 
     def init_services(self):
         """Find any services we have in the config and create their regex
@@ -131,14 +298,17 @@ class IRCBot():
                     self.queue.remove(i)
 
             elif current_time - self.queries[i]["time"] >= _MAX_REQUEST_TIME:
+                if self.queries[i]["trace"]:
+                    self.queries[i]["trace"].finish("expired")
                 del self.queries[i]
                 if i in self.queue:
                     self.queue.remove(i)
 
-    def make_query_entry(self, source, username, message):
+    def make_query_entry(self, source, username, message, trace=None):
         """Find a query id available for use, recording the details of the
         requesting source and username as well as the time of the request in a
-        dict that is stored in our dict of pending queries."""
+        dict that is stored in our dict of pending queries. Any trace of the
+        query is kept in the dict so its result can be traced."""
 
         current_time = time.time()
         self.expire_query_entries(current_time)
@@ -155,20 +325,27 @@ class IRCBot():
         if query_id is None:
             raise Exception("too many queries in queue")
 
+        query_type = self.get_message_service(message)
+        cache_key = None
+        if self.manager.result_cache:
+            cache_key = self.manager.result_cache.get_key(query_type, message)
+
         query = {'id'           : query_id,
                  'requester'    : username,
                  'source_ident' : source.get_source_ident(),
                  'time'         : current_time,
-                 'type'         : self.get_message_service(message)}
+                 'type'         : query_type,
+                 'trace'        : trace,
+                 'cache_key'    : cache_key}
         self.queries[query_id] = query
 
         return query
 
     @asyncio.coroutine
-    def send_query_message(self, source, requester, message):
+    def send_query_message(self, source, requester, message, trace=None):
         """Send a message containing a DCSS query to the bot."""
 
-        query_entry = self.make_query_entry(source, requester, message)
+        query_entry = self.make_query_entry(source, requester, message, trace)
 
         if 'sequell' in self.services:
             message = self.prepare_sequell_message(source, requester,
@@ -176,7 +353,9 @@ class IRCBot():
         else:
             self.queue.append(query_entry['id'])
 
-        yield from self.manager.send(self.conf["nick"], message)
+        metrics.dcss_queries.inc(self.conf["nick"], query_entry["type"])
+        with tracing.span(trace, "irc_send", bot=self.conf["nick"]):
+            yield from self.manager.send(self.conf["nick"], message)
 
     def get_message_query_id(self, message):
         """Get the originating query ID associated with the given IRC message
@@ -230,6 +409,9 @@ class IRCBot():
 
         self.last_answered_query = self.queries[query_id]
         del self.queries[query_id]
+        metrics.dcss_query_latency.observe(
+            time.time() - self.last_answered_query["time"], self.conf["nick"],
+            self.last_answered_query["type"])
         return self.last_answered_query
 
 
@@ -239,18 +421,57 @@ class DCSSManager():
     chat."""
 
     ## Can't depend on beem_conf, as this isn't loaded yet.
-    def __init__(self, conf):
+    def __init__(self, conf, result_cache=True):
         self.conf = conf
         self.bots = {}
         for bot_conf in self.conf["bots"]:
             bot = IRCBot(self, bot_conf)
             self.bots[bot_conf["nick"]] = bot
         self.managers = {}
+        # Holds received IRC messages until they can be processed.
+        self.messages = []
+        metrics.irc_receive_queue.set_function(lambda: len(self.messages))
+        # A process that doesn't query the bots itself has no use for a
+        # result cache.
+        self.result_cache = None
+        if result_cache and self.conf.get("result_cache"):
+            self.result_cache = ResultCache(self.conf["result_cache"])
+        self.init_bad_patterns()
 
         self.reactor = Reactor()
         self.reactor.add_global_handler("all_events", self.dispatcher, -10)
         self.server = self.reactor.server()
 
+    def init_bad_patterns(self):
+        self.bad_patterns = [re.compile(p)
+                             for p in self.conf.get("bad_patterns", [])]
+
+    def reload(self, conf):
+        """Apply a reloaded DCSS config, recompiling the bad patterns and the
+        patterns of each bot. Returns a list of the changed settings that need
+        a restart, which keep their current values."""
+
+        restart = []
+        for field in sorted(set(self.conf) | set(conf)):
+            if (field not in _RELOAD_FIELDS
+                    and self.conf.get(field) != conf.get(field)):
+                restart.append("dcss.{}".format(field))
+
+        new_conf = dict(self.conf)
+        new_conf["bad_patterns"] = conf.get("bad_patterns", [])
+        if sorted(b["nick"] for b in conf["bots"]) != sorted(self.bots):
+            restart.append("dcss.bots")
+        else:
+            for bot_conf in conf["bots"]:
+                bot = self.bots[bot_conf["nick"]]
+                bot.conf = bot_conf
+                bot.init_services()
+            new_conf["bots"] = conf["bots"]
+
+        self.conf = new_conf
+        self.init_bad_patterns()
+        return restart
+
     def log_exception(self, error_msg):
         """Log an exception and its traceback with the given message describing
         the source of the exception."""
@@ -368,6 +589,15 @@ class DCSSManager():
                     self.log_exception("Error handling IRC message from nick "
                             "{}: {}".format(nick, message))
 
+            if self.result_cache:
+                try:
+                    self.result_cache.finish_entries()
+                    if time.time() >= self.result_cache.time_compact:
+                        self.result_cache.compact()
+
+                except Exception:
+                    self.log_exception("Unable to update result cache")
+
             # XXX This seems needed to give other coroutines a chance to run.
             # It may be needed until we can rework the irc connection to use
             # asyncio's connections/streams.
@@ -382,6 +612,7 @@ class DCSSManager():
             return
 
         self.server.privmsg(nick, message)
+        metrics.irc_messages_sent.inc(nick)
 
     def dispatcher(self, connection, event):
         """Dispatch events to on_<event.type> method, if present. All messages
@@ -440,6 +671,11 @@ class DCSSManager():
         if not query:
             return
 
+        trace = query["trace"]
+        if trace:
+            trace.add_span("bot_response", query["time"], time.time(),
+                           bot=nick)
+
         manager = self.managers[query["source_ident"]["service"]]
         source = manager.get_source_by_ident(query["source_ident"])
         if not source:
@@ -461,12 +697,22 @@ class DCSSManager():
                     break
 
             if bot:
+                results = self.get_cached_results(bot, message)
+                if results:
+                    # As below, don't hold up reading IRC.
+                    ensure_future(self.send_cached_result(source, bot,
+                                                          results, trace))
+                    return
+
                 try:
-                    yield from bot.send_query_message(source,
-                            query["requester"], message)
+                    with tracing.span(trace, "relay", bot=bot.conf["nick"]):
+                        yield from bot.send_query_message(source,
+                                query["requester"], message, trace)
                     return
 
                 except Exception:
+                    if trace:
+                        trace.finish("error")
                     self.log_exception("Unable to relay message to {} from {} "
                             "on behalf of {}: {}".format(bot.conf['nick'],
                                 source.describe(), query["requester"],
@@ -483,10 +729,52 @@ class DCSSManager():
         else:
             message_type = query["type"]
 
-        yield from source.send_chat(message, message_type)
+        if query["cache_key"] and self.result_cache:
+            self.result_cache.add_result(query, message, message_type)
+
+        # The source may need to wait before it can send, so don't hold up
+        # reading IRC. Sources send their messages in order.
+        ensure_future(self.send_result(source, message, message_type, trace))
 
     @asyncio.coroutine
-    def read_message(self, source, username, message):
+    def send_result(self, source, message, message_type, trace=None):
+        """Send a query result to the source's chat, finishing any trace of
+        the query."""
+
+        with tracing.span(trace, "send_chat"):
+            yield from source.send_chat(message, message_type)
+        if trace:
+            trace.finish()
+
+    def get_cached_results(self, bot, message):
+        """Get the cached results of a query to the bot, or None if there
+        aren't any."""
+
+        if not self.result_cache:
+            return
+
+        key = self.result_cache.get_key(bot.get_message_service(message),
+                                        message)
+        if not key:
+            return
+
+        return self.result_cache.get(key)
+
+    @asyncio.coroutine
+    def send_cached_result(self, source, bot, results, trace=None):
+        """Send cached results of a query to the bot to the source."""
+
+        if trace:
+            trace.add_span("result_cache", time.time(), time.time(),
+                           bot=bot.conf["nick"])
+        for i, (result, message_type) in enumerate(results):
+            # Only the last result finishes the trace.
+            yield from self.send_result(source, result, message_type,
+                                        trace if i == len(results) - 1
+                                        else None)
+
+    @asyncio.coroutine
+    def read_message(self, source, username, message, trace=None):
         """Read a message from the given source and username, sending any query
         to the appropriate bot."""
 
@@ -497,12 +785,24 @@ class DCSSManager():
                 break
 
         if not bot:
+            if trace:
+                trace.finish("error")
             raise Exception("Unknown bot message: {}".format(message))
 
+        results = self.get_cached_results(bot, message)
+        if results:
+            yield from self.send_cached_result(source, bot, results, trace)
+            return
+
         try:
-            yield from bot.send_query_message(source, username, message)
+            with tracing.span(trace, "dcss_read_message",
+                              bot=bot.conf["nick"]):
+                yield from bot.send_query_message(source, username, message,
+                                                  trace)
 
         except Exception:
+            if trace:
+                trace.finish("error")
             self.log_exception("Unable to send message from {} to {} "
                     "(requester: {}, message: {})".format(source.describe(),
                         bot.conf["nick"], username, message))
@@ -515,11 +815,8 @@ class DCSSManager():
         """Does this message match against a 'bad pattern' regexp that excludes
         it from processing?"""
 
-        if not self.conf.get("bad_patterns"):
-            return False
-
-        for pat in self.conf["bad_patterns"]:
-            if re.search(pat, message):
+        for pat in self.bad_patterns:
+            if pat.search(message):
                 _log.debug("DCSS: Bad pattern message: %s", message)
                 return True
 
@@ -670,3 +967,28 @@ class Reactor(irc.client.Reactor):
     def handle_sasl_900(self, connection, event):
         connection.cap("END")
         connection.authenticated = True
+
+
+# Fields names and default values of the DCSS tables in the DB. These tables
+# aren't loaded into memory by BotDB.
+db_tables = {
+        _RESULT_TABLE : [
+            {"name" : "service",
+             "type" : "text",
+             "primary" : True,
+            },
+            {"name" : "query",
+             "type" : "text",
+             "primary" : True,
+            },
+            {"name" : "time",
+             "type" : "integer",
+             "default" : 0,
+             "index" : True
+            },
+            {"name" : "results",
+             "type" : "text",
+             "default" : "[]"
+            },
+        ],
+}
@@ -0,0 +1,255 @@
+"""Decoding and filtering of incoming WebTiles websocket frames."""
+
+import base64
+import importlib
+import json
+import logging
+import re
+import zlib
+
+_log = logging.getLogger()
+
+# JSON modules we can use to decode frames, in order of preference when the
+# decoder is "auto". Each must provide a loads() function that accepts str.
+json_decoders = ["orjson", "ujson", "simplejson", "json"]
+
+# Compressed frames at least this many bytes long are inflated on a worker
+# thread instead of the event loop thread.
+inflate_thread_min_bytes = 16384
+
+# Appended to each compressed frame to complete the deflate sync flush that
+# the server strips.
+_DEFLATE_TRAILER = bytes([0, 0, 255, 255])
+
+# Matches the message type fields of the messages in a frame. Quotes within
+# JSON strings are always escaped, so this won't match message text.
+_msg_type_regex = re.compile(r'(?<!\\)"msg"\s*:\s*"([^"\\]+)"')
+
+# Message types used only to render the game or the lobby. Game connections
+# in chat-only ingest mode drop these without decoding them.
+render_message_types = frozenset([
+    "cursor",
+    "close_all_menus",
+    "close_menu",
+    "delay",
+    "dump",
+    "flash",
+    "game_client",
+    "html",
+    "init_input",
+    "input_mode",
+    "layout",
+    "lobby_clear",
+    "lobby_complete",
+    "lobby_entry",
+    "lobby_html",
+    "lobby_remove",
+    "map",
+    "menu",
+    "msgs",
+    "options",
+    "player",
+    "set_game_links",
+    "text_cursor",
+    "txt",
+    "ui-pop",
+    "ui-push",
+    "ui-scroll",
+    "ui-state",
+    "ui-state-sync",
+    "ui_state",
+    "update_menu",
+    "update_menu_items",
+])
+
+
+class IngestStats():
+    """Counts of messages and bytes received, broken down by message type and
+    by whether the message was dropped without being handled. Also counts the
+    bytes we've sent and the time spent handling each type of message."""
+
+    def __init__(self):
+        self.frames = 0
+        self.frames_skipped = 0
+        # Decompressed bytes of the frames, and their size on the wire.
+        self.bytes = 0
+        self.wire_bytes = 0
+        self.bytes_sent = 0
+        self.messages_sent = 0
+        # Dicts of message type to counts of messages and bytes. Bytes for
+        # frames holding several messages are split evenly between them.
+        self.kept = {}
+        self.dropped = {}
+        self.type_bytes = {}
+        # Dict of message type to seconds spent handling messages of the type.
+        self.handle_time = {}
+
+    def record_received(self, num_bytes):
+        self.wire_bytes += num_bytes
+
+    def record_sent(self, num_bytes):
+        self.messages_sent += 1
+        self.bytes_sent += num_bytes
+
+    def record_handling(self, msg_type, elapsed):
+        self.handle_time[msg_type] = (self.handle_time.get(msg_type, 0)
+                                      + elapsed)
+
+    def get_handle_time(self):
+        return sum(self.handle_time.values())
+
+    def record_frame(self, num_bytes, msg_types, dropped_types, skipped):
+        self.frames += 1
+        self.bytes += num_bytes
+        if skipped:
+            self.frames_skipped += 1
+
+        if not msg_types:
+            return
+
+        share = num_bytes / len(msg_types)
+        for t in msg_types:
+            counts = self.dropped if t in dropped_types else self.kept
+            counts[t] = counts.get(t, 0) + 1
+            self.type_bytes[t] = self.type_bytes.get(t, 0) + share
+
+    def merge(self, other):
+        """Add the counts from another IngestStats object to ours."""
+
+        self.frames += other.frames
+        self.frames_skipped += other.frames_skipped
+        self.bytes += other.bytes
+        self.wire_bytes += other.wire_bytes
+        self.bytes_sent += other.bytes_sent
+        self.messages_sent += other.messages_sent
+        for ours, theirs in ((self.kept, other.kept),
+                             (self.dropped, other.dropped),
+                             (self.type_bytes, other.type_bytes),
+                             (self.handle_time, other.handle_time)):
+            for t, count in theirs.items():
+                ours[t] = ours.get(t, 0) + count
+
+    def describe_usage(self):
+        """Return a short summary of bytes received and sent and handling
+        time."""
+
+        return "{:.0f}KB in, {:.0f}KB out, {:.2f}s handling".format(
+            self.wire_bytes / 1024, self.bytes_sent / 1024,
+            self.get_handle_time())
+
+    def describe(self, limit=10):
+        """Return a one-line summary of the message types with the most
+        bytes."""
+
+        num_dropped = sum(self.dropped.values())
+        num_kept = sum(self.kept.values())
+        types = sorted(self.type_bytes, key=lambda t: self.type_bytes[t],
+                       reverse=True)[:limit]
+        breakdown = ", ".join(
+            "{} {}/{}/{:.0f}KB/{:.2f}s".format(t, self.kept.get(t, 0),
+                                              self.dropped.get(t, 0),
+                                              self.type_bytes[t] / 1024,
+                                              self.handle_time.get(t, 0))
+            for t in types)
+        return ("{} frames ({} undecoded), {:.0f}KB decompressed, {}, {} "
+                "messages kept, {} dropped; by type "
+                "(kept/dropped/size/handling): {}".format(
+                    self.frames, self.frames_skipped, self.bytes / 1024,
+                    self.describe_usage(), num_kept, num_dropped, breakdown))
+
+
+def get_json_loads(name=None):
+    """Get the loads() function of the named JSON module. If name is None or
+    "auto", use the first module in `json_decoders` that's installed."""
+
+    if name and name != "auto":
+        if name not in json_decoders:
+            raise Exception("unknown JSON decoder: {}".format(name))
+        return importlib.import_module(name).loads
+
+    for n in json_decoders:
+        try:
+            module = importlib.import_module(n)
+        except ImportError:
+            continue
+
+        _log.debug("Using JSON decoder %s", n)
+        return module.loads
+
+
+class FrameRecorder():
+    """Write the raw frames received by connections to a file, one JSON object
+    per line, for use by the ingest benchmark. Each connection has its own
+    deflate stream, so frames are tagged with a connection number."""
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path, "a")
+        self.num_connections = 0
+
+    def new_connection(self):
+        self.num_connections += 1
+        return self.num_connections
+
+    def record(self, conn_num, data):
+        if isinstance(data, bytes):
+            entry = {"conn" : conn_num,
+                     "data" : base64.b64encode(data).decode("ascii")}
+        else:
+            entry = {"conn" : conn_num, "text" : data}
+        self.fh.write(json.dumps(entry) + "\n")
+
+    def close(self):
+        self.fh.close()
+
+
+def make_inflater():
+    """Make a decompressor for the raw deflate stream of a WebTiles
+    connection."""
+
+    return zlib.decompressobj(-zlib.MAX_WBITS)
+
+
+def inflate_frame(inflater, data):
+    """Decompress one frame of a connection's deflate stream into text. Frames
+    must be given in the order they were received."""
+
+    return inflater.decompress(data + _DEFLATE_TRAILER).decode("utf-8")
+
+
+def decode_frame(text, drop_types=None, stats=None, loads=json.loads):
+    """Decode the text of a frame into a list of message dicts using the given
+    JSON loads() function. Messages with types in `drop_types` are removed, and
+    if every message in the frame is to be dropped, the JSON is never
+    decoded. Message types are only found with a regex when there are types to
+    drop; otherwise they're taken from the decoded messages."""
+
+    msg_types = None
+    if drop_types:
+        msg_types = _msg_type_regex.findall(text)
+
+    skipped = False
+    if (drop_types
+            and msg_types
+            and all(t in drop_types for t in msg_types)):
+        messages = []
+        skipped = True
+    else:
+        message = loads(text)
+        if "msgs" in message:
+            messages = message["msgs"]
+        elif "msg" in message:
+            messages = [message]
+        else:
+            raise Exception("Received unknown message: {}".format(text))
+
+        if msg_types is None and stats:
+            msg_types = [m["msg"] for m in messages if "msg" in m]
+        if drop_types:
+            messages = [m for m in messages
+                        if m.get("msg") not in drop_types]
+
+    if stats:
+        stats.record_frame(len(text), msg_types, drop_types or (), skipped)
+
+    return messages
@@ -0,0 +1,459 @@
+"""Counters, gauges and histograms describing the running server, and an
+optional endpoint that serves them in the Prometheus and OpenMetrics text
+formats."""
+
+import asyncio
+import logging
+import math
+import os
+import socket
+import stat
+import time
+
+_log = logging.getLogger()
+
+# Upper bounds in seconds of the default histogram buckets.
+latency_buckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60, 120]
+
+# How long in seconds to wait for a client to send its request.
+_REQUEST_TIMEOUT = 10
+
+_PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+_OPENMETRICS_CONTENT_TYPE = ("application/openmetrics-text; version=1.0.0; "
+                             "charset=utf-8")
+
+
+def escape_label_value(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+def format_bound(bound):
+    """Format a histogram bucket bound for its "le" label in the canonical
+    float form, so that a bound of 1 is always the series le="1.0"."""
+
+    if bound == math.inf:
+        return "+Inf"
+    return repr(float(bound))
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+
+    return "{" + ",".join('{}="{}"'.format(n, escape_label_value(v))
+                          for n, v in pairs) + "}"
+
+
+class Metric():
+    """Base class for metrics. Each metric has a fixed list of label names, and
+    a value for each combination of label values it's been updated with."""
+
+    type_name = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+        # Functions returning dicts of label values to values, for metrics
+        # whose label values are only known when they're exposed.
+        self.collectors = []
+
+    def check_labels(self, label_values):
+        if len(label_values) != len(self.label_names):
+            raise Exception("metric {} takes labels {}, got {}".format(
+                self.name, self.label_names, label_values))
+
+    def remove(self, *label_values):
+        """Stop exporting the value for the given labels."""
+
+        self.values.pop(tuple(label_values), None)
+
+    def add_collector(self, func):
+        self.collectors.append(func)
+
+    def set_function(self, func, *label_values):
+        """Export the result of calling func as the value for the given
+        labels."""
+
+        self.check_labels(label_values)
+        self.values[label_values] = func
+
+    def get_values(self):
+        """Return a sorted list of (label values, value) tuples, calling any
+        value functions and collectors."""
+
+        values = {}
+        for k, v in self.values.items():
+            values[k] = v() if callable(v) else v
+        for collector in self.collectors:
+            values.update(collector())
+        return sorted(values.items())
+
+    def get_samples(self):
+        """Return a list of (suffix, label values, extra label, value) tuples
+        for the metric's current values."""
+
+        return [("", k, None, v) for k, v in self.get_values()]
+
+    def expose(self, openmetrics=False):
+        name = self.name
+        if openmetrics and self.type_name == "counter":
+            name = name[:-len("_total")]
+        lines = ["# HELP {} {}".format(name, self.description),
+                 "# TYPE {} {}".format(name, self.type_name)]
+        for suffix, values, extra, value in self.get_samples():
+            lines.append("{}{} {}".format(
+                self.name + suffix,
+                format_labels(self.label_names, values, extra),
+                format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    """A count that only increases. Names must end in _total. Counter values
+    can be functions returning counts kept elsewhere."""
+
+    type_name = "counter"
+
+    def inc(self, *label_values, amount=1):
+        self.check_labels(label_values)
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values):
+        return self.values.get(label_values, 0)
+
+
+class Gauge(Metric):
+    """A value that can go up and down. A gauge value can also be a function,
+    called whenever the metric is exposed, for values that are cheaper to
+    compute on demand than to keep up to date."""
+
+    type_name = "gauge"
+
+    def set(self, value, *label_values):
+        self.check_labels(label_values)
+        self.values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        self.check_labels(label_values)
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def get(self, *label_values):
+        value = self.values.get(label_values, 0)
+        return value() if callable(value) else value
+
+
+class Histogram(Metric):
+    """Counts of observed values in cumulative buckets, along with their sum
+    and count."""
+
+    type_name = "histogram"
+
+    def __init__(self, name, description, label_names=(),
+                 buckets=latency_buckets):
+        super().__init__(name, description, label_names)
+        self.buckets = list(buckets)
+
+    def observe(self, value, *label_values):
+        self.check_labels(label_values)
+        entry = self.values.get(label_values)
+        if not entry:
+            entry = {"counts" : [0] * (len(self.buckets) + 1), "sum" : 0}
+            self.values[label_values] = entry
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry["counts"][i] += 1
+                break
+        else:
+            entry["counts"][-1] += 1
+        entry["sum"] += value
+
+    def get_samples(self):
+        samples = []
+        for k, entry in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + [math.inf],
+                                    entry["counts"]):
+                total += count
+                samples.append(("_bucket", k, ("le", format_bound(bound)),
+                                total))
+            samples.append(("_count", k, None, total))
+            samples.append(("_sum", k, None, entry["sum"]))
+        return samples
+
+
+class Timer():
+    """A context manager that observes its elapsed time in a histogram."""
+
+    def __init__(self, histogram, *label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start,
+                               *self.label_values)
+
+
+class MetricsRegistry():
+    """A set of metrics exposed together."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise Exception("metric {} already registered".format(
+                metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def expose(self, openmetrics=False):
+        """Return the text exposition of all metrics."""
+
+        lines = []
+        for name in sorted(self.metrics):
+            try:
+                lines.extend(self.metrics[name].expose(openmetrics))
+
+            except Exception:
+                _log.exception("Metrics: Unable to expose metric %s", name)
+
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+# The registry holding all of beem's metrics.
+registry = MetricsRegistry()
+
+# WebTiles
+watched_games = registry.gauge(
+    "beem_watched_games", "Games being watched.", ["server", "kind"])
+queued_games = registry.gauge(
+    "beem_queued_games", "Subscriber games waiting for a watch slot.",
+    ["server"])
+watch_capacity = registry.gauge(
+    "beem_watch_capacity", "Current number of watch slots.",
+    ["server", "kind"])
+autowatch_spectators = registry.gauge(
+    "beem_autowatch_spectators", "Spectators of autowatched games.",
+    ["server"])
+connections_started = registry.counter(
+    "beem_connections_started_total", "WebTiles connections started.",
+    ["server", "kind"])
+connections_stopped = registry.counter(
+    "beem_connections_stopped_total", "WebTiles connections stopped.",
+    ["server", "kind", "reason"])
+received_bytes = registry.counter(
+    "beem_webtiles_received_bytes_total",
+    "Compressed bytes received from WebTiles.", ["server", "connection"])
+sent_bytes = registry.counter(
+    "beem_webtiles_sent_bytes_total", "Bytes sent to WebTiles.",
+    ["server", "connection"])
+received_messages = registry.counter(
+    "beem_webtiles_received_messages_total",
+    "Messages received by game connections, by type.", ["server", "type"])
+handling_time = registry.counter(
+    "beem_webtiles_handling_seconds_total",
+    "Time game connections spent handling messages, by type.",
+    ["server", "type"])
+watch_evictions = registry.counter(
+    "beem_watch_evictions_total",
+    "Watched games evicted for waiting subscribers.", ["server"])
+
+# Chat
+chat_messages = registry.counter(
+    "beem_chat_messages_total", "Chat messages read from other users.",
+    ["server"])
+chat_commands = registry.counter(
+    "beem_chat_commands_total", "Commands attempted in chat, by type.",
+    ["server", "type"])
+command_limit_rejections = registry.counter(
+    "beem_command_limit_rejections_total",
+    "Commands ignored because of the command limit.", ["server"])
+chat_sent = registry.counter(
+    "beem_chat_sent_total", "Chat messages sent by the bot.", ["server"])
+
+# DCSS
+dcss_queries = registry.counter(
+    "beem_dcss_queries_total", "Queries sent to the DCSS IRC bots.",
+    ["bot", "type"])
+dcss_queries_in_flight = registry.gauge(
+    "beem_dcss_queries_in_flight", "Queries awaiting a bot response.",
+    ["bot"])
+dcss_query_latency = registry.histogram(
+    "beem_dcss_query_latency_seconds",
+    "Time from sending a query to receiving its first response.",
+    ["bot", "type"])
+dcss_result_cache = registry.counter(
+    "beem_dcss_result_cache_lookups_total",
+    "Lookups of cacheable DCSS queries in the result cache.",
+    ["type", "result"])
+dcss_cached_results = registry.gauge(
+    "beem_dcss_cached_results", "Query results held in the result cache.")
+irc_receive_queue = registry.gauge(
+    "beem_irc_receive_queue_depth", "Received IRC messages awaiting handling.")
+irc_messages_sent = registry.counter(
+    "beem_irc_messages_sent_total", "Messages sent to IRC.", ["nick"])
+
+# Event loop
+loop_lag = registry.gauge(
+    "beem_loop_lag_seconds", "Moving average of event loop lag.")
+resident_memory = registry.gauge(
+    "beem_resident_memory_bytes", "Resident memory of the process.")
+
+# DB
+db_write_latency = registry.histogram(
+    "beem_db_write_latency_seconds", "Time taken to commit a DB write.",
+    ["table", "op"])
+db_cache_lookups = registry.counter(
+    "beem_db_cache_lookups_total",
+    "Lookups of rows not in the DB row cache, by result.", ["table", "result"])
+db_pending_writes = registry.gauge(
+    "beem_db_pending_writes", "DB writes waiting to be committed.", ["db"])
+db_durability_lag = registry.gauge(
+    "beem_db_durability_lag_seconds",
+    "How long the oldest uncommitted DB write has waited.", ["db"])
+
+
+class MetricsServer():
+    """Serves the metrics of a registry over HTTP on a TCP port or a unix
+    socket. Any GET of /metrics gets the exposition, in the OpenMetrics format
+    if the client accepts it, and the Prometheus text format otherwise."""
+
+    def __init__(self, conf, metrics_registry=registry):
+        self.conf = conf
+        self.registry = metrics_registry
+        self.server = None
+        # A listening socket to use instead of making one, such as one handed
+        # off by another process.
+        self.sock = None
+
+    def describe(self):
+        if self.conf.get("unix_socket"):
+            return "unix socket {}".format(self.conf["unix_socket"])
+
+        return "{}:{}".format(self.conf.get("host", "127.0.0.1"),
+                              self.conf["port"])
+
+    @asyncio.coroutine
+    def read_request(self, reader):
+        """Read the request line and headers, returning the method, path, and
+        a dict of lowercase header names to values."""
+
+        request = yield from reader.readline()
+        headers = {}
+        while True:
+            line = yield from reader.readline()
+            if not line or not line.strip():
+                break
+
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        parts = request.decode("latin-1").split()
+        if len(parts) < 2:
+            return None, None, headers
+
+        return parts[0], parts[1].split("?")[0], headers
+
+    @asyncio.coroutine
+    def handle_client(self, reader, writer):
+        try:
+            method, path, headers = yield from asyncio.wait_for(
+                self.read_request(reader), _REQUEST_TIMEOUT)
+
+            content_type = "text/plain; charset=utf-8"
+            if method not in ("GET", "HEAD"):
+                status = "405 Method Not Allowed"
+                body = "Method not allowed\n"
+            elif path not in ("/", "/metrics"):
+                status = "404 Not Found"
+                body = "Not found\n"
+            else:
+                status = "200 OK"
+                openmetrics = ("application/openmetrics-text"
+                               in headers.get("accept", ""))
+                body = self.registry.expose(openmetrics)
+                content_type = (_OPENMETRICS_CONTENT_TYPE if openmetrics
+                                else _PROMETHEUS_CONTENT_TYPE)
+
+            body = body.encode("utf-8")
+            head = ("HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}"
+                    "\r\nConnection: close\r\n\r\n".format(status,
+                                                          content_type,
+                                                          len(body)))
+            writer.write(head.encode("latin-1"))
+            if method != "HEAD":
+                writer.write(body)
+            yield from writer.drain()
+
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+        except Exception:
+            _log.exception("Metrics: Error handling request")
+
+        finally:
+            writer.close()
+
+    @asyncio.coroutine
+    def start(self):
+        """Serve metrics until cancelled."""
+
+        path = self.conf.get("unix_socket")
+        if self.sock and self.sock.family == socket.AF_UNIX:
+            self.server = yield from asyncio.start_unix_server(
+                self.handle_client, sock=self.sock)
+        elif self.sock:
+            self.server = yield from asyncio.start_server(
+                self.handle_client, sock=self.sock)
+        elif path:
+            # Remove a socket left behind by a previous run.
+            if (os.path.exists(path)
+                    and stat.S_ISSOCK(os.stat(path).st_mode)):
+                os.unlink(path)
+            self.server = yield from asyncio.start_unix_server(
+                self.handle_client, path=path)
+        else:
+            self.server = yield from asyncio.start_server(
+                self.handle_client, self.conf.get("host", "127.0.0.1"),
+                self.conf["port"])
+        _log.info("Metrics: Serving metrics on %s", self.describe())
+
+        try:
+            while True:
+                yield from asyncio.sleep(3600)
+
+        finally:
+            self.server.close()
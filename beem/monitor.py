@@ -0,0 +1,225 @@
+"""Monitoring of event loop responsiveness and process resource use."""
+
+import asyncio
+import bisect
+import logging
+import os
+import resource
+import time
+import weakref
+
+_log = logging.getLogger()
+
+# How often in seconds to sample event loop lag.
+_SAMPLE_INTERVAL = 0.25
+# Weight of each new lag sample in the moving average.
+_LAG_AVERAGE_WEIGHT = 0.05
+# Upper bounds in seconds of the lag histogram buckets. The last bucket holds
+# everything larger.
+LAG_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+# How often in seconds to log a summary of loop statistics.
+_SUMMARY_INTERVAL = 600
+# How many slow callback sources to keep in the summaries.
+_MAX_SLOW_SOURCES = 10
+# How many slow callback sources to track. Slow callbacks from new sources
+# after this are counted under "other".
+_MAX_SLOW_ENTRIES = 500
+
+# Names given to tasks with name_task().
+_task_names = weakref.WeakKeyDictionary()
+
+def name_task(task, name):
+    """Give a task a descriptive name, used to attribute slow callbacks."""
+
+    _task_names[task] = name
+    if hasattr(task, "set_name"):
+        task.set_name(name)
+
+def get_task_name(task):
+    return _task_names.get(task, "task")
+
+def get_coroutine_chain(coro):
+    """Return the qualified names of a coroutine and the coroutines it's
+    waiting on, outermost first. Awaitables without a name are given by their
+    type, so the chain doesn't depend on object addresses."""
+
+    names = []
+    while coro is not None and len(names) < 20:
+        names.append(getattr(coro, "__qualname__", None)
+                     or type(coro).__name__)
+        coro = (getattr(coro, "cr_await", None)
+                or getattr(coro, "gi_yieldfrom", None))
+    return names
+
+def describe_callback(callback):
+    """Describe a callback run by the event loop. For task steps, this is the
+    task's name and the chain of coroutines it's running."""
+
+    task = getattr(callback, "__self__", None)
+    if isinstance(task, asyncio.Future) and hasattr(task, "_coro"):
+        name = get_task_name(task)
+        chain = get_coroutine_chain(task._coro)
+        if len(chain) > 4:
+            chain = chain[:2] + ["..."] + chain[-2:]
+        return "{} ({})".format(name, " > ".join(chain))
+
+    return (getattr(callback, "__qualname__", None)
+            or type(callback).__name__)
+
+
+class LoopMonitor():
+    """Measures event loop lag, which is how much later than scheduled the loop
+    runs a callback, by repeatedly sleeping and timing how long the sleep
+    actually took. Also reports the process's resident memory, and if a
+    threshold is set, times every callback the loop runs and records the
+    sources of those slower than the threshold."""
+
+    def __init__(self, conf=None, sample_interval=_SAMPLE_INTERVAL):
+        self.conf = conf if conf else {}
+        self.sample_interval = sample_interval
+        # Exponential moving average of lag in seconds.
+        self.lag = 0
+        self.max_lag = 0
+        self.num_samples = 0
+        self.lag_counts = [0] * (len(LAG_BUCKETS) + 1)
+
+        # Dict of callback descriptions to dicts with the count, total time
+        # and max time of slow calls.
+        self.slow_callbacks = {}
+        self.orig_handle_run = None
+
+    def record_lag(self, lag):
+        self.num_samples += 1
+        self.lag += _LAG_AVERAGE_WEIGHT * (lag - self.lag)
+        self.max_lag = max(self.max_lag, lag)
+        self.lag_counts[bisect.bisect_left(LAG_BUCKETS, lag)] += 1
+
+    def get_lag_percentile(self, percent):
+        """Estimate a lag percentile from the histogram, returning the upper
+        bound of the bucket it falls in."""
+
+        target = self.num_samples * percent / 100
+        seen = 0
+        for i, count in enumerate(self.lag_counts):
+            seen += count
+            if seen >= target and count:
+                return LAG_BUCKETS[i] if i < len(LAG_BUCKETS) else self.max_lag
+        return 0
+
+    def record_slow_callback(self, desc, elapsed):
+        entry = self.slow_callbacks.get(desc)
+        if not entry and len(self.slow_callbacks) >= _MAX_SLOW_ENTRIES:
+            desc = "other"
+            entry = self.slow_callbacks.get(desc)
+        if not entry:
+            entry = {"count" : 0, "total" : 0, "max" : 0}
+            self.slow_callbacks[desc] = entry
+        entry["count"] += 1
+        entry["total"] += elapsed
+        entry["max"] = max(entry["max"], elapsed)
+
+        _log.debug("Monitor: Slow callback took %.3fs: %s", elapsed, desc)
+
+    def install_callback_timer(self):
+        """Time every callback the event loop runs by wrapping Handle._run.
+        Callbacks are described before they run, so a task step is attributed
+        to the coroutines it resumes rather than where it next suspends. This
+        costs two clock reads and a walk of the coroutine chain per callback,
+        so it's only done when a slow callback threshold is configured."""
+
+        threshold = self.conf.get("slow_callback_threshold")
+        if not threshold or self.orig_handle_run:
+            return
+
+        orig_run = asyncio.events.Handle._run
+        monitor = self
+
+        def timed_run(handle):
+            desc = None
+            if handle._callback:
+                desc = describe_callback(handle._callback)
+            start = time.monotonic()
+            orig_run(handle)
+            elapsed = time.monotonic() - start
+            if elapsed >= threshold and desc:
+                monitor.record_slow_callback(desc, elapsed)
+
+        self.orig_handle_run = orig_run
+        asyncio.events.Handle._run = timed_run
+
+    def remove_callback_timer(self):
+        if self.orig_handle_run:
+            asyncio.events.Handle._run = self.orig_handle_run
+            self.orig_handle_run = None
+
+    def get_rss(self):
+        """Return the resident set size of the process in bytes. Where
+        /proc isn't available, this is the peak RSS instead."""
+
+        try:
+            with open("/proc/self/statm") as fh:
+                pages = int(fh.read().split()[1])
+            return pages * os.sysconf("SC_PAGE_SIZE")
+
+        except (OSError, ValueError, IndexError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def get_slow_sources(self, limit=_MAX_SLOW_SOURCES):
+        """Return a list of (description, entry) tuples for the sources of
+        slow callbacks with the most total time."""
+
+        return sorted(self.slow_callbacks.items(),
+                      key=lambda item: item[1]["total"],
+                      reverse=True)[:limit]
+
+    def get_stats(self):
+        """Return a dict of the current loop statistics."""
+
+        return {"lag_average" : self.lag,
+                "lag_max" : self.max_lag,
+                "lag_p50" : self.get_lag_percentile(50),
+                "lag_p99" : self.get_lag_percentile(99),
+                "lag_samples" : self.num_samples,
+                "lag_histogram" : list(zip(LAG_BUCKETS + [float("inf")],
+                                           self.lag_counts)),
+                "rss" : self.get_rss(),
+                "slow_callbacks" : self.get_slow_sources()}
+
+    def describe(self, limit=3):
+        """Return a one-line summary of the loop statistics."""
+
+        stats = self.get_stats()
+        summary = ("loop lag avg {:.3f}s, p50 <= {}s, p99 <= {}s, max "
+                   "{:.3f}s; RSS {:.1f}MB".format(
+                       stats["lag_average"], stats["lag_p50"],
+                       stats["lag_p99"], stats["lag_max"],
+                       stats["rss"] / 1024 / 1024))
+        slow = stats["slow_callbacks"][:limit]
+        if slow:
+            summary += "; slowest: " + ", ".join(
+                "{} {}x {:.2f}s max {:.3f}s".format(desc, e["count"],
+                                                   e["total"], e["max"])
+                for desc, e in slow)
+        return summary
+
+    @asyncio.coroutine
+    def start(self):
+        """Sample loop lag and log periodic summaries until cancelled."""
+
+        self.install_callback_timer()
+        loop = asyncio.get_event_loop()
+        summary_interval = self.conf.get("summary_interval", _SUMMARY_INTERVAL)
+        time_summary = loop.time()
+        try:
+            while True:
+                expected = loop.time() + self.sample_interval
+                yield from asyncio.sleep(self.sample_interval)
+                self.record_lag(max(0, loop.time() - expected))
+
+                if (summary_interval
+                        and loop.time() - time_summary >= summary_interval):
+                    time_summary = loop.time()
+                    _log.info("Monitor: %s", self.describe())
+
+        finally:
+            self.remove_callback_timer()
@@ -0,0 +1,187 @@
+"""A sampling profiler that can be started while the bot is running.
+
+A profile runs on its own thread for a fixed duration, periodically sampling
+the stack of the event loop thread. Each sample is attributed to the asyncio
+task running at the time, using the names given with monitor.name_task(), and
+the samples are written as collapsed stacks that flame graph tools can read.
+Optionally, a diff of tracemalloc snapshots taken at the start and end of the
+profile is also written."""
+
+import asyncio
+import logging
+import os
+import os.path
+import sys
+import threading
+import time
+import tracemalloc
+
+from .monitor import get_task_name
+
+_log = logging.getLogger()
+
+_DURATION = 30
+_MAX_DURATION = 600
+_SAMPLE_INTERVAL = 0.005
+# How many lines of the tracemalloc diff to write.
+_MEMORY_DIFF_LINES = 50
+
+# The profiler set up by init_profiler().
+profiler = None
+
+
+def get_current_task(loop):
+    """Get the task running on the loop, if any. This reads the loop's current
+    task from another thread, so it's only a best guess."""
+
+    current_tasks = getattr(asyncio.tasks, "_current_tasks", None)
+    if current_tasks is None:
+        current_tasks = getattr(asyncio.Task, "_current_tasks", {})
+
+    try:
+        return current_tasks.get(loop)
+
+    except Exception:
+        return
+
+
+def get_frame_name(frame):
+    code = frame.f_code
+    name = getattr(code, "co_qualname", code.co_name)
+    return "{}:{}".format(os.path.basename(code.co_filename), name)
+
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(get_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class SamplingProfiler():
+    """Profiles the thread running the event loop. Only one profile can run at
+    a time."""
+
+    def __init__(self, conf=None):
+        self.conf = conf if conf else {}
+        self.thread = None
+        self.loop = None
+        self.loop_thread_id = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def get_output_prefix(self):
+        output_dir = self.conf.get("output_dir", ".")
+        return os.path.join(output_dir, "beem-profile-{}".format(
+            time.strftime("%Y%m%d-%H%M%S")))
+
+    def start(self, duration=None, trace_memory=None):
+        """Start a profile of the given duration in seconds, returning the path
+        prefix of the output files, or None if a profile is already running.
+        This must be called from the event loop thread."""
+
+        if self.is_running():
+            return
+
+        if not duration:
+            duration = self.conf.get("duration", _DURATION)
+        duration = min(duration, _MAX_DURATION)
+        if trace_memory is None:
+            trace_memory = self.conf.get("trace_memory", False)
+
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        prefix = self.get_output_prefix()
+
+        snapshot = None
+        # Leave tracemalloc running if something else started it.
+        stop_tracing = False
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.conf.get("trace_memory_frames", 1))
+                stop_tracing = True
+            snapshot = tracemalloc.take_snapshot()
+
+        self.thread = threading.Thread(target=self.run,
+                                       args=(duration, prefix, snapshot,
+                                             stop_tracing),
+                                       name="beem profiler", daemon=True)
+        self.thread.start()
+        _log.info("Profiler: Profiling for %s seconds, writing to %s",
+                  duration, prefix)
+        return prefix
+
+    def sample(self, counts):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+
+        task = get_current_task(self.loop)
+        task_name = get_task_name(task) if task else "event loop"
+        stack = "{};{}".format(task_name.replace(";", ","),
+                               collapse_stack(frame))
+        counts[stack] = counts.get(stack, 0) + 1
+
+    def run(self, duration, prefix, snapshot, stop_tracing):
+        interval = self.conf.get("sample_interval", _SAMPLE_INTERVAL)
+        counts = {}
+        num_samples = 0
+        time_end = time.monotonic() + duration
+
+        try:
+            while time.monotonic() < time_end:
+                self.sample(counts)
+                num_samples += 1
+                time.sleep(interval)
+
+            self.write_stacks(prefix + ".collapsed", counts)
+            if snapshot:
+                self.write_memory_diff(prefix + ".memory.txt", snapshot)
+
+        except Exception:
+            _log.exception("Profiler: Error while profiling")
+            return
+
+        finally:
+            if stop_tracing:
+                tracemalloc.stop()
+
+        task_counts = {}
+        for stack, count in counts.items():
+            task_name = stack.split(";", 1)[0]
+            task_counts[task_name] = task_counts.get(task_name, 0) + count
+        top_tasks = sorted(task_counts.items(), key=lambda item: item[1],
+                           reverse=True)[:5]
+        _log.info("Profiler: Wrote %d samples to %s.collapsed; busiest tasks: "
+                  "%s", num_samples, prefix, ", ".join(
+                      "{} {:.0f}%".format(name, 100 * count / num_samples)
+                      for name, count in top_tasks))
+
+    def write_stacks(self, path, counts):
+        with open(path, "w") as fh:
+            for stack, count in sorted(counts.items()):
+                fh.write("{} {}\n".format(stack, count))
+
+    def write_memory_diff(self, path, snapshot):
+        end_snapshot = tracemalloc.take_snapshot()
+        stats = end_snapshot.compare_to(snapshot, "lineno")
+        with open(path, "w") as fh:
+            for stat in stats[:_MEMORY_DIFF_LINES]:
+                fh.write("{}\n".format(stat))
+
+
+def init_profiler(conf=None):
+    global profiler
+    profiler = SamplingProfiler(conf)
+
+def start_profile(duration=None, trace_memory=None):
+    """Start a profile with the profiler, returning the path prefix of its
+    output files, or None if a profile is already running."""
+
+    if not profiler:
+        init_profiler()
+
+    return profiler.start(duration, trace_memory)
@@ -0,0 +1,211 @@
+"""Fast restarts with state restore.
+
+This is not a seamless handoff: the new process opens its own WebSocket and
+IRC connections, so every watched game reconnects and the bot rejoins IRC.
+What's kept is the state, so the new process can start watching the same games
+right away instead of waiting for the lobby and autowatch to find them again.
+
+A process with a restart socket configured listens on that unix socket. When a
+new process starts with the same config, it connects to the socket before
+loading the DB and asks the running process for its state. The running process
+waits briefly for pending DCSS queries to be answered, commits its DB writes,
+and replies with the watch state of each WebTiles manager and, using
+SCM_RIGHTS, the file descriptors of its listening metrics sockets. Once the
+new process acknowledges the reply, the running process shuts down, and the
+new process restores the watch state and serves metrics on the same sockets.
+
+Live connections aren't passed across: their TLS sessions and compression
+state only exist in the old process."""
+
+import array
+import asyncio
+import json
+import logging
+import os
+import socket
+import stat
+import time
+
+_log = logging.getLogger()
+
+# How long to wait for the other process at each step of a restart.
+_RESTART_TIMEOUT = 10
+# How long the running process waits for pending DCSS queries to be answered
+# before sending its state.
+_DRAIN_TIMEOUT = 5
+# The most file descriptors sent in a restart.
+_MAX_FDS = 16
+_REQUEST = b"restart\n"
+_ACK = b"ok\n"
+
+
+def receive_message(sock):
+    """Receive a JSON message and any file descriptors sent with it."""
+
+    data = b""
+    fds = array.array("i")
+    while not data.endswith(b"\n"):
+        chunk, ancillary, flags, addr = sock.recvmsg(
+            65536, socket.CMSG_LEN(_MAX_FDS * fds.itemsize))
+        if not chunk:
+            raise Exception("connection closed during restart")
+
+        data += chunk
+        for level, ctype, cdata in ancillary:
+            if level == socket.SOL_SOCKET and ctype == socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata)
+                                    - (len(cdata) % fds.itemsize)])
+
+    return json.loads(data.decode("utf-8")), list(fds)
+
+
+def request_state(path):
+    """Ask the process listening on the restart socket to stop, returning
+    its saved state, with a "sockets" list of socket objects for the
+    listening sockets it sent. Returns None if no process is listening."""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(_RESTART_TIMEOUT + _DRAIN_TIMEOUT)
+    try:
+        try:
+            sock.connect(path)
+
+        except (FileNotFoundError, ConnectionRefusedError):
+            return
+
+        _log.info("Restart: Requesting state from the process on %s", path)
+        sock.sendall(_REQUEST)
+        state, fds = receive_message(sock)
+
+        sockets = []
+        for desc, fd in zip(state.get("sockets", []), fds):
+            sockets.append(socket.fromfd(fd, desc["family"],
+                                         socket.SOCK_STREAM))
+            os.close(fd)
+        state["sockets"] = sockets
+        sock.sendall(_ACK)
+
+    finally:
+        sock.close()
+
+    _log.info("Restart: Received state for %s from pid %s",
+              ", ".join(state["managers"]), state["pid"])
+    return state
+
+
+class RestartServer():
+    """Listens on the restart socket, and sends our state to a new process
+    when asked, then stops. The beem server provides get_restart_state(),
+    get_restart_sockets(), wait_db_written(), and stop()."""
+
+    def __init__(self, path, beem_server):
+        self.path = path
+        self.beem_server = beem_server
+
+    @asyncio.coroutine
+    def drain_queries(self):
+        """Wait a little for pending DCSS queries to be answered, since they
+        can't be handed off."""
+
+        bots = self.beem_server.dcss_manager.bots.values()
+        time_end = time.time() + _DRAIN_TIMEOUT
+        while (time.time() < time_end
+               and any(bot.queries for bot in bots)):
+            yield from asyncio.sleep(0.1)
+
+        pending = sum(len(bot.queries) for bot in bots)
+        if pending:
+            _log.warning("Restart: Dropping %s pending DCSS queries", pending)
+
+    @asyncio.coroutine
+    def send_reply(self, conn, state, fds):
+        """Send the restart state and file descriptors without blocking the
+        loop. The message is small, so the first sendmsg() almost always sends
+        all of it."""
+
+        loop = asyncio.get_event_loop()
+        message = json.dumps(state).encode("utf-8") + b"\n"
+        ancillary = []
+        if fds:
+            ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                          array.array("i", fds))]
+        time_end = time.time() + _RESTART_TIMEOUT
+        while True:
+            try:
+                sent = conn.sendmsg([message], ancillary)
+                break
+
+            except BlockingIOError:
+                if time.time() >= time_end:
+                    raise Exception("timed out sending restart state")
+                yield from asyncio.sleep(0.01)
+
+        if sent < len(message):
+            yield from asyncio.wait_for(
+                loop.sock_sendall(conn, message[sent:]), _RESTART_TIMEOUT)
+
+    @asyncio.coroutine
+    def handle(self, conn):
+        loop = asyncio.get_event_loop()
+        request = b""
+        while not request.endswith(b"\n") and len(request) < len(_REQUEST):
+            chunk = yield from asyncio.wait_for(loop.sock_recv(conn, 64),
+                                                _RESTART_TIMEOUT)
+            if not chunk:
+                return
+            request += chunk
+
+        if request != _REQUEST:
+            _log.warning("Restart: Ignoring unknown request: %r", request)
+            return
+
+        _log.info("Restart: Sending state to a new process")
+        yield from self.drain_queries()
+        state = self.beem_server.get_restart_state()
+        sockets = self.beem_server.get_restart_sockets()
+        state["sockets"] = [{"family" : int(s.family)} for s in sockets]
+
+        # Commit queued DB writes so the new process can load them.
+        yield from asyncio.wait_for(self.beem_server.wait_db_written(),
+                                    _RESTART_TIMEOUT)
+        yield from self.send_reply(conn, state, [s.fileno() for s in sockets])
+        ack = yield from asyncio.wait_for(loop.sock_recv(conn, len(_ACK)),
+                                          _RESTART_TIMEOUT)
+        if ack != _ACK:
+            _log.error("Restart: New process didn't accept our state; "
+                       "continuing")
+            return
+
+        _log.info("Restart: State sent; shutting down")
+        self.beem_server.stop()
+
+    @asyncio.coroutine
+    def start(self):
+        """Listen for restart requests until cancelled."""
+
+        loop = asyncio.get_event_loop()
+        # A previous process may still be listening on the old socket file,
+        # which is fine, since it's shutting down.
+        if (os.path.exists(self.path)
+                and stat.S_ISSOCK(os.stat(self.path).st_mode)):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(1)
+        sock.setblocking(False)
+        _log.info("Restart: Listening on %s", self.path)
+
+        try:
+            while True:
+                conn, addr = yield from loop.sock_accept(sock)
+                try:
+                    yield from self.handle(conn)
+
+                except Exception:
+                    _log.exception("Restart: Error sending state")
+
+                finally:
+                    conn.close()
+
+        finally:
+            sock.close()
@@ -10,6 +10,7 @@ else:
     ensure_future = asyncio.ensure_future
 
 import functools
+import json
 import logging
 import os
 import signal
@@ -19,9 +20,17 @@ import webtiles
 
 from .botdb import BotDB
 from .config import BeemConfig
-from .dcss import DCSSManager
+from .dcss import DCSSManager, db_tables as dcss_db_tables
+from . import restart
+from . import metrics
+from . import profiler
+from . import shard
+from . import tracing
+from .monitor import LoopMonitor, name_task
+from .timers import TimerWheel
 from .version import version
-from .webtiles import WebTilesManager, db_tables
+from .webtiles import WebTilesManager, db_tables, db_migrations
+from .webtiles import state_db_tables
 
 # Will be configured by beem_server after the config is loaded.
 _log = logging.getLogger()
@@ -32,15 +41,28 @@ class BeemServer:
     """The beem server. Load the configuration and runs the tasks for the DCSS
     and WebTiles managers.
 
+    With 'workers' configured, the server is a supervisor that runs the
+    WebTiles managers in worker processes. A worker is given its index, the
+    socket to the supervisor, and the names of its managers in `worker`.
+
     """
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, worker=None):
+        self.config_file = config_file
+        self.worker = worker
+        self.supervisor = None
+        self.supervisor_task = None
         self.dcss_task = None
-        self.webtiles_task = None
+        self.webtiles_tasks = []
+        self.timers_task = None
+        self.monitor_task = None
+        self.metrics_task = None
+        self.restart_task = None
         self.loop = asyncio.get_event_loop()
         self.shutdown_error = False
 
-        self.conf = BeemConfig(config_file)
+        self.conf = BeemConfig(config_file,
+                               self.worker["index"] if self.worker else None)
 
         try:
             self.conf.load()
@@ -49,8 +71,49 @@ class BeemServer:
             self.critical_error("Error loading configuration file"
                     " {}:".format(self.conf.path))
 
-        self.dcss_manager = DCSSManager(self.conf.dcss)
+        if self.conf.get("tracing"):
+            tracing_conf = self.conf.tracing
+            if self.worker:
+                tracing_conf = dict(tracing_conf)
+                tracing_conf["filename"] = "{}.{}".format(
+                    tracing_conf["filename"], self.worker["index"])
+            tracing.init_tracing(tracing_conf)
+        profiler.init_profiler(self.conf.get("profiler"))
+
+        # Get the state of a running process before loading the DB, so that we
+        # load its last writes.
+        self.restart_state = None
+        if self.conf.get("restart_socket"):
+            try:
+                self.restart_state = restart.request_state(
+                    self.conf.restart_socket)
+
+            except Exception:
+                _log.exception("Restart: Unable to get the state of the "
+                               "running process; starting normally")
+
+        if self.worker:
+            self.dcss_manager = shard.RemoteDCSS(self.conf.dcss,
+                                                 self.worker["fd"], self)
+        else:
+            self.dcss_manager = DCSSManager(self.conf.dcss)
+        self.timers = TimerWheel()
+        self.monitor = LoopMonitor(self.conf.get("monitor"))
+        metrics.loop_lag.set_function(lambda: self.monitor.lag)
+        metrics.resident_memory.set_function(self.monitor.get_rss)
+        self.metrics_server = None
+        if self.conf.get("metrics"):
+            metrics_conf = self.conf.metrics
+            if self.worker:
+                metrics_conf = shard.get_worker_metrics_conf(
+                    metrics_conf, self.worker["index"])
+            self.metrics_server = metrics.MetricsServer(metrics_conf)
+            if self.restart_state and self.restart_state["sockets"]:
+                self.metrics_server.sock = self.restart_state["sockets"][0]
         self.load_webtiles()
+        if self.conf.get("workers") and not self.worker:
+            self.supervisor = shard.Supervisor(config_file, self.conf,
+                                               self.dcss_manager, self.bot_dbs)
 
     def critical_error(self, error_msg):
         _log.critical("Server error: %s", error_msg)
@@ -61,27 +124,165 @@ class BeemServer:
 
         sys.exit(1)
 
-    def load_webtiles(self):
-        bot_db = BotDB(self.conf.db_file, db_tables, "webtiles_users")
+    def load_db(self, db_file):
+        tables = dict(db_tables)
+        tables.update(dcss_db_tables)
+        tables.update(state_db_tables)
+        bot_db = BotDB(db_file, tables, "webtiles_users",
+                       self.conf.get("db_journal_mode", "wal"),
+                       self.conf.get("db_synchronous", "normal"),
+                       self.conf.get("db_write_behind", True),
+                       self.conf.get("db_cache_size"), ["subscription"],
+                       db_migrations,
+                       list(dcss_db_tables) + list(state_db_tables))
 
         try:
             bot_db.load_db()
 
         except Exception:
             self.critical_error(
-                    "unable to load DB file {}:".format(self.conf.db_file))
+                    "unable to load DB file {}:".format(db_file))
+
+        return bot_db
+
+    def load_webtiles(self):
+        """Make a WebTiles manager for each configured server. All managers
+        share the DCSS manager, and servers with the same db_file share a DB.
+        A supervisor runs no managers, and a worker runs the managers placed
+        on it."""
+
+        self.bot_dbs = {}
+        self.webtiles_managers = []
+        servers = shard.get_shard_confs(self.conf.webtiles_servers)
+        if self.worker:
+            servers = [s for s in servers
+                       if s.get("name", "WebTiles") in self.worker["services"]]
+        elif self.conf.get("workers"):
+            servers = []
+
+        for wtconf in servers:
+            db_file = wtconf.get("db_file", self.conf.db_file)
+            if db_file not in self.bot_dbs:
+                self.bot_dbs[db_file] = self.load_db(db_file)
+                # Other processes keep their own copy of the DB in memory.
+                if self.worker:
+                    self.bot_dbs[db_file].change_listener = functools.partial(
+                        self.dcss_manager.send_db_row, db_file)
+            bot_db = self.bot_dbs[db_file]
+
+            manager = WebTilesManager(wtconf, bot_db, self.dcss_manager,
+                                      self.timers, self.monitor)
+            if self.restart_state:
+                manager.restart_state = self.restart_state["managers"].get(
+                    manager.service)
+            self.webtiles_managers.append(manager)
+
+            if wtconf.get("watch_username"):
+                user_data = bot_db.get_user_data(wtconf["watch_username"])
+                if not user_data:
+                    user_data = bot_db.register_user(wtconf["watch_username"])
+                if not user_data["subscription"]:
+                    bot_db.set_user_field(wtconf["watch_username"],
+                                          "subscription", 1)
+
+        # The result cache is kept in the main DB.
+        if self.dcss_manager.result_cache:
+            if self.conf.db_file not in self.bot_dbs:
+                self.bot_dbs[self.conf.db_file] = self.load_db(
+                    self.conf.db_file)
+
+            try:
+                self.dcss_manager.result_cache.load(
+                    self.bot_dbs[self.conf.db_file])
+
+            except Exception:
+                self.critical_error("unable to load DCSS result cache:")
+
+    @asyncio.coroutine
+    def wait_db_written(self):
+        """Wait until every DB change made so far is committed, without
+        blocking the loop."""
+
+        for bot_db in self.bot_dbs.values():
+            yield from bot_db.wait_written()
+
+    def get_restart_state(self):
+        """Get the state to send to a new process replacing us."""
+
+        return {"pid"      : os.getpid(),
+                "version"  : version,
+                "managers" : {m.service : m.get_state()
+                              for m in self.webtiles_managers}}
 
-        wtconf = self.conf.webtiles
-        self.webtiles_manager = WebTilesManager(wtconf, bot_db,
-                                                self.dcss_manager)
+    def reload(self):
+        """Reload the config file, applying what changed if it's valid. A
+        supervisor also has its workers reload."""
 
-        if wtconf.get("watch_username"):
-            user_data = bot_db.get_user_data(wtconf["watch_username"])
-            if not user_data:
-                user_data = bot_db.register_user(wtconf["watch_username"])
-            if not user_data["subscription"]:
-                bot_db.set_user_field(wtconf["watch_username"], "subscription",
-                        1)
+        _log.info("Reload: Reloading config file %s", self.conf.path)
+        conf = BeemConfig(self.config_file)
+        try:
+            conf.load(True)
+
+        except Exception as e:
+            _log.error("Reload: Keeping the current config: %s", e)
+            return
+
+        if self.supervisor:
+            self.supervisor.reload()
+        task = ensure_future(self.apply_config(conf))
+        name_task(task, "config reload")
+
+    @asyncio.coroutine
+    def apply_config(self, conf):
+        """Apply the changes in a reloaded config to the DCSS and WebTiles
+        managers. Changes to settings only used at startup, including adding
+        or removing servers, are reported and take effect on restart. Since
+        self.conf stays the config we started with, these are reported on
+        each reload until then."""
+
+        need_restart = []
+        for field in sorted(set(self.conf.data) | set(conf.data)):
+            if (field not in ("dcss", "webtiles", "webtiles_defaults")
+                    and self.conf.get(field) != conf.get(field)):
+                need_restart.append(field)
+
+        need_restart.extend(self.dcss_manager.reload(conf.dcss))
+
+        old_names = {s.get("name", "WebTiles") for s
+                     in shard.get_shard_confs(self.conf.webtiles_servers)}
+        server_confs = {s.get("name", "WebTiles") : s for s
+                        in shard.get_shard_confs(conf.webtiles_servers)}
+        # Each worker only knows about its own managers.
+        if not self.worker:
+            for name in sorted(old_names ^ set(server_confs)):
+                need_restart.append("webtiles server {}".format(name))
+
+        for manager in self.webtiles_managers:
+            if manager.service not in server_confs:
+                continue
+
+            try:
+                fields = yield from manager.reload(
+                    server_confs[manager.service])
+
+            except Exception:
+                _log.exception("Reload: Error reloading %s config",
+                               manager.service)
+                continue
+
+            need_restart.extend("{}.{}".format(manager.service, f)
+                           for f in fields)
+
+        if need_restart:
+            _log.warning("Reload: Changes to these settings need a restart: "
+                         "%s", ", ".join(need_restart))
+        _log.info("Reload: Config reloaded")
+
+    def get_restart_sockets(self):
+        if not self.metrics_server or not self.metrics_server.server:
+            return []
+
+        return list(self.metrics_server.server.sockets[:1])
 
     def start(self):
         """Start the server, set up the event loop and signal handlers,
@@ -104,8 +305,17 @@ class BeemServer:
             self.loop.add_signal_handler(getattr(signal, signame),
                                            functools.partial(do_exit, signame))
 
+        def do_profile():
+            if not profiler.start_profile():
+                _log.warning("Not starting profile since one is running.")
+
+        self.loop.add_signal_handler(signal.SIGUSR1, do_profile)
+        self.loop.add_signal_handler(signal.SIGHUP, self.reload)
+
         print("Event loop running forever, press Ctrl+C to interrupt.")
         print("pid %s: send SIGINT or SIGTERM to exit." % os.getpid())
+        print("Send SIGUSR1 to write a profile.")
+        print("Send SIGHUP to reload the config.")
 
         try:
             self.loop.run_until_complete(self.process())
@@ -127,23 +337,64 @@ class BeemServer:
         if self.dcss_task and not self.dcss_task.done():
             self.dcss_task.cancel()
 
-        if self.webtiles_task and not self.webtiles_task.done():
-            self.webtiles_task.cancel()
+        for task in self.webtiles_tasks:
+            if not task.done():
+                task.cancel()
+
+        if self.supervisor:
+            if self.supervisor_task and not self.supervisor_task.done():
+                self.supervisor_task.cancel()
+            self.supervisor.stop()
+
+        # Don't exit with DB writes still queued.
+        for bot_db in self.bot_dbs.values():
+            bot_db.flush()
 
     @asyncio.coroutine
     def process(self):
         tasks = []
 
-        self.webtiles_task = ensure_future(self.webtiles_manager.start())
-        tasks.append(self.webtiles_task)
+        self.timers_task = ensure_future(self.timers.start())
+        name_task(self.timers_task, "timer wheel")
+        if self.metrics_server:
+            self.metrics_task = ensure_future(self.metrics_server.start())
+            name_task(self.metrics_task, "metrics server")
+        self.monitor_task = ensure_future(self.monitor.start())
+        if self.conf.get("restart_socket"):
+            restart_server = restart.RestartServer(self.conf.restart_socket,
+                                                   self)
+            self.restart_task = ensure_future(restart_server.start())
+            name_task(self.restart_task, "restart server")
+
+        for manager in self.webtiles_managers:
+            task = ensure_future(manager.start())
+            name_task(task, "{} manager".format(manager.service))
+            self.webtiles_tasks.append(task)
+            tasks.append(task)
 
         self.dcss_task = ensure_future(self.dcss_manager.start())
+        name_task(self.dcss_task, "DCSS manager")
         tasks.append(self.dcss_task)
 
+        if self.supervisor:
+            self.supervisor_task = ensure_future(self.supervisor.start())
+            name_task(self.supervisor_task, "supervisor")
+            tasks.append(self.supervisor_task)
+
         yield from asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
 
         self.dcss_manager.disconnect()
-        yield from self.webtiles_manager.disconnect()
+        for manager in self.webtiles_managers:
+            yield from manager.disconnect()
+        self.timers_task.cancel()
+        self.monitor_task.cancel()
+        if self.metrics_task:
+            self.metrics_task.cancel()
+        if self.restart_task:
+            self.restart_task.cancel()
+        tracing.stop_tracing()
+        for bot_db in self.bot_dbs.values():
+            bot_db.close()
 
 
 def main():
@@ -153,7 +404,9 @@ def main():
                         default=_DEFAULT_BEEM_CONFIG_FILE,
                         help="The beem config file to use.")
     parser.add_argument("--version", action="version", version=version)
+    parser.add_argument("--worker", dest="worker", type=json.loads,
+                        help=argparse.SUPPRESS)
     args = parser.parse_args()
 
-    server = BeemServer(args.config_file)
+    server = BeemServer(args.config_file, args.worker)
     server.start()
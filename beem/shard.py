@@ -0,0 +1,445 @@
+"""Running WebTiles managers in worker processes.
+
+With 'workers' set in the config, the beem process becomes a supervisor that
+owns the IRC connection to the DCSS bots and starts that many worker
+processes, each running the WebTiles managers of some servers. A server with
+'shards' set is split into that many managers, each watching the games of
+the players whose names hash to its shard, so that one busy server can use
+several workers. Each shard's manager has its own lobby connection and
+reads the whole lobby, keeping only its own players, so there's no single
+process that owns the lobby.
+
+Placement is static and doesn't follow the actual load. A player's shard is
+fixed by the hash of their name, and managers are placed on workers once, at
+startup, by their configured watch slots. Each worker serves its own metrics,
+which show how busy it is.
+
+Workers send DCSS queries to the supervisor, which sends them to the bots and
+sends the results back to the worker that asked. Workers also tell the
+supervisor about changes they make to DB rows, which it passes on to the
+other workers so their in-memory copies of the DB stay current. Messages are
+JSON lines over a unix socket pair."""
+
+import asyncio
+if hasattr(asyncio, "async"):
+    ensure_future = asyncio.async
+else:
+    ensure_future = asyncio.ensure_future
+
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+
+from .dcss import DCSSManager
+
+_log = logging.getLogger()
+
+# How long to wait in seconds before restarting a worker that exited.
+_RESTART_WAIT = 5
+# How often in seconds the supervisor tells workers whether the DCSS bots are
+# ready.
+_READY_INTERVAL = 1
+
+
+def get_shard_confs(servers):
+    """Get the manager configs for the given WebTiles server configs, with any
+    server having 'shards' split into a config for each shard. Shards split the
+    server's subscriber and autowatch slots, and its accounts if there are
+    enough to give each shard its own."""
+
+    confs = []
+    for server in servers:
+        num_shards = server.get("shards", 1)
+        if num_shards <= 1:
+            confs.append(server)
+            continue
+
+        accounts = list(server.get("accounts", []))
+        if server.get("username"):
+            accounts.insert(0, {"username" : server["username"],
+                                "password" : server["password"]})
+        for i in range(num_shards):
+            conf = dict(server)
+            conf["name"] = "{}#{}".format(server.get("name", "WebTiles"),
+                                          i + 1)
+            conf["shard"] = [i, num_shards]
+            conf["max_watched_subscribers"] = max(
+                1, server["max_watched_subscribers"] // num_shards)
+            # Split the autowatch slots too, with any left over going to the
+            # first shards, so the server autowatches as many games as it
+            # would unsharded.
+            slots = server.get("autowatch_slots", 1)
+            conf["autowatch_slots"] = (slots // num_shards
+                                       + (1 if i < slots % num_shards else 0))
+            if not conf["autowatch_slots"]:
+                conf["autowatch_enabled"] = False
+            if len(accounts) >= num_shards:
+                conf.pop("username", None)
+                conf.pop("password", None)
+                conf["accounts"] = accounts[i::num_shards]
+            confs.append(conf)
+
+    return confs
+
+
+def get_worker_metrics_conf(conf, index):
+    """Get the metrics config of a worker. Each worker serves the metrics of
+    its own managers, on the port that's its index after the supervisor's, or
+    on the supervisor's unix socket path with its index appended."""
+
+    conf = dict(conf)
+    if conf.get("unix_socket"):
+        conf["unix_socket"] = "{}.{}".format(conf["unix_socket"], index)
+    else:
+        conf["port"] = conf["port"] + index
+    return conf
+
+
+def get_conf_load(conf):
+    """Estimate the load of a manager from its watch slots."""
+
+    load = conf["max_watched_subscribers"]
+    if conf.get("autowatch_enabled"):
+        load += conf.get("autowatch_slots", 1)
+    return load
+
+
+def place_confs(confs, num_workers):
+    """Place manager configs on workers, each on the worker with the least
+    load so far, largest first. Returns a list of the names of the managers
+    for each worker."""
+
+    loads = [0] * num_workers
+    placement = [[] for i in range(num_workers)]
+    for conf in sorted(confs, key=get_conf_load, reverse=True):
+        worker = loads.index(min(loads))
+        placement[worker].append(conf.get("name", "WebTiles"))
+        loads[worker] += get_conf_load(conf)
+    return placement
+
+
+class Channel():
+    """Sends and receives JSON messages over a stream."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, message):
+        self.writer.write(json.dumps(message).encode("utf-8") + b"\n")
+
+    @asyncio.coroutine
+    def drain(self):
+        yield from self.writer.drain()
+
+    @asyncio.coroutine
+    def read(self):
+        """Read the next message, returning None if the stream closed."""
+
+        line = yield from self.reader.readline()
+        if not line:
+            return
+
+        return json.loads(line.decode("utf-8"))
+
+    def close(self):
+        self.writer.close()
+
+
+class RemoteDCSS(DCSSManager):
+    """Used by a worker in place of a DCSS manager. DCSS messages in chat are
+    recognized as usual, but queries are sent to the supervisor, which sends
+    back their results."""
+
+    def __init__(self, conf, fd, beem_server):
+        # Any result cache is in the supervisor.
+        super().__init__(conf, result_cache=False)
+        self.fd = fd
+        self.beem_server = beem_server
+        self.channel = None
+        self.bots_ready = False
+
+    def ready(self):
+        return self.channel is not None and self.bots_ready
+
+    def disconnect(self):
+        if self.channel:
+            self.channel.close()
+            self.channel = None
+
+    def send_db_row(self, db_file, table, row):
+        if self.channel:
+            self.channel.send({"type"    : "db_row",
+                               "db_file" : db_file,
+                               "table"   : table,
+                               "row"     : row})
+
+    @asyncio.coroutine
+    def read_message(self, source, username, message, trace=None):
+        """Send a query to the supervisor."""
+
+        if not self.channel:
+            if trace:
+                trace.finish("error")
+            raise Exception("Not connected to supervisor")
+
+        chat_nicks = source.get_chat_dcss_nicks(username)
+        self.channel.send({"type"       : "query",
+                           "source"     : source.get_source_ident(),
+                           "user"       : source.user,
+                           "username"   : username,
+                           "message"    : message,
+                           "chat_nicks" : (sorted(chat_nicks)
+                                           if chat_nicks is not None
+                                           else None)})
+        yield from self.channel.drain()
+        # The rest of the query is handled by the supervisor.
+        if trace:
+            trace.finish("forwarded")
+
+    def handle_message(self, message):
+        if message["type"] == "ready":
+            self.bots_ready = message["ready"]
+
+        elif message["type"] == "chat":
+            ident = message["source"]
+            manager = self.managers.get(ident["service"])
+            source = manager.get_source_by_ident(ident) if manager else None
+            if not source:
+                _log.warning("Worker: Ignoring result for unknown source: %s",
+                             message["message"])
+                return
+
+            ensure_future(self.send_result(source, message["message"],
+                                           message["message_type"]))
+
+        elif message["type"] == "db_row":
+            bot_db = self.beem_server.bot_dbs.get(message["db_file"])
+            if bot_db:
+                bot_db.apply_row(message["table"], message["row"])
+
+    @asyncio.coroutine
+    def start(self):
+        """Handle messages from the supervisor, stopping the worker if the
+        supervisor goes away."""
+
+        sock = socket.fromfd(self.fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(self.fd)
+        reader, writer = yield from asyncio.open_unix_connection(sock=sock)
+        self.channel = Channel(reader, writer)
+        while True:
+            message = yield from self.channel.read()
+            if message is None:
+                _log.error("Worker: Lost connection to supervisor")
+                self.channel = None
+                self.beem_server.stop(True)
+                return
+
+            try:
+                self.handle_message(message)
+
+            except Exception:
+                self.log_exception("Error handling supervisor message: "
+                                   "{}".format(message))
+
+
+class RemoteSource():
+    """Stands in for a game connection in a worker as the source of a DCSS
+    query, sending results to the worker."""
+
+    def __init__(self, worker, ident, user=None, chat_nicks=None):
+        self.worker = worker
+        self.ident = ident
+        self.user = user
+        self.chat_nicks = chat_nicks
+
+    def get_source_ident(self):
+        return self.ident
+
+    def get_dcss_nick(self, user):
+        return user
+
+    def get_chat_dcss_nicks(self, sender):
+        if self.chat_nicks is None:
+            return
+
+        return set(self.chat_nicks)
+
+    def describe(self):
+        return "{} game of {} on worker {}".format(self.ident["service"],
+                                                   self.ident["player"],
+                                                   self.worker.index)
+
+    @asyncio.coroutine
+    def send_chat(self, message, message_type="normal"):
+        self.worker.send({"type"         : "chat",
+                          "source"       : self.ident,
+                          "message"      : message,
+                          "message_type" : message_type})
+        yield from self.worker.drain()
+
+
+class RemoteManager():
+    """Registered with the supervisor's DCSS manager for each manager a worker
+    runs, so query results go to that worker."""
+
+    def __init__(self, worker, service):
+        self.worker = worker
+        self.service = service
+
+    def get_source_by_ident(self, ident):
+        return RemoteSource(self.worker, ident)
+
+
+class Worker():
+    """A worker process run by the supervisor. The process is restarted if it
+    exits."""
+
+    def __init__(self, supervisor, index, services):
+        self.supervisor = supervisor
+        self.index = index
+        self.services = services
+        self.process = None
+        self.channel = None
+
+    def send(self, message):
+        if self.channel:
+            self.channel.send(message)
+
+    @asyncio.coroutine
+    def drain(self):
+        if self.channel:
+            yield from self.channel.drain()
+
+    @asyncio.coroutine
+    def run(self):
+        """Start the worker process and handle its messages until it
+        exits."""
+
+        parent_sock, child_sock = socket.socketpair()
+        worker_arg = json.dumps({"index"    : self.index,
+                                 "fd"       : child_sock.fileno(),
+                                 "services" : self.services})
+        self.process = yield from asyncio.create_subprocess_exec(
+            sys.executable, "-c", "from beem.server import main; main()",
+            "-c", self.supervisor.config_file, "--worker", worker_arg,
+            pass_fds=[child_sock.fileno()])
+        child_sock.close()
+        _log.info("Supervisor: Started worker %s (pid %s) for %s", self.index,
+                  self.process.pid, ", ".join(self.services))
+
+        reader, writer = yield from asyncio.open_unix_connection(
+            sock=parent_sock)
+        self.channel = Channel(reader, writer)
+        try:
+            while True:
+                message = yield from self.channel.read()
+                if message is None:
+                    break
+
+                try:
+                    self.supervisor.handle_message(self, message)
+
+                except Exception:
+                    _log.exception("Supervisor: Error handling message from "
+                                   "worker %s: %s", self.index, message)
+
+        finally:
+            self.channel.close()
+            self.channel = None
+
+        status = yield from self.process.wait()
+        _log.error("Supervisor: Worker %s exited with status %s", self.index,
+                   status)
+
+    @asyncio.coroutine
+    def start(self):
+        try:
+            while True:
+                try:
+                    yield from self.run()
+
+                except asyncio.CancelledError:
+                    raise
+
+                except Exception:
+                    _log.exception("Supervisor: Error running worker %s",
+                                   self.index)
+
+                yield from asyncio.sleep(_RESTART_WAIT)
+
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+
+    def reload(self):
+        if self.process and self.process.returncode is None:
+            self.process.send_signal(signal.SIGHUP)
+
+
+class Supervisor():
+    """Starts the worker processes and handles their DCSS queries and DB
+    changes."""
+
+    def __init__(self, config_file, conf, dcss_manager, bot_dbs):
+        self.config_file = config_file
+        self.dcss_manager = dcss_manager
+        self.bot_dbs = bot_dbs
+        confs = get_shard_confs(conf.webtiles_servers)
+        placement = place_confs(confs, conf.workers)
+        self.workers = []
+        for i, services in enumerate(placement):
+            if not services:
+                continue
+
+            worker = Worker(self, i + 1, services)
+            self.workers.append(worker)
+            for service in services:
+                dcss_manager.managers[service] = RemoteManager(worker, service)
+
+    def handle_message(self, worker, message):
+        if message["type"] == "query":
+            source = RemoteSource(worker, message["source"], message["user"],
+                                  message["chat_nicks"])
+            ensure_future(self.dcss_manager.read_message(
+                source, message["username"], message["message"]))
+
+        elif message["type"] == "db_row":
+            bot_db = self.bot_dbs.get(message["db_file"])
+            if bot_db:
+                bot_db.apply_row(message["table"], message["row"])
+            for w in self.workers:
+                if w is not worker:
+                    w.send(message)
+
+    @asyncio.coroutine
+    def start(self):
+        tasks = [ensure_future(w.start()) for w in self.workers]
+        try:
+            while True:
+                ready = self.dcss_manager.ready()
+                for worker in self.workers:
+                    worker.send({"type" : "ready", "ready" : ready})
+
+                yield from asyncio.sleep(_READY_INTERVAL)
+
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.stop()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def reload(self):
+        """Have the workers reload the config."""
+
+        for worker in self.workers:
+            worker.reload()
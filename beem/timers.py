@@ -0,0 +1,102 @@
+"""A timer wheel for scheduling many delayed calls with a single task."""
+
+import asyncio
+import logging
+import sys
+import time
+import traceback
+
+_log = logging.getLogger()
+
+# The resolution of the timer wheel in seconds, and the number of slots in the
+# wheel. Timers due further in the future than one full turn of the wheel wait
+# in their slot for the needed number of turns.
+_TICK_LENGTH = 0.5
+_NUM_SLOTS = 512
+
+class Timer():
+    """A call scheduled on a TimerWheel. Use cancel() to prevent the call."""
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel():
+    """A hashed timer wheel. Timers are kept in a ring of slots, each slot
+    holding the timers due in ticks that map to it. Scheduling and cancelling
+    a timer are constant time, and a single task advances the wheel, calling
+    the timers that are due. Callbacks are plain functions run on the event
+    loop thread, and should schedule any coroutines they need to run."""
+
+    def __init__(self, tick_length=_TICK_LENGTH, num_slots=_NUM_SLOTS):
+        self.tick_length = tick_length
+        self.slots = [[] for i in range(num_slots)]
+        self.time_start = time.monotonic()
+        # The last tick we've processed.
+        self.current_tick = 0
+
+    def get_tick(self, when):
+        return int((when - self.time_start) / self.tick_length)
+
+    def schedule(self, delay, callback, *args):
+        """Schedule callback(*args) to be called after `delay` seconds, and
+        return a Timer object for the call."""
+
+        # Round up so that timers never fire early, and always put them at
+        # least one tick past the current one.
+        tick = self.get_tick(time.monotonic() + delay) + 1
+        tick = max(tick, self.current_tick + 1)
+        timer = Timer(tick, callback, args)
+        self.slots[tick % len(self.slots)].append(timer)
+        return timer
+
+    def run_due(self):
+        """Call every timer that's due, advancing the wheel to the current
+        time."""
+
+        now_tick = self.get_tick(time.monotonic())
+        while self.current_tick < now_tick:
+            self.current_tick += 1
+            slot = self.slots[self.current_tick % len(self.slots)]
+            if not slot:
+                continue
+
+            count = len(slot)
+            waiting = []
+            for timer in slot[:count]:
+                if timer.cancelled:
+                    continue
+
+                if timer.tick > self.current_tick:
+                    waiting.append(timer)
+                    continue
+
+                try:
+                    timer.callback(*timer.args)
+
+                except Exception:
+                    exc_type, exc_value, exc_tb = sys.exc_info()
+                    _log.error("Timer: Error calling %s:", timer.callback)
+                    _log.error("".join(traceback.format_exception(
+                        exc_type, exc_value, exc_tb)))
+
+            # Callbacks can schedule new timers into this slot, so keep those
+            # too.
+            slot[:] = waiting + slot[count:]
+
+    def __len__(self):
+        return sum(len(s) for s in self.slots)
+
+    @asyncio.coroutine
+    def start(self):
+        """Advance the wheel until cancelled."""
+
+        while True:
+            self.run_due()
+            yield from asyncio.sleep(self.tick_length)
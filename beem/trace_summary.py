@@ -0,0 +1,105 @@
+"""Summarize the stage latencies in beem trace files."""
+
+import argparse
+import json
+import math
+import os.path
+
+_PERCENTILES = [50, 90, 99]
+
+
+def get_percentile(values, percent):
+    """Return the nearest-rank percentile of a sorted list of values."""
+
+    if not values:
+        return 0
+
+    rank = max(1, int(math.ceil(percent / 100 * len(values))))
+    return values[rank - 1]
+
+
+def read_traces(paths):
+    """Read traces from the given files. A file's rotated backups are read
+    too, oldest first."""
+
+    for path in paths:
+        backups = []
+        i = 1
+        while os.path.exists("{}.{}".format(path, i)):
+            backups.append("{}.{}".format(path, i))
+            i += 1
+
+        for p in list(reversed(backups)) + [path]:
+            with open(p) as fh:
+                for line in fh:
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    try:
+                        yield json.loads(line)
+
+                    except ValueError:
+                        continue
+
+
+def format_row(name, durations):
+    durations.sort()
+    cols = ["{:<24}".format(name), "{:>7}".format(len(durations))]
+    for p in _PERCENTILES:
+        cols.append("{:>9.3f}".format(get_percentile(durations, p)))
+    cols.append("{:>9.3f}".format(durations[-1] if durations else 0))
+    return " ".join(cols)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("trace_files", nargs="+", metavar="<trace-file>",
+                        help="Trace files written by beem.")
+    parser.add_argument("-s", dest="service", metavar="<service>",
+                        help="Only include traces from this service.")
+    parser.add_argument("-m", dest="prefix", metavar="<prefix>",
+                        help="Only include traces of messages starting with "
+                        "this prefix, such as '!lg'.")
+    args = parser.parse_args()
+
+    stages = {}
+    totals = {}
+    statuses = {}
+    for trace in read_traces(args.trace_files):
+        if args.service and trace.get("service") != args.service:
+            continue
+
+        if args.prefix and not trace.get("message", "").startswith(
+                args.prefix):
+            continue
+
+        status = trace.get("status", "ok")
+        statuses[status] = statuses.get(status, 0) + 1
+        totals.setdefault(status, []).append(trace["duration"])
+        for span in trace.get("spans", []):
+            name = span["name"]
+            if span.get("bot"):
+                name += " ({})".format(span["bot"])
+            stages.setdefault(name, []).append(span["duration"])
+
+    num_traces = sum(statuses.values())
+    print("{} traces: {}".format(num_traces, ", ".join(
+        "{} {}".format(count, status)
+        for status, count in sorted(statuses.items()))))
+    if not num_traces:
+        return
+
+    header = ["{:<24}".format("stage"), "{:>7}".format("count")]
+    header.extend("{:>9}".format("p{}".format(p)) for p in _PERCENTILES)
+    header.append("{:>9}".format("max"))
+    print()
+    print(" ".join(header))
+    for name in sorted(stages):
+        print(format_row(name, stages[name]))
+    for status in sorted(totals):
+        print(format_row("total ({})".format(status), totals[status]))
+
+
+if __name__ == "__main__":
+    main()
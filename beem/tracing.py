@@ -0,0 +1,165 @@
+"""Tracing of chat commands through each stage of their handling.
+
+A trace starts when a chat message is read, and records a span for each stage
+the message passes through: parsing, the rate limit check, sending a query to
+a DCSS bot, waiting for the bot's response, Sequell relays to other bots, and
+sending the result to chat. Finished traces are written as JSON lines to a
+rotating file that can be read by `beem-trace-summary`."""
+
+import json
+import logging
+from logging.handlers import RotatingFileHandler
+import random
+import time
+
+_log = logging.getLogger()
+
+_MAX_BYTES = 10000000
+_BACKUP_COUNT = 5
+
+# The tracer set up by init_tracing(). Tracing is off when this is None.
+tracer = None
+
+
+class Span():
+    """A context manager that records the time taken by a stage of a trace."""
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        attrs = self.attrs
+        if exc_type:
+            attrs = dict(attrs, error=exc_type.__name__)
+        self.trace.add_span(self.name, self.start, time.time(), **attrs)
+
+
+class NullSpan():
+    """Used in place of a Span for untraced messages."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+_null_span = NullSpan()
+
+
+class Trace():
+    """The spans recorded for one chat message. A trace is written once it's
+    finished, and ignores any spans added after that."""
+
+    def __init__(self, trace_tracer, service, source, requester, message):
+        self.tracer = trace_tracer
+        self.trace_id = "{:016x}".format(random.getrandbits(64))
+        self.time_start = time.time()
+        self.service = service
+        self.source = source
+        self.requester = requester
+        self.message = message
+        self.spans = []
+        self.finished = False
+
+    def add_span(self, name, start, end, **attrs):
+        if self.finished:
+            return
+
+        span = {"name" : name,
+                "start" : round(start - self.time_start, 6),
+                "duration" : round(end - start, 6)}
+        span.update(attrs)
+        self.spans.append(span)
+
+    def finish(self, status="ok"):
+        if self.finished:
+            return
+
+        self.finished = True
+        self.tracer.write({"trace_id" : self.trace_id,
+                           "time" : self.time_start,
+                           "service" : self.service,
+                           "source" : self.source,
+                           "requester" : self.requester,
+                           "message" : self.message,
+                           "status" : status,
+                           "duration" : round(time.time() - self.time_start,
+                                              6),
+                           "spans" : self.spans})
+
+
+class Tracer():
+    """Samples chat messages to trace and writes finished traces to a rotating
+    file."""
+
+    def __init__(self, conf):
+        self.conf = conf
+        self.sample_rate = conf.get("sample_rate", 1)
+        handler = RotatingFileHandler(conf["filename"],
+                                      maxBytes=conf.get("max_bytes",
+                                                        _MAX_BYTES),
+                                      backupCount=conf.get("backup_count",
+                                                           _BACKUP_COUNT))
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.logger = logging.getLogger("beem.trace")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(handler)
+        self.handler = handler
+
+    def start_trace(self, service, source, requester, message):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        return Trace(self, service, source, requester, message)
+
+    def write(self, record):
+        try:
+            self.logger.info(json.dumps(record))
+
+        except Exception:
+            _log.exception("Trace: Unable to write trace %s",
+                           record["trace_id"])
+
+    def close(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+
+def init_tracing(conf):
+    """Start tracing with the given tracing config table."""
+
+    global tracer
+    tracer = Tracer(conf)
+    _log.info("Trace: Writing traces to %s (sample rate %s)", conf["filename"],
+              tracer.sample_rate)
+
+def stop_tracing():
+    global tracer
+    if tracer:
+        tracer.close()
+        tracer = None
+
+def start_trace(service, source, requester, message):
+    """Start a trace for a chat message, returning None if tracing is off or
+    the message isn't sampled."""
+
+    if not tracer:
+        return
+
+    return tracer.start_trace(service, source, requester, message)
+
+def span(trace, name, **attrs):
+    """Return a context manager recording a span in the trace, or doing
+    nothing if the trace is None."""
+
+    if not trace:
+        return _null_span
+
+    return Span(trace, name, attrs)
@@ -6,30 +6,194 @@ if hasattr(asyncio, "async"):
 else:
     ensure_future = asyncio.ensure_future
 
+import heapq
+import json
 import logging
 import os
+import random
 import re
-import signal
 import sys
 import time
 import traceback
 import webtiles
+import zlib
 from websockets.exceptions import ConnectionClosed
 
 from .chat import ChatWatcher, BotCommandException, bot_help_command
 from .chat import pluralize_name
+from . import metrics
+from .ingest import FrameRecorder, IngestStats, decode_frame, get_json_loads
+from .ingest import inflate_frame, inflate_thread_min_bytes, make_inflater
+from .ingest import render_message_types
+from .monitor import name_task
+from .profiler import start_profile
 from .version import version as Version
 
 _log = logging.getLogger()
 
-# How long to wait in seconds before reattempting a WebSocket connection.
+# How long to wait in seconds before reattempting a WebSocket connection. This
+# wait doubles with each consecutive failure up to the maximum wait.
 _retry_connection_wait = 5
+_max_retry_connection_wait = 300
+# How many game connections can be connecting or logging in at once.
+_max_pending_connections = 5
 # How many seconds to wait after sending a login or watch request before we
 # timeout.
 _request_timeout = 10
 # How many seconds to wait after a game ends before attempting to watch the
 # game again.
 _rewatch_wait = 5
+# How often in seconds to ping the server on each connection.
+_ping_interval = 60
+# Chat activity in a game decays with this half-life in seconds. Bot and DCSS
+# commands count for more activity than other chat.
+_activity_half_life = 600
+_chat_activity = 1
+_command_activity = 3
+# Weights used to score how useful it is to watch a game. A subscriber waiting
+# for a slot gains score the longer it waits, up to a maximum.
+_spectator_weight = 1
+_idle_weight = 5
+_queue_wait_weight = 0.1
+_max_queue_wait_score = 5
+# Defaults for watch slot eviction. A game must be watched for
+# 'min_watch_time' seconds before it can be evicted, a waiting game's score
+# must exceed the evicted game's score by 'eviction_margin', and evictions
+# happen at most once every 'eviction_interval' seconds.
+_min_watch_time = 300
+_eviction_margin = 2
+_eviction_interval = 30
+# Defaults for adaptive capacity. Every 'capacity_interval' seconds, capacity
+# shrinks when the average event loop lag is above 'max_loop_lag' seconds, and
+# grows when lag is below half of that.
+_capacity_interval = 30
+_max_loop_lag = 0.1
+# How often in seconds to log a summary of received game messages.
+_ingest_report_interval = 600
+# Defaults for saving the watch queue and watched games to the DB, so they can
+# be restored on restart. The state is saved every 'state_save_interval'
+# seconds and at shutdown, and is only restored if it's at most
+# 'state_max_age' seconds old. Restored games are watched without waiting for
+# the lobby until the lobby is complete or 'restore_timeout' seconds pass.
+_state_save_interval = 60
+_state_max_age = 600
+_restore_timeout = 30
+# How many chat messages a game connection can have waiting to be handled, and
+# what to do when a message arrives and the queue is full.
+_work_queue_size = 50
+_work_queue_policy = "block"
+work_queue_policies = ["block", "drop_newest", "drop_oldest"]
+# Settings that are only used when the manager starts. A config reload reports
+# changes to these, which keep their current values until restart. Other
+# settings are read from the config as they're needed, so they're applied by
+# a reload right away.
+_restart_fields = ["name", "server_url", "protocol_version", "username",
+                   "password", "accounts", "watch_player", "json_decoder",
+                   "record_frames_file", "db_file", "shards", "shard"]
+
+class ConnectionThrottle():
+    """Admission control for new game connections. This limits how many
+    connections can be in the process of connecting and logging in at once,
+    and tracks an exponential backoff with jitter after failures, both for the
+    server as a whole and for each individual game."""
+
+    def __init__(self, conf, service):
+        self.conf = conf
+        self.service = service
+        # Connections we've admitted that haven't started watching, mapped to
+        # the game key they were admitted for.
+        self.pending = {}
+        # Backoff entries, each a dict holding the count of consecutive
+        # failures and the time at which we can retry.
+        self.server_backoff = None
+        self.game_backoff = {}
+
+    def get_retry_wait(self, failures):
+        """Get a randomized wait time to use after the given number of
+        consecutive failures. We use the upper half of the exponential wait so
+        that retries stay spread out without retrying too early."""
+
+        base = self.conf.get("retry_connection_wait", _retry_connection_wait)
+        max_wait = self.conf.get("max_retry_connection_wait",
+                                 _max_retry_connection_wait)
+        wait = min(max_wait, base * 2 ** (failures - 1))
+        return random.uniform(wait / 2, wait)
+
+    def make_backoff(self, entry):
+        failures = entry["failures"] + 1 if entry else 1
+        wait = self.get_retry_wait(failures)
+        return {"failures" : failures,
+                "time_retry" : time.time() + wait}
+
+    def server_ready(self):
+        """Is the server out of any backoff period?"""
+
+        return (not self.server_backoff
+                or time.time() >= self.server_backoff["time_retry"])
+
+    def game_ready(self, key):
+        """Can we admit a new connection to the game with the given key?"""
+
+        limit = self.conf.get("max_pending_connections",
+                              _max_pending_connections)
+        if len(self.pending) >= limit or not self.server_ready():
+            return False
+
+        backoff = self.game_backoff.get(key)
+        return not backoff or time.time() >= backoff["time_retry"]
+
+    def admit(self, conn, key):
+        self.pending[conn] = key
+
+    def release(self, conn):
+        self.pending.pop(conn, None)
+
+    def server_failed(self):
+        self.server_backoff = self.make_backoff(self.server_backoff)
+        _log.warning("%s: Server connection failure %s, waiting %.1f "
+                     "seconds before reconnecting", self.service,
+                     self.server_backoff["failures"],
+                     self.server_backoff["time_retry"] - time.time())
+
+    def server_succeeded(self):
+        self.server_backoff = None
+
+    def game_failed(self, key):
+        backoff = self.make_backoff(self.game_backoff.get(key))
+        self.game_backoff[key] = backoff
+        _log.info("%s: Game connection failure %s for user %s, waiting "
+                  "%.1f seconds before retrying", self.service,
+                  backoff["failures"], key[0],
+                  backoff["time_retry"] - time.time())
+
+    def game_succeeded(self, key):
+        self.game_backoff.pop(key, None)
+
+    def connection_failed(self, conn):
+        """Record the failure of an admitted connection that never started
+        watching. If it never logged in, we treat this as a rejection by the
+        server, otherwise only the game is affected."""
+
+        key = self.pending.pop(conn, None)
+        if not key:
+            return
+
+        if conn.logged_in:
+            self.game_failed(key)
+        else:
+            self.server_failed()
+
+    def expire_backoff(self):
+        """Remove game backoff entries whose retry time passed more than the
+        maximum wait ago, so the dict doesn't grow without bound."""
+
+        current_time = time.time()
+        max_wait = self.conf.get("max_retry_connection_wait",
+                                 _max_retry_connection_wait)
+        for key, backoff in list(self.game_backoff.items()):
+            if current_time - backoff["time_retry"] >= max_wait:
+                del self.game_backoff[key]
+
 
 class ConnectionHandler():
     """This class provides some basic support to continuous read/respond tasks.
@@ -42,50 +206,205 @@ class ConnectionHandler():
         self.manager = manager
         self.task = None
         self.ping_task = None
+        # Timers on the manager's timer wheel for our next ping and for the
+        # deadline of any login or watch request we've made.
+        self.ping_timer = None
+        self.request_timer = None
+
+        # Message types we drop without handling, and our decompressor for
+        # the connection's deflate stream.
+        self.ingest_filter = None
+        self.inflater = None
+        self.ingest_stats = IngestStats()
+        self.record_num = None
+
+        # Work we handle in a separate task so that slow work doesn't stop us
+        # from reading the WebSocket.
+        self.work_queue = None
+        self.work_task = None
+        self.work_dropped = 0
+
+    def get_task_name(self, desc=None):
+        return "{} {}{}".format(self.manager.service, self.describe(),
+                                " " + desc if desc else "")
+
+    def start_task(self):
+        """Start the task that runs this connection, named for the loop
+        monitor."""
+
+        self.task = ensure_future(self.start())
+        name_task(self.task, self.get_task_name())
+
+    def schedule_ping(self):
+        self.ping_timer = self.manager.timers.schedule(_ping_interval,
+                                                       self.handle_ping_timer)
+
+    def handle_ping_timer(self):
+        self.ping_timer = None
+        self.ping_task = ensure_future(self.send_ping())
+        name_task(self.ping_task, self.get_task_name("ping"))
 
     @asyncio.coroutine
-    def start_ping(self):
+    def send_ping(self):
+        if not self.connected():
+            return
+
+        try:
+            yield from self.websocket.ping()
+
+        except asyncio.CancelledError:
+            return
+
+        except Exception:
+            self.log_exception("unable to send ping")
+            ensure_future(self.manager.stop_connection(self))
+            return
+
+        self.schedule_ping()
+
+    def set_request_timer(self):
+        """Start the deadline for a login or watch request, replacing any
+        current deadline."""
+
+        self.cancel_request_timer()
+        self.request_timer = self.manager.timers.schedule(
+            _request_timeout, self.handle_request_timeout)
+
+    def cancel_request_timer(self):
+        if self.request_timer:
+            self.request_timer.cancel()
+            self.request_timer = None
+
+    def handle_request_timeout(self):
+        self.request_timer = None
+        _log.warning("%s: Request timed out for %s", self.manager.service,
+                     self.describe())
+        ensure_future(self.manager.stop_connection(self))
+
+    def cancel_timers(self):
+        self.cancel_request_timer()
+        if self.ping_timer:
+            self.ping_timer.cancel()
+            self.ping_timer = None
+
+    @asyncio.coroutine
+    def handle_pre_read(self):
+        pass
+
+    def handle_connected(self):
+        pass
+
+    @asyncio.coroutine
+    def queue_work(self, coroutine_func, *args):
+        """Queue a call of the given coroutine function to be run by our work
+        task. Queued work is run in order. If the queue is full, either wait
+        for space, drop this work, or drop the oldest work, depending on the
+        configured policy."""
+
+        if not self.work_queue:
+            self.work_queue = asyncio.Queue(
+                maxsize=self.manager.conf.get("work_queue_size",
+                                              _work_queue_size))
+            self.work_task = ensure_future(self.process_work())
+            name_task(self.work_task, self.get_task_name("work"))
+
+        policy = self.manager.conf.get("work_queue_policy", _work_queue_policy)
+        if self.work_queue.full() and policy != "block":
+            self.work_dropped += 1
+            _log.warning("%s: In %s, work queue full, dropping %s work",
+                         self.manager.service, self.describe(),
+                         "oldest" if policy == "drop_oldest" else "newest")
+            if policy == "drop_newest":
+                return
+
+            self.work_queue.get_nowait()
+
+        yield from self.work_queue.put((coroutine_func, args))
+
+    @asyncio.coroutine
+    def process_work(self):
+        """Run queued work until cancelled."""
+
         while True:
-            if not self.connected():
+            try:
+                coroutine_func, args = yield from self.work_queue.get()
+
+            except asyncio.CancelledError:
                 return
 
+            start = time.perf_counter()
             try:
-                yield from self.websocket.ping()
+                yield from coroutine_func(*args)
 
             except asyncio.CancelledError:
                 return
 
             except Exception:
-                self.log_exception("unable to send ping")
-                yield from self.manager.stop_connection(self)
-                return
+                self.log_exception("unable to handle queued work")
 
-            yield from asyncio.sleep(60)
+            # Queued work is the handling of chat messages.
+            self.ingest_stats.record_handling("chat",
+                                              time.perf_counter() - start)
 
     @asyncio.coroutine
-    def handle_pre_read(self):
-        pass
+    def read_messages(self):
+        """Read a list of messages from the WebSocket. We decode frames
+        ourselves instead of using the webtiles package so we can use a faster
+        JSON decoder and drop unwanted messages cheaply. Large frames are
+        inflated on a worker thread, since zlib releases the GIL while it
+        works."""
+
+        data = yield from self.websocket.recv()
+        self.ingest_stats.record_received(len(data))
+
+        recorder = self.manager.frame_recorder
+        if recorder:
+            if not self.record_num:
+                self.record_num = recorder.new_connection()
+            recorder.record(self.record_num, data)
+
+        if isinstance(data, bytes):
+            if len(data) >= inflate_thread_min_bytes:
+                loop = asyncio.get_event_loop()
+                data = yield from loop.run_in_executor(None, inflate_frame,
+                                                       self.inflater, data)
+            else:
+                data = inflate_frame(self.inflater, data)
+
+        return decode_frame(data, self.ingest_filter, self.ingest_stats,
+                            self.manager.json_loads)
+
+    @asyncio.coroutine
+    def open_websocket(self):
+        """Connect, and make the decompressor for the connection's deflate
+        stream. The webtiles package doesn't read from the WebSocket while
+        connecting and logging in, so the stream starts with the first frame
+        read_messages() reads."""
+
+        yield from self.connect()
+        self.inflater = make_inflater()
 
     @asyncio.coroutine
     def start(self):
         if not self.connected():
             try:
-                yield from self.connect()
+                yield from self.open_websocket()
 
             except Exception:
                 self.log_exception("unable to connect")
-                yield from asyncio.sleep(_retry_connection_wait)
                 ensure_future(self.manager.stop_connection(self))
                 return
 
-        self.ping_task = ensure_future(self.start_ping())
+            self.handle_connected()
+
+        self.schedule_ping()
 
         while True:
             yield from self.handle_pre_read()
 
             messages = None
             try:
-                messages = yield from self.read()
+                messages = yield from self.read_messages()
 
             except asyncio.CancelledError:
                 return
@@ -99,6 +418,7 @@ class ConnectionHandler():
                 continue
 
             for message in messages:
+                start = time.perf_counter()
                 try:
                     yield from self.handle_message(message)
 
@@ -110,6 +430,16 @@ class ConnectionHandler():
                     ensure_future(self.manager.stop_connection(self))
                     return
 
+                # Queued chat handling is recorded when the work runs.
+                if message["msg"] != "chat" or not self.work_queue:
+                    self.ingest_stats.record_handling(
+                        message["msg"], time.perf_counter() - start)
+
+    def record_send(self, message):
+        """Count a message we're sending in our stats."""
+
+        self.ingest_stats.record_sent(len(json.dumps(message)))
+
 
 class LobbyConnection(webtiles.WebTilesConnection, ConnectionHandler):
     """Lobby connection. Only needed due to different connection arguments and
@@ -123,9 +453,21 @@ class LobbyConnection(webtiles.WebTilesConnection, ConnectionHandler):
             websocket_url=self.manager.conf["server_url"],
             protocol_version=self.manager.conf["protocol_version"])
 
+    def handle_connected(self):
+        self.manager.throttle.server_succeeded()
+
+    @asyncio.coroutine
+    def send(self, message):
+        self.record_send(message)
+        yield from super().send(message)
+
+    def describe(self):
+        return "lobby connection"
+
     def log_exception(self, error_msg):
         exc_type, exc_value, exc_tb = sys.exc_info()
-        _log.error("WebTiles: In lobby connection, %s: ", error_msg)
+        _log.error("%s: In lobby connection, %s: ", self.manager.service,
+                   error_msg)
         _log.error("".join(traceback.format_exception(
             exc_type, exc_value, exc_tb)))
 
@@ -135,22 +477,28 @@ class GameConnection(webtiles.WebTilesGameConnection, ConnectionHandler,
     """A game websocket connection that watches chat and responds to
     commands."""
 
-    def __init__(self, manager, player, game_id, *args, **kwargs):
+    def __init__(self, manager, player, game_id, account, *args, **kwargs):
         super().__init__(manager, *args, **kwargs)
 
         self.player = player
         self.game_id = game_id
         self.source_type_desc = "chat"
-
-        self.time_since_request = None
+        # The bot account entry this connection logs in with.
+        self.account = account
+        # Held while waiting to send chat, so our messages are sent in order
+        # when the account is at its send limit.
+        self.send_lock = asyncio.Lock()
+
+        # Decaying count of chat activity, and when we started watching.
+        self.activity = 0
+        self.time_activity = time.time()
+        self.time_watch_start = None
+        if manager.conf.get("chat_only_ingest"):
+            self.ingest_filter = render_message_types
 
         self.need_greeting = False
         if manager.conf.get("greeting_text"):
-            user_data = manager.bot_db.get_user_data(player)
-            if user_data and user_data["subscription"] > 0:
-                self.need_greeting = False
-            else:
-                self.need_greeting = True
+            self.need_greeting = not manager.user_is_subscribed(player)
         # Last time we either send the watch command or had watched a game,
         # used so we can reuse connections, but end them after being idle for
         # too long.
@@ -169,11 +517,18 @@ class GameConnection(webtiles.WebTilesGameConnection, ConnectionHandler,
                 self.source_type_desc)
 
     def connect(self):
+        # This deadline covers both the connection and the login request.
+        self.set_request_timer()
         yield from super().connect(self.manager.conf["server_url"],
-                                   self.manager.conf["username"],
-                                   self.manager.conf["password"],
+                                   self.account["username"],
+                                   self.account["password"],
                                    self.manager.conf["protocol_version"])
 
+    @asyncio.coroutine
+    def send(self, message):
+        self.record_send(message)
+        yield from super().send(message)
+
     def get_source_ident(self):
         """Get a unique identifier dict of the game for this connection.
         Identifies this game connection as a source for chat watching. This is
@@ -185,21 +540,14 @@ class GameConnection(webtiles.WebTilesGameConnection, ConnectionHandler,
 
     @asyncio.coroutine
     def handle_pre_read(self):
-        """For a game connection, we check timeouts on login and watch
-        requests, and greet the user if we're autowatching them."""
-
-        if (self.time_since_request
-            and time.time() - self.time_since_request >= _request_timeout):
-            ensure_future(self.manager.stop_connection(self))
-            return
+        """For a game connection, we send the watch request once we've logged
+        in, and greet the user if we're autowatching them."""
 
         if (self.logged_in
             and self.player
             and not self.watching
-            and not self.time_since_request):
-            yield from self.send_watch_game(self.player,
-                                            self.game_id)
-            self.time_since_request = time.time()
+            and not self.request_timer):
+            yield from self.watch_game(self.player, self.game_id)
 
         if not self.watching or not self.need_greeting:
             return
@@ -209,6 +557,50 @@ class GameConnection(webtiles.WebTilesGameConnection, ConnectionHandler,
         yield from self.send_chat(greeting)
         self.need_greeting = False
 
+    def is_bot_user(self, user):
+        """Any of our bot accounts could be watching this game, so ignore chat
+        from all of them."""
+
+        return self.manager.is_bot_account(user)
+
+    @asyncio.coroutine
+    def watch_game(self, player, game_id):
+        """Send a request to watch the given game, which may be different from
+        the game we're currently watching."""
+
+        if player != self.player or game_id != self.game_id:
+            self.activity = 0
+            self.time_watch_start = None
+            # Stats are kept per game, so move those of the old game to the
+            # server totals.
+            self.manager.ingest_stats.merge(self.ingest_stats)
+            self.ingest_stats = IngestStats()
+
+        self.player = player
+        self.game_id = game_id
+        yield from self.send_watch_game(player, game_id)
+        self.set_request_timer()
+
+    def get_activity(self):
+        """Get the current chat activity, decayed to the current time."""
+
+        elapsed = time.time() - self.time_activity
+        return self.activity * 0.5 ** (elapsed / _activity_half_life)
+
+    def add_activity(self, amount):
+        self.activity = self.get_activity() + amount
+        self.time_activity = time.time()
+
+    @asyncio.coroutine
+    def read_chat(self, sender, message):
+        if not self.is_bot_user(sender):
+            self.add_activity(_chat_activity)
+
+        yield from super().read_chat(sender, message)
+
+    def note_command(self, sender, message):
+        self.add_activity(_command_activity - _chat_activity)
+
     def get_chat_dcss_nicks(self, sender):
         nicks = set()
         for username in self.spectators:
@@ -225,8 +617,7 @@ class GameConnection(webtiles.WebTilesGameConnection, ConnectionHandler,
         if self.manager.user_is_ignored(user):
             return False
 
-        user_data = self.manager.bot_db.get_user_data(self.player)
-        if user_data and user_data["player_only"]:
+        if self.manager.bot_db.user_has_value(self.player, "player_only", 1):
             return user.lower() == self.player.lower()
 
         return True
@@ -244,31 +635,46 @@ class GameConnection(webtiles.WebTilesGameConnection, ConnectionHandler,
         elif self.message_needs_escape(message):
             message = "]" + message
 
-        try:
-            yield from self.send({"msg" : "chat_msg", "text" : message})
+        with (yield from self.send_lock):
+            wait = self.manager.reserve_chat_send(self.account)
+            if wait > 0:
+                yield from asyncio.sleep(wait)
 
-        except Exception as e:
-            self.log_exception("unable to send chat message {}".format(
-                message))
-            ensure_future(self.manager.stop_connection(self))
-            return
+            try:
+                yield from self.send({"msg" : "chat_msg", "text" : message})
+
+            except Exception as e:
+                self.log_exception("unable to send chat message {}".format(
+                    message))
+                ensure_future(self.manager.stop_connection(self))
+                return
+
+            metrics.chat_sent.inc(self.manager.service)
 
     @asyncio.coroutine
     def handle_message(self, message):
         if message["msg"] == "login_success":
-            self.time_since_request = None
+            self.cancel_request_timer()
+            self.manager.throttle.server_succeeded()
 
         elif message["msg"] == "login_fail":
-            _log.critical("WebTiles: Login to %s failed, shutting down "
-                          "server.", self.manager.conf["server_url"])
-            os.kill(os.getpid(), signal.SIGTERM)
+            # Other servers can keep running, so only stop this manager.
+            _log.critical("%s: Login to %s failed, stopping manager.",
+                          self.manager.service,
+                          self.manager.conf["server_url"])
+            self.manager.login_failed = True
 
         elif message["msg"] == "watching_started":
-            self.time_since_request = None
-            _log.info("WebTiles: Watching user %s", self.player)
+            self.cancel_request_timer()
+            self.time_watch_start = time.time()
+            self.manager.throttle.game_succeeded((self.player, self.game_id))
+            self.manager.throttle.release(self)
+            _log.info("%s: Watching user %s", self.manager.service,
+                      self.player)
 
         elif message["msg"] == "game_ended" and self.watching:
-            _log.info("WebTiles: Game ended for user %s", self.player)
+            _log.info("%s: Game ended for user %s", self.manager.service,
+                      self.player)
             ensure_future(self.manager.stop_connection(self))
             return
 
@@ -276,43 +682,193 @@ class GameConnection(webtiles.WebTilesGameConnection, ConnectionHandler,
                or message["msg"] == "go" and message["path"] == "/")
               and self.watching):
             # The game we were watching stopped for some reason.
-            _log.warning("WebTiles: Told to go to lobby while watching user "
-                         "%s.", self.player)
+            _log.warning("%s: Told to go to lobby while watching user "
+                         "%s.", self.manager.service, self.player)
             ensure_future(self.manager.stop_connection(self))
             return
 
         elif self.logged_in and message["msg"] == "chat":
             user, chat_message = self.parse_chat_message(message)
-            yield from self.read_chat(user, chat_message)
+            yield from self.queue_work(self.read_chat, user, chat_message)
 
         yield from super().handle_message(message)
 
 
 class WebTilesManager():
-    def __init__(self, conf, bot_db, dcss_manager):
+    def __init__(self, conf, bot_db, dcss_manager, timers, monitor):
         self.conf = conf
         self.bot_db = bot_db
         self.dcss_manager = dcss_manager
+        self.timers = timers
+        self.monitor = monitor
         self.bot_commands = bot_commands
 
-        self.service = "WebTiles"
-        dcss_manager.managers["WebTiles"] = self
+        self.service = conf.get("name", "WebTiles")
+        dcss_manager.managers[self.service] = self
+        # The index of our shard and the number of shards of the server, when
+        # the server's games are split between several managers.
+        self.shard = conf.get("shard")
+
+        # Each account entry tracks the connections using the account and the
+        # times of recent chat messages sent with it.
+        self.accounts = []
+        account_confs = list(conf.get("accounts", []))
+        if conf.get("username"):
+            account_confs.insert(0, {"username" : conf["username"],
+                                     "password" : conf["password"]})
+        for a in account_confs:
+            self.accounts.append({"username"    : a["username"],
+                                  "password"    : a["password"],
+                                  "connections" : set(),
+                                  "send_times"  : []})
         self.single_user = conf.get("watch_player") is not None
 
+        self.throttle = ConnectionThrottle(conf, self.service)
+        self.json_loads = get_json_loads(conf.get("json_decoder"))
+        self.frame_recorder = None
+        if conf.get("record_frames_file"):
+            self.frame_recorder = FrameRecorder(conf["record_frames_file"])
+        # Message counts from closed game connections.
+        self.ingest_stats = IngestStats()
+        self.time_ingest_report = time.time()
         self.lobby = None
-        self.autowatch_candidate = None
-        self.autowatch = None
+        # Set when a login fails, which stops the manager, and once the
+        # manager has disconnected.
+        self.login_failed = False
+        self.stopped = False
+        # Connections used to autowatch the most spectated games.
+        self.autowatches = []
         self.watch_queue = []
         self.connections = set()
+        self.time_last_eviction = 0
+
+        # The number of subscriber and autowatch connections we currently
+        # allow, which only differ from the configured limits when adaptive
+        # capacity is enabled.
+        self.subscriber_capacity = conf["max_watched_subscribers"]
+        self.autowatch_capacity = conf.get("autowatch_slots", 1)
+        self.time_capacity_check = time.time()
+        self.message_count = 0
+
+        # Whether we're watching games restored from a saved state before the
+        # lobby is complete, and the restored autowatch games.
+        self.restoring = False
+        self.time_restore = None
+        self.restored_autowatch = []
+        self.time_state_save = time.time()
+        # State received from the process we replaced on a fast restart, which
+        # is restored instead of the saved state.
+        self.restart_state = None
+
+        self.init_metrics()
+
+    def init_metrics(self):
+        """Export gauges describing our watched games, computed whenever the
+        metrics are read."""
+
+        def count_autowatches():
+            return sum(1 for c in self.autowatches if c.watching)
+
+        def count_autowatch_spectators():
+            return sum(len([s for s in c.spectators if s != c.player])
+                       for c in self.autowatches if c.watching)
+
+        metrics.watched_games.set_function(lambda: len(self.connections),
+                                           self.service, "subscriber")
+        metrics.watched_games.set_function(count_autowatches, self.service,
+                                           "autowatch")
+        metrics.queued_games.set_function(lambda: len(self.watch_queue),
+                                          self.service)
+        metrics.watch_capacity.set_function(lambda: self.subscriber_capacity,
+                                            self.service, "subscriber")
+        metrics.watch_capacity.set_function(lambda: self.autowatch_capacity,
+                                            self.service, "autowatch")
+        metrics.autowatch_spectators.set_function(count_autowatch_spectators,
+                                                  self.service)
+
+        def get_stats(kind):
+            if kind == "lobby":
+                return self.lobby.ingest_stats if self.lobby else IngestStats()
+            return self.get_ingest_stats()
+
+        for kind in ("game", "lobby"):
+            metrics.received_bytes.set_function(
+                lambda k=kind: get_stats(k).wire_bytes, self.service, kind)
+            metrics.sent_bytes.set_function(
+                lambda k=kind: get_stats(k).bytes_sent, self.service, kind)
+
+        def get_type_counts():
+            stats = get_stats("game")
+            counts = {}
+            for t in set(stats.kept) | set(stats.dropped):
+                counts[(self.service, t)] = (stats.kept.get(t, 0)
+                                             + stats.dropped.get(t, 0))
+            return counts
+
+        def get_type_times():
+            return {(self.service, t) : elapsed for t, elapsed
+                    in get_stats("game").handle_time.items()}
+
+        metrics.received_messages.add_collector(get_type_counts)
+        metrics.handling_time.add_collector(get_type_times)
+
+    def get_connection_kind(self, conn):
+        if conn is self.lobby:
+            return "lobby"
+        elif conn in self.autowatches:
+            return "autowatch"
+        return "subscriber"
+
+    def get_account(self):
+        """Get the account with the fewest connections for a new game
+        connection. Returns None if every account is at its connection
+        limit."""
+
+        limit = self.conf.get("max_account_connections")
+        account = min(self.accounts, key=lambda a: len(a["connections"]))
+        if limit and len(account["connections"]) >= limit:
+            return
+
+        return account
+
+    def is_bot_account(self, username):
+        lname = username.lower()
+        for a in self.accounts:
+            if a["username"].lower() == lname:
+                return True
+
+        return False
+
+    def reserve_chat_send(self, account):
+        """Reserve a time to send a chat message with the given account, and
+        return how long in seconds to wait before sending. If the account has
+        sent 'account_send_limit' messages in the last 'account_send_period'
+        seconds, the message waits until the oldest of these has aged out."""
+
+        limit = self.conf.get("account_send_limit")
+        if not limit:
+            return 0
+
+        period = self.conf["account_send_period"]
+        current_time = time.time()
+        send_times = account["send_times"]
+        while send_times and current_time - send_times[0] >= period:
+            send_times.pop(0)
+
+        send_time = current_time
+        if len(send_times) >= limit:
+            send_time = send_times[-limit] + period
+        send_times.append(send_time)
+        return send_time - current_time
 
     def get_connection(self, username, game_id):
         """Get any existing connection for the given game."""
 
-        if (self.autowatch
-            and self.autowatch.player
-            and self.autowatch.player == username
-            and self.autowatch.game_id == game_id):
-            return self.autowatch
+        for conn in self.autowatches:
+            if (conn.player
+                and conn.player == username
+                and conn.game_id == game_id):
+                return conn
 
         for conn in self.connections:
             if (conn.player
@@ -326,24 +882,46 @@ class WebTilesManager():
         return self.get_connection(ident["player"], ident["game_id"])
 
     @asyncio.coroutine
-    def stop_connection(self, conn):
+    def stop_connection(self, conn, failed=True):
         """Shut down a WebTiles connection. If the connection is a game
         connection, it has its game connection entry removed (including
-        autowatch).
+        autowatch). If `failed` is True, the stop is counted as a connection
+        failure for the purposes of reconnection backoff.
 
         Note: This cancels the connection's start() tasks, so any coroutine
         that might call this through start() should use asyncio.ensure_future()
         to schedule instead of yield, otherwise that call to stop_connection()
         itself can be cancelled."""
 
+        metrics.connections_stopped.inc(self.service,
+                                        self.get_connection_kind(conn),
+                                        "failed" if failed else "closed")
+
         if conn.task and not conn.task.done():
             conn.task.cancel()
 
         if conn.ping_task and not conn.ping_task.done():
             conn.ping_task.cancel()
 
-        if conn is self.autowatch:
-            self.autowatch = None
+        conn.cancel_timers()
+
+        if conn.work_task and not conn.work_task.done():
+            conn.work_task.cancel()
+
+        if conn is not self.lobby:
+            conn.account["connections"].discard(conn)
+            self.ingest_stats.merge(conn.ingest_stats)
+            conn.ingest_stats = IngestStats()
+
+        if conn is self.lobby:
+            if failed:
+                self.throttle.server_failed()
+        elif failed:
+            self.throttle.connection_failed(conn)
+        self.throttle.release(conn)
+
+        if conn in self.autowatches:
+            self.autowatches.remove(conn)
         elif conn in self.connections:
             if conn.watching:
                 self.set_watch_end(conn)
@@ -358,62 +936,255 @@ class WebTilesManager():
     def try_new_connection(self, player, game_id):
         """Try to make a new subscriber connection."""
 
-        if len(self.connections) >= self.conf["max_watched_subscribers"]:
+        if len(self.connections) >= self.subscriber_capacity:
+            return
+
+        if not self.throttle.game_ready((player, game_id)):
+            return
+
+        account = self.get_account()
+        if not account:
             return
 
-        conn = GameConnection(self, player, game_id)
-        conn.task = ensure_future(conn.start())
+        conn = GameConnection(self, player, game_id, account)
+        account["connections"].add(conn)
+        self.throttle.admit(conn, (player, game_id))
+        conn.start_task()
         self.connections.add(conn)
+        metrics.connections_started.inc(self.service, "subscriber")
 
     @asyncio.coroutine
     def disconnect(self):
+        if self.stopped:
+            return
+        self.stopped = True
+
+        # Save before stopping connections changes the queue.
+        try:
+            self.save_state()
+
+        except Exception:
+            _log.exception("%s: Unable to save watch state", self.service)
+
         if self.lobby:
-            yield from self.stop_connection(self.lobby)
+            yield from self.stop_connection(self.lobby, False)
 
-        if self.autowatch:
-            yield from self.stop_connection(self.autowatch)
+        for conn in list(self.autowatches):
+            yield from self.stop_connection(conn, False)
 
         for conn in list(self.connections):
-            yield from self.stop_connection(conn)
+            yield from self.stop_connection(conn, False)
 
         self.watch_queue = []
 
+        if self.frame_recorder:
+            self.frame_recorder.close()
+            self.frame_recorder = None
+
     @asyncio.coroutine
     def start(self):
         """Start the WebTiles service manager."""
 
-        _log.info("WebTiles: Starting manager")
+        _log.info("%s: Starting manager", self.service)
 
         if not self.lobby:
             self.lobby = LobbyConnection(self)
 
+        try:
+            self.restore_state(self.restart_state)
+
+        except Exception:
+            _log.exception("%s: Unable to restore watch state", self.service)
+
         while True:
-            if not self.lobby.task or self.lobby.task.done():
-                self.lobby.task = ensure_future(self.lobby.start())
-
-            autowatch_game = None
-            if self.conf["protocol_version"] >= 2 or self.lobby.lobby_complete:
-                autowatch_game = self.process_lobby()
-            if autowatch_game:
-                yield from self.do_autowatch_game(autowatch_game)
-            else:
-                yield from self.check_current_autowatch()
+            if self.login_failed:
+                yield from self.disconnect()
+                return
+
+            if ((not self.lobby.task or self.lobby.task.done())
+                    and self.throttle.server_ready()):
+                self.lobby.start_task()
+                metrics.connections_started.inc(self.service, "lobby")
+
+            if self.restoring and (self.lobby.lobby_complete
+                                   or time.time() - self.time_restore
+                                   >= _restore_timeout):
+                self.end_restore()
+
+            autowatch_games = []
+            if self.restoring:
+                autowatch_games = self.get_restored_autowatch()
+            elif (self.conf["protocol_version"] >= 2
+                  or self.lobby.lobby_complete):
+                autowatch_games = self.process_lobby()
+            yield from self.update_autowatch(autowatch_games)
 
             yield from self.process_queue()
+            if self.conf.get("adaptive_capacity"):
+                yield from self.check_capacity()
+            self.throttle.expire_backoff()
+            self.check_ingest_report()
+            if (time.time() - self.time_state_save
+                    >= self.conf.get("state_save_interval",
+                                     _state_save_interval)):
+                self.save_state()
             yield from asyncio.sleep(0.5)
 
+    def get_state(self):
+        """Get a snapshot of the watch queue and watched games that can be
+        restored after a restart."""
+
+        queue = []
+        for entry in self.watch_queue:
+            conn = self.get_connection(entry["username"], entry["game_id"])
+            queue.append({"username"    : entry["username"],
+                          "game_id"     : entry["game_id"],
+                          "time_end"    : entry["time_end"],
+                          "time_queued" : entry["time_queued"],
+                          "watching"    : conn in self.connections})
+
+        return {"time"        : time.time(),
+                "watch_queue" : queue,
+                "autowatch"   : [[c.player, c.game_id]
+                                 for c in self.autowatches if c.player]}
+
+    def save_state(self):
+        self.time_state_save = time.time()
+        self.bot_db.replace_row(state_table,
+                                {"service" : self.service,
+                                 "time"    : int(self.time_state_save),
+                                 "state"   : json.dumps(self.get_state())})
+
+    def restore_state(self, state=None):
+        """Restore the watch queue and autowatch games from the given state,
+        or else from the saved state. Games we were watching go first in the
+        queue, and they and the autowatch games are watched without waiting
+        for the lobby. The rest of the queue is checked against the lobby as
+        usual once it's complete."""
+
+        max_age = self.conf.get("state_max_age", _state_max_age)
+        if not state:
+            rows = self.bot_db.select_rows(state_table, "service = ?",
+                                           [self.service])
+            if not max_age or not rows:
+                return
+
+            state = json.loads(rows[0]["state"])
+
+        age = time.time() - state["time"]
+        if max_age and age > max_age:
+            _log.info("%s: Not restoring watch state saved %d seconds ago",
+                      self.service, age)
+            return
+
+        num_watching = 0
+        for e in state["watch_queue"]:
+            if (self.get_queue_entry(e["username"], e["game_id"])
+                    or not self.is_game_allowed(e["username"], e["game_id"])):
+                continue
+
+            pos = None
+            if e["watching"]:
+                pos = num_watching
+                num_watching += 1
+            entry = self.add_queue(e["username"], e["game_id"], pos)
+            entry["time_end"] = e["time_end"]
+            entry["time_queued"] = e["time_queued"]
+            entry["restored"] = e["watching"]
+
+        self.restored_autowatch = [tuple(g) for g in state["autowatch"]]
+        self.restoring = True
+        self.time_restore = time.time()
+        _log.info("%s: Restored %d queued games (%d watched) and %d autowatch "
+                  "games saved %d seconds ago", self.service,
+                  len(self.watch_queue), num_watching,
+                  len(self.restored_autowatch), age)
+
+    def get_restored_autowatch(self):
+        if not self.dcss_manager.ready():
+            return []
+
+        return [g for g in self.restored_autowatch
+                if self.is_game_allowed(*g)]
+
+    def end_restore(self):
+        """Stop watching restored games early once the lobby is complete.
+        Games no longer in the lobby will be dropped by the usual queue and
+        autowatch checks."""
+
+        self.restoring = False
+        self.restored_autowatch = []
+        for entry in self.watch_queue:
+            entry.pop("restored", None)
+        _log.info("%s: Finished restoring watch state", self.service)
+
+    def get_ingest_stats(self):
+        """Get the combined message counts of all game connections, open or
+        closed."""
+
+        stats = IngestStats()
+        stats.merge(self.ingest_stats)
+        for conn in self.connections:
+            stats.merge(conn.ingest_stats)
+        for conn in self.autowatches:
+            stats.merge(conn.ingest_stats)
+        return stats
+
+    def check_ingest_report(self):
+        if (not self.conf.get("chat_only_ingest")
+                or time.time() - self.time_ingest_report
+                < _ingest_report_interval):
+            return
+
+        self.time_ingest_report = time.time()
+        _log.info("%s: Game message ingest: %s", self.service,
+                  self.get_ingest_stats().describe())
+        top_games = self.describe_top_games()
+        if top_games:
+            _log.info("%s: Top games by bandwidth: %s", self.service,
+                      top_games)
+
+    def get_top_games(self, limit=3):
+        """Get the watched game connections that have received the most bytes
+        since they started watching their game."""
+
+        conns = [c for c in self.connections | set(self.autowatches)
+                 if c.player]
+        return heapq.nlargest(limit, conns,
+                              key=lambda c: c.ingest_stats.wire_bytes)
+
+    def describe_top_games(self, limit=3):
+        return ", ".join("{} ({})".format(c.player,
+                                          c.ingest_stats.describe_usage())
+                         for c in self.get_top_games(limit))
+
+    def describe_usage(self):
+        """Return a summary of the bandwidth and handling time of the server's
+        connections, with the most expensive games."""
+
+        stats = self.get_ingest_stats()
+        if self.lobby:
+            stats.merge(self.lobby.ingest_stats)
+        summary = "{}: {}".format(self.service, stats.describe_usage())
+        top_games = self.describe_top_games()
+        if top_games:
+            summary += "; top games: {}".format(top_games)
+        return summary
+
     def add_queue(self, player, game_id, pos=None):
         """Add a game to the watch queue. It will be watched when a watching
         slot is available."""
 
-        entry = {"username" : player,
-                 "game_id"  : game_id,
-                 "time_end" : None}
+        entry = {"username"     : player,
+                 "game_id"      : game_id,
+                 "time_end"     : None,
+                 "rewatch_wait" : False,
+                 "time_queued"  : time.time()}
         if pos is None:
             pos = len(self.watch_queue)
 
         self.watch_queue.insert(pos, entry)
-        return
+        return entry
 
     def get_queue_entry(self, player, game_id):
         for entry in self.watch_queue:
@@ -425,41 +1196,69 @@ class WebTilesManager():
         return
 
     @asyncio.coroutine
-    def do_autowatch_game(self, game):
-        player, game_id = game
-        if (self.autowatch
-                and self.autowatch.player == player
-                and self.autowatch.game_id == game_id):
-            return
+    def update_autowatch(self, games):
+        """Assign the given autowatch games to autowatch connections. Games we
+        already autowatch keep their connections, and the remaining games go
+        to autowatch connections whose games weren't chosen, which switch
+        games on their existing WebSocket, or to new connections if there are
+        free autowatch slots."""
+
+        new_games = []
+        for game in games:
+            conn = self.get_connection(*game)
+            if not conn or conn not in self.autowatches:
+                new_games.append(game)
+
+        for conn in list(self.autowatches):
+            if (conn.player, conn.game_id) in games:
+                continue
+
+            if not new_games:
+                yield from self.check_current_autowatch(conn)
+                continue
 
-        _log.info("WebTiles: Found new autowatch user %s", player)
-        if self.autowatch and self.autowatch.watching:
-            _log.info("WebTiles: Stopping autowatch for user %s: new "
-                      "autowatch game found", self.autowatch.player)
+            player, game_id = new_games.pop(0)
+            _log.info("%s: Found new autowatch user %s", self.service, player)
+            if conn.watching:
+                _log.info("%s: Stopping autowatch for user %s: new "
+                          "autowatch game found", self.service, conn.player)
 
-        if not self.autowatch:
-            self.autowatch = GameConnection(self, player, game_id)
-            self.autowatch.task = ensure_future(self.autowatch.start())
-        else:
+            # The greeting is for players who aren't subscribed, so decide
+            # again for the new player.
+            if self.conf.get("greeting_text"):
+                conn.need_greeting = not self.user_is_subscribed(player)
             try:
-                yield from self.autowatch.send_watch_game(player, game_id)
+                yield from conn.watch_game(player, game_id)
 
             except Exception:
-                yield from self.stop_connection(self.autowatch)
+                # Switching games on a connection isn't a failure to connect
+                # to the server, so it doesn't count towards backoff.
+                yield from self.stop_connection(conn, False)
+
+        while new_games and len(self.autowatches) < self.autowatch_capacity:
+            game = new_games.pop(0)
+            account = self.get_account()
+            if not self.throttle.game_ready(game) or not account:
+                break
 
+            _log.info("%s: Found new autowatch user %s", self.service,
+                      game[0])
+            conn = GameConnection(self, game[0], game[1], account)
+            account["connections"].add(conn)
+            self.throttle.admit(conn, game)
+            conn.start_task()
+            self.autowatches.append(conn)
+            metrics.connections_started.inc(self.service, "autowatch")
 
     @asyncio.coroutine
-    def check_current_autowatch(self):
-        """When we don't find a new autowatch candidate, check that we're still
-        able to watch our present autowatch game."""
-
-        if not self.autowatch:
-            return
+    def check_current_autowatch(self, conn):
+        """When we don't find a new autowatch candidate for an autowatch
+        connection, check that we're still able to watch its present game."""
 
         lobby_entry = None
         for entry in self.lobby.lobby_entries:
-            if (entry["username"] == self.autowatch.player
-                and entry["game_id"] == self.autowatch.game_id):
+            if (entry["username"] == conn.player
+                and entry["game_id"] == conn.game_id):
                 lobby_entry = entry
                 break
 
@@ -473,8 +1272,7 @@ class WebTilesManager():
         # doing so just leads to a lot of fluctations in autowatching.
         idle_time = (lobby_entry["idle_time"] +
                      time.time() - lobby_entry["time_last_update"])
-        game_allowed = self.is_game_allowed(self.autowatch.player,
-                                            self.autowatch.game_id)
+        game_allowed = self.is_game_allowed(conn.player, conn.game_id)
         end_reason = None
         if not game_allowed:
             end_reason = "Game disallowed"
@@ -485,19 +1283,19 @@ class WebTilesManager():
         else:
             return
 
-        _log.info("WebTiles: Stopping autowatch for user %s: %s",
-                  self.autowatch.player, end_reason)
-        yield from self.stop_connection(self.autowatch)
+        _log.info("%s: Stopping autowatch for user %s: %s", self.service,
+                  conn.player, end_reason)
+        yield from self.stop_connection(conn, False)
 
     def process_lobby(self):
-        """Process lobby entries, adding games to the watch queue and return an
-        autowatch candidate if one is found."""
+        """Process lobby entries, adding games to the watch queue and return a
+        list of the games to autowatch, most spectated first."""
 
-        autowatch_spectators = -1
         min_spectators = self.conf["min_autowatch_spectators"]
         current_time = time.time()
-        autowatch_game = None
-        max_subscribers = self.conf["max_watched_subscribers"]
+        max_subscribers = self.subscriber_capacity
+        # Heap entries for autowatch candidates.
+        candidates = []
         for entry in self.lobby.lobby_entries:
             subscribed = self.user_is_subscribed(entry["username"])
             queue_entry = self.get_queue_entry(entry["username"],
@@ -516,23 +1314,19 @@ class WebTilesManager():
             # autowatch candidates.
             no_free_slot = (not conn in self.connections
                             and len(self.connections) >= max_subscribers)
-            # Find an autowatch candidate
+            # Find autowatch candidates
             if (self.conf.get("autowatch_enabled")
                     and self.dcss_manager.ready()
                     and entry["spectator_count"] >= min_spectators
-                    and (not subscribed or no_free_slot)
-                    and (conn
-                        and conn is self.autowatch
-                        # If there's a tie, favor a game we're already
-                        # autowatching instead of letting the order of
-                        # iteration decide.
-                        and entry["spectator_count"] == autowatch_spectators
-                        # This is chosen because it has more spectators.
-                        or entry["spectator_count"] > autowatch_spectators)):
-                autowatch_spectators = entry["spectator_count"]
-                autowatch_game = (entry["username"], entry["game_id"])
-
-        return autowatch_game
+                    and (not subscribed or no_free_slot)):
+                # If there's a tie, favor a game we're already autowatching
+                # instead of letting the order of iteration decide.
+                current = 1 if conn and conn in self.autowatches else 0
+                candidates.append((entry["spectator_count"], current,
+                                   entry["username"], entry["game_id"]))
+
+        return [(c[2], c[3])
+                for c in heapq.nlargest(self.autowatch_capacity, candidates)]
 
     @asyncio.coroutine
     def process_queue(self):
@@ -540,7 +1334,9 @@ class WebTilesManager():
         can."""
 
         timeout = self.conf["game_rewatch_timeout"]
-        max_subscribers = self.conf["max_watched_subscribers"]
+        max_subscribers = self.subscriber_capacity
+        # Queue entries that could be watched if a slot were free.
+        waiting = []
         for entry in list(self.watch_queue):
             lobby = self.lobby.get_lobby_entry(entry["username"],
                                                entry["game_id"])
@@ -551,8 +1347,7 @@ class WebTilesManager():
             idle = idle_time >= self.conf["max_game_idle"]
 
             allowed = self.is_game_allowed(entry["username"], entry["game_id"])
-            wait = (entry["time_end"]
-                    and time.time() - entry["time_end"] < _rewatch_wait)
+            wait = entry["rewatch_wait"]
             expired = (not entry["time_end"]
                        or time.time() - entry["time_end"] >= timeout)
             conn = self.get_connection(entry["username"], entry["game_id"])
@@ -565,24 +1360,33 @@ class WebTilesManager():
                 elif idle:
                     end_reason = "Game idle"
                 if end_reason:
-                    _log.info("WebTiles: Stopping watching of user %s: %s",
-                              entry["username"], end_reason)
-                    yield from self.stop_connection(conn)
+                    _log.info("%s: Stopping watching of user %s: %s",
+                              self.service, entry["username"], end_reason)
+                    yield from self.stop_connection(conn, False)
                 # An autowatched subscriber without a subscriber slot now has
                 # one.
-                elif (conn is self.autowatch
+                elif (conn in self.autowatches
                       and len(self.connections) < max_subscribers):
                     self.connections.add(conn)
-                    self.autowatch = None
+                    self.autowatches.remove(conn)
                     continue
 
-            # The queue entry is no longer valid.
-            if not allowed or idle or not lobby and expired:
+            # The queue entry is no longer valid. Entries aren't dropped for
+            # lacking a lobby entry while restoring.
+            if (not allowed or idle
+                    or not lobby and expired and not self.restoring):
                 self.watch_queue.remove(entry)
                 continue
 
+            # Restored games we were watching don't wait for the lobby.
+            early = self.restoring and entry.get("restored")
             # We can't watch yet or they already have a subscriber slot.
-            if not self.dcss_manager.ready() or not lobby or wait or conn:
+            if (not self.dcss_manager.ready() or not (lobby or early) or wait
+                    or conn):
+                continue
+
+            if len(self.connections) >= max_subscribers:
+                waiting.append((entry, lobby))
                 continue
 
             # Try to give the game a subscriber slot. If this fails, the entry
@@ -590,12 +1394,262 @@ class WebTilesManager():
             yield from self.try_new_connection(entry["username"],
                                                entry["game_id"])
 
+        if waiting and self.conf.get("watch_eviction_enabled"):
+            yield from self.check_eviction(waiting)
+
+    def get_idle_time(self, lobby_entry):
+        return (lobby_entry["idle_time"] + time.time()
+                - lobby_entry["time_last_update"])
+
+    def get_watch_score(self, conn):
+        """Score how useful it is to keep watching a game, based on its recent
+        chat activity, its spectators, and how long it's been idle."""
+
+        num_specs = len([s for s in conn.spectators
+                         if s != conn.player and not self.is_bot_account(s)])
+        score = conn.get_activity() + _spectator_weight * num_specs
+
+        lobby = self.lobby.get_lobby_entry(conn.player, conn.game_id)
+        if lobby:
+            idle_time = self.get_idle_time(lobby)
+            score -= (_idle_weight * idle_time / self.conf["max_game_idle"])
+        return score
+
+    def get_waiting_score(self, entry, lobby):
+        """Score how useful it would be to watch a game waiting for a slot.
+        We don't know its chat activity, so we use the time it has waited
+        instead."""
+
+        wait_score = min(_max_queue_wait_score,
+                         _queue_wait_weight
+                         * (time.time() - entry["time_queued"]) / 60)
+        idle_score = (_idle_weight * self.get_idle_time(lobby)
+                      / self.conf["max_game_idle"])
+        return (_spectator_weight * lobby["spectator_count"] + wait_score
+                - idle_score)
+
+    @asyncio.coroutine
+    def check_eviction(self, waiting):
+        """When subscriber slots are full, see if the best waiting game is
+        worth more than the least useful game we're watching, and if so, evict
+        that game to free a slot. Games must be watched for a minimum time
+        before they can be evicted, the waiting game must be better by a
+        margin, and we evict at most once per interval, all to keep games from
+        trading slots back and forth."""
+
+        current_time = time.time()
+        interval = self.conf.get("eviction_interval", _eviction_interval)
+        if current_time - self.time_last_eviction < interval:
+            return
+
+        min_watch_time = self.conf.get("min_watch_time", _min_watch_time)
+        victim = None
+        victim_score = None
+        for conn in self.connections:
+            # A connection switching games has no watch start time until the
+            # new game's watch starts.
+            if (not conn.watching
+                    or conn.time_watch_start is None
+                    or current_time - conn.time_watch_start < min_watch_time):
+                continue
+
+            score = self.get_watch_score(conn)
+            if victim is None or score < victim_score:
+                victim = conn
+                victim_score = score
+
+        if not victim:
+            return
+
+        entry, lobby = max(waiting,
+                           key=lambda w: self.get_waiting_score(w[0], w[1]))
+        entry_score = self.get_waiting_score(entry, lobby)
+        margin = self.conf.get("eviction_margin", _eviction_margin)
+        if entry_score < victim_score + margin:
+            return
+
+        _log.info("%s: Evicting user %s (score %.1f) to watch waiting user %s "
+                  "(score %.1f)", self.service, victim.player, victim_score,
+                  entry["username"], entry_score)
+        self.time_last_eviction = current_time
+
+        # The waiting game moves to the front of the queue so it gets the free
+        # slot.
+        yield from self.evict_connection(victim)
+        self.watch_queue.remove(entry)
+        self.watch_queue.insert(0, entry)
+
+    @asyncio.coroutine
+    def evict_connection(self, conn):
+        """Stop watching a subscriber game to free its slot. The game's queue
+        entry goes to the end of the queue, where it waits like any other
+        game."""
+
+        entry = self.get_queue_entry(conn.player, conn.game_id)
+        metrics.watch_evictions.inc(self.service)
+        yield from self.stop_connection(conn, False)
+        if entry:
+            self.watch_queue.remove(entry)
+            entry["time_end"] = None
+            entry["time_queued"] = time.time()
+            self.watch_queue.append(entry)
+
+    def get_message_rate(self, elapsed):
+        """Get the average rate of messages per second per game connection
+        over the given elapsed time since we last called this."""
+
+        stats = self.get_ingest_stats()
+        count = sum(stats.kept.values()) + sum(stats.dropped.values())
+        num_conns = len(self.connections) + len(self.autowatches)
+        rate = 0
+        if num_conns and elapsed > 0:
+            rate = (count - self.message_count) / elapsed / num_conns
+        self.message_count = count
+        return rate
+
+    @asyncio.coroutine
+    def check_capacity(self):
+        """Grow or shrink the number of connections we allow based on event
+        loop lag, memory use and message rate. When overloaded, we give up
+        autowatch slots before subscriber slots, and stop the least useful
+        games to get down to capacity. We only grow when lag is well below the
+        limit and the connections we allow are in use."""
+
+        current_time = time.time()
+        elapsed = current_time - self.time_capacity_check
+        interval = self.conf.get("capacity_interval", _capacity_interval)
+        if elapsed < interval:
+            return
+        self.time_capacity_check = current_time
+
+        max_lag = self.conf.get("max_loop_lag", _max_loop_lag)
+        lag = self.monitor.lag
+        rss = self.monitor.get_rss()
+        max_rss = self.conf.get("max_rss_mb", 0) * 1024 * 1024
+        message_rate = self.get_message_rate(elapsed)
+        max_subscribers = self.conf["max_watched_subscribers"]
+        min_subscribers = min(max_subscribers,
+                              self.conf.get("min_watched_subscribers", 1))
+        max_autowatch = self.conf.get("autowatch_slots", 1)
+        # Would one more game put us over the message rate limit?
+        max_rate = self.conf.get("max_message_rate")
+        num_conns = len(self.connections) + len(self.autowatches)
+        rate_ok = not max_rate or message_rate * (num_conns + 1) < max_rate
+
+        old_capacity = (self.subscriber_capacity, self.autowatch_capacity)
+        if lag > max_lag or max_rss and rss > max_rss:
+            if self.autowatch_capacity > 0:
+                self.autowatch_capacity -= 1
+            else:
+                step = max(1, self.subscriber_capacity // 10)
+                self.subscriber_capacity = max(min_subscribers,
+                                               self.subscriber_capacity - step)
+
+        elif (lag < max_lag / 2
+              and (not max_rss or rss < max_rss * 0.9)
+              and rate_ok):
+            if (self.subscriber_capacity < max_subscribers
+                    and len(self.connections) >= self.subscriber_capacity):
+                self.subscriber_capacity += 1
+            elif self.autowatch_capacity < max_autowatch:
+                self.autowatch_capacity += 1
+
+        if (self.subscriber_capacity, self.autowatch_capacity) != old_capacity:
+            _log.info("%s: Capacity now %s subscriber and %s autowatch slots "
+                      "(loop lag %.3fs, RSS %.1fMB, %.1f messages/s per game)",
+                      self.service, self.subscriber_capacity,
+                      self.autowatch_capacity, lag, rss / 1024 / 1024,
+                      message_rate)
+
+        yield from self.enforce_capacity()
+
+    @asyncio.coroutine
+    def enforce_capacity(self):
+        """Stop the least useful games until we're within capacity."""
+
+        while len(self.autowatches) > self.autowatch_capacity:
+            conn = min(self.autowatches, key=lambda c: len(c.spectators))
+            _log.info("%s: Stopping autowatch for user %s: Over capacity",
+                      self.service, conn.player)
+            yield from self.stop_connection(conn, False)
+
+        while len(self.connections) > self.subscriber_capacity:
+            conn = min(self.connections, key=self.get_watch_score)
+            _log.info("%s: Stopping watching of user %s: Over capacity",
+                      self.service, conn.player)
+            yield from self.evict_connection(conn)
+
+    @asyncio.coroutine
+    def reload(self, conf):
+        """Apply a reloaded config for this server. Watch capacity is reset to
+        the new limits, and watched and queued games that are no longer
+        allowed or are over capacity are stopped. Returns a list of the changed
+        settings that need a restart, which keep their current values."""
+
+        conf = dict(conf)
+        restart = []
+        for field in _restart_fields:
+            if conf.get(field) == self.conf.get(field):
+                continue
+
+            restart.append(field)
+            if field in self.conf:
+                conf[field] = self.conf[field]
+            else:
+                conf.pop(field, None)
+
+        self.conf = conf
+        self.throttle.conf = conf
+
+        max_subscribers = conf["max_watched_subscribers"]
+        max_autowatch = conf.get("autowatch_slots", 1)
+        if conf.get("adaptive_capacity"):
+            # Capacity grows back to the limits as usual.
+            self.subscriber_capacity = min(self.subscriber_capacity,
+                                           max_subscribers)
+            self.autowatch_capacity = min(self.autowatch_capacity,
+                                          max_autowatch)
+        else:
+            self.subscriber_capacity = max_subscribers
+            self.autowatch_capacity = max_autowatch
+
+        for conn in list(self.autowatches):
+            if not conf.get("autowatch_enabled"):
+                end_reason = "Autowatch disabled"
+            elif not self.is_game_allowed(conn.player, conn.game_id):
+                end_reason = "Game disallowed"
+            else:
+                continue
+
+            _log.info("%s: Stopping autowatch for user %s: %s", self.service,
+                      conn.player, end_reason)
+            yield from self.stop_connection(conn, False)
+
+        for conn in list(self.connections):
+            if self.is_game_allowed(conn.player, conn.game_id):
+                continue
+
+            _log.info("%s: Stopping watching of user %s: Game disallowed",
+                      self.service, conn.player)
+            yield from self.stop_connection(conn, False)
+
+        self.watch_queue = [e for e in self.watch_queue
+                            if self.is_game_allowed(e["username"],
+                                                    e["game_id"])]
+        yield from self.enforce_capacity()
+        return restart
+
     def set_watch_end(self, conn):
         queue = self.get_queue_entry(conn.player, conn.game_id)
         if not queue:
             return
 
         queue["time_end"] = time.time()
+        queue["rewatch_wait"] = True
+        self.timers.schedule(_rewatch_wait, self.end_rewatch_wait, queue)
+
+    def end_rewatch_wait(self, entry):
+        entry["rewatch_wait"] = False
 
     def user_is_admin(self, user):
         """Return True if the user is a bot admin."""
@@ -632,17 +1686,28 @@ class WebTilesManager():
         if self.user_is_ignored(username):
             return False
 
-        user_data = self.bot_db.get_user_data(username)
-        if user_data and user_data["subscription"] < 0:
+        if self.bot_db.user_has_value(username, "subscription", -1):
             return False
 
         return True
 
+    def owns_player(self, username):
+        """Are the player's games in our shard? Every process must agree on
+        this, so it uses a stable hash."""
+
+        if not self.shard:
+            return True
+
+        index, num_shards = self.shard
+        return (zlib.crc32(username.lower().encode("utf-8")) % num_shards
+                == index)
+
     def is_game_allowed(self, username, game_id):
         """Can this game ever be watched? A game is disallowed if the user is
-        not allowed or the game is of too old a version."""
+        not allowed, the game is in another shard, or the game is of too old a
+        version."""
 
-        if not self.can_watch_user(username):
+        if not self.owns_player(username) or not self.can_watch_user(username):
             return False
 
         # Check for old, untested versions.
@@ -659,8 +1724,7 @@ class WebTilesManager():
         return True
 
     def user_is_subscribed(self, username):
-        user_data = self.bot_db.get_user_data(username)
-        return user_data and user_data["subscription"] > 0
+        return self.bot_db.user_has_value(username, "subscription", 1)
 
 
 @asyncio.coroutine
@@ -677,6 +1741,7 @@ def bot_subscribe_command(source, username):
             username))
 
     bot_db.set_user_field(username, "subscription", 1)
+    yield from bot_db.wait_written()
     yield from source.send_chat(
         "Subscribed. I will now watch all games of user {}".format(username))
 
@@ -694,6 +1759,7 @@ def bot_unsubscribe_command(source, username):
             username))
 
     bot_db.set_user_field(username, "subscription", -1)
+    yield from bot_db.wait_written()
     msg = "Unsubscribed. I will no longer watch games of user {}.".format(
         username)
     # We'll be leaving the chat of this source.
@@ -708,14 +1774,18 @@ def bot_status_command(source, *args):
     mgr = source.manager
     report = "Version {}".format(Version)
 
-    if mgr.autowatch and mgr.autowatch.watching:
-        num_specs = len(mgr.autowatch.spectators)
+    autowatches = []
+    for conn in mgr.autowatches:
+        if not conn.watching:
+            continue
 
-        if mgr.autowatch.player in mgr.autowatch.spectators:
+        num_specs = len(conn.spectators)
+        if conn.player in conn.spectators:
             num_specs -= 1
-
-        report += "; Autowatching user {} with {} spec(s)".format(
-            mgr.autowatch.player, num_specs)
+        autowatches.append("user {} with {} spec(s)".format(conn.player,
+                                                            num_specs))
+    if autowatches:
+        report += "; Autowatching {}".format(", ".join(autowatches))
 
     if mgr.connections:
         names = sorted(
@@ -723,8 +1793,32 @@ def bot_status_command(source, *args):
         report += "; Watching {} subscriber(s): {}".format(
                 len(mgr.connections), ", ".join(names))
 
+    top_games = mgr.describe_top_games()
+    if top_games:
+        report += "; Top games by bandwidth: {}".format(top_games)
+
     yield from source.send_chat(report)
 
+@asyncio.coroutine
+def bot_stats_command(source, *args):
+    """!botstats chat command"""
+
+    mgr = source.manager
+    yield from source.send_chat("{}; {}".format(mgr.monitor.describe(),
+                                                mgr.describe_usage()))
+
+@asyncio.coroutine
+def bot_profile_command(source, username, duration=None, memory=None):
+    """!profile chat command"""
+
+    prefix = start_profile(int(duration) if duration else None,
+                           True if memory else None)
+    if not prefix:
+        raise BotCommandException("A profile is already running.")
+
+    yield from source.send_chat("Started profile {}".format(
+        os.path.basename(prefix)))
+
 @asyncio.coroutine
 def bot_player_only_command(source, username, state=None):
     """!player-only chat command"""
@@ -763,15 +1857,46 @@ db_tables = {
             },
             {"name" : "subscription",
              "type" : "integer",
-             "default" : 0
+             "default" : 0,
+             "index" : True
             },
             {"name" : "player_only",
+             "type" : "integer",
+             "default" : 0,
+             "index" : True
+            },
+        ],
+}
+
+# The table holding the saved state of each manager, which isn't loaded into
+# memory by BotDB.
+state_table = "webtiles_state"
+state_db_tables = {
+        state_table : [
+            {"name" : "service",
+             "type" : "text",
+             "primary" : True,
+            },
+            {"name" : "time",
              "type" : "integer",
              "default" : 0
             },
+            {"name" : "state",
+             "type" : "text",
+             "default" : "{}"
+            },
         ],
 }
 
+# Changes to the WebTiles DB schema made by each version after the first. See
+# BotDB.
+db_migrations = [
+        # 1: Indexes for the in-memory indexes of subscribed and player-only
+        # users.
+        [("add_index", "webtiles_users", "subscription"),
+         ("add_index", "webtiles_users", "player_only")],
+]
+
 # WebTiles bot commands
 bot_commands = {
     "bothelp" : {
@@ -782,6 +1907,25 @@ bot_commands = {
         "require_admin" : True,
         "function" : bot_status_command,
     },
+    "botstats" : {
+        "require_admin" : True,
+        "function" : bot_stats_command,
+    },
+    "profile" : {
+        "require_admin" : True,
+        "args" : [
+            {
+                "pattern" : r"[0-9]+$",
+                "description" : "seconds",
+                "required" : False
+            },
+            {
+                "pattern" : r"memory$",
+                "description" : "memory",
+                "required" : False
+            } ],
+        "function" : bot_profile_command,
+    },
     "subscribe" : {
         "disallow_single_user_mode" : True,
         "function" : bot_subscribe_command,
@@ -0,0 +1,95 @@
+"""Measure the write throughput of BotDB, comparing its persistent connection
+under each journal mode and synchronous setting, and its write-behind writer,
+with opening a new connection for every write.
+
+Each run registers a number of users and then changes a field of each, which
+is what !subscribe does for new users."""
+
+import argparse
+import os.path
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beem.botdb import BotDB
+
+# The same table as the WebTiles user table, defined here so the benchmark
+# doesn't need the WebTiles dependencies.
+db_tables = {
+    "webtiles_users" : [
+        {"name" : "username", "type" : "text", "primary" : True},
+        {"name" : "subscription", "type" : "integer", "default" : 0},
+        {"name" : "player_only", "type" : "integer", "default" : 0},
+    ],
+}
+
+
+class ConnectionPerWriteDB(BotDB):
+    """Writes the way BotDB did before it kept a connection open: connect,
+    execute, commit and close for every write, with sqlite's default
+    settings."""
+
+    def execute_write(self, table, op, statement, params, row_key):
+        conn = sqlite3.connect(self.db_file)
+        try:
+            conn.execute(statement, params)
+            conn.commit()
+
+        finally:
+            conn.close()
+
+
+def run(db_class, path, num_users, **kwargs):
+    bot_db = db_class(path, db_tables, "webtiles_users", **kwargs)
+    bot_db.load_db()
+
+    start = time.perf_counter()
+    for i in range(num_users):
+        name = "user{}".format(i)
+        bot_db.register_user(name)
+        bot_db.set_user_field(name, "subscription", 1)
+    bot_db.flush()
+    elapsed = time.perf_counter() - start
+
+    bot_db.close()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", dest="num_users", type=int, default=1000,
+                        help="Number of users to register.")
+    parser.add_argument("-d", dest="directory",
+                        help="Directory for the test DBs. Use a directory on "
+                        "the same disk as the real DB for realistic results.")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.directory)
+    configs = [("connection per write", ConnectionPerWriteDB,
+                {"journal_mode" : "delete", "synchronous" : "full"})]
+    for journal_mode, synchronous in (("delete", "full"), ("wal", "full"),
+                                      ("wal", "normal"), ("wal", "off")):
+        configs.append(("persistent {}/{}".format(journal_mode, synchronous),
+                        BotDB, {"journal_mode" : journal_mode,
+                                "synchronous" : synchronous}))
+    configs.append(("write-behind wal/full", BotDB,
+                    {"journal_mode" : "wal", "synchronous" : "full",
+                     "write_behind" : True}))
+
+    try:
+        for i, (desc, db_class, kwargs) in enumerate(configs):
+            path = os.path.join(directory, "bench{}.db3".format(i))
+            elapsed = run(db_class, path, args.num_users, **kwargs)
+            print("{:>28}: {:8.0f} writes/s ({:.2f}s)".format(
+                desc, 2 * args.num_users / elapsed, elapsed))
+
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
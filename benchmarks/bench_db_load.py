@@ -0,0 +1,120 @@
+"""Measure the startup time and memory use of BotDB with a large user table,
+comparing loading every user at startup with loading users lazily into a
+bounded cache. The memory used by the full load shows the bytes used per
+in-memory user.
+
+A DB of users is made once, a fraction of them subscribed. Each mode is then
+run in its own process, so that its memory use can be measured separately: it
+loads the DB, then looks up a number of random users, a few of them unknown,
+the way the lobby does for the players of new games."""
+
+import argparse
+import os.path
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beem.botdb import BotDB
+from bench_db import db_tables
+
+
+def get_rss():
+    """Get the current resident set size in KiB, or the maximum if this isn't
+    Linux."""
+
+    try:
+        with open("/proc/self/statm") as fh:
+            pages = int(fh.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_db(path, num_users, subscribed):
+    bot_db = BotDB(path, db_tables, "webtiles_users", synchronous="off")
+    bot_db.load_db()
+    with bot_db.conn:
+        bot_db.conn.executemany(
+            "INSERT INTO webtiles_users (username, subscription) "
+            "VALUES (?, ?)",
+            (("user{}".format(i), 1 if random.random() < subscribed else 0)
+             for i in range(num_users)))
+    bot_db.close()
+
+
+def run_mode(path, num_users, num_lookups, cache_size):
+    rss_start = get_rss()
+    start = time.perf_counter()
+    bot_db = BotDB(path, db_tables, "webtiles_users", cache_size=cache_size,
+                   pinned_fields=["subscription"])
+    bot_db.load_db()
+    load_time = time.perf_counter() - start
+    rss_loaded = get_rss()
+
+    start = time.perf_counter()
+    for i in range(num_lookups):
+        if i % 10 == 0:
+            name = "unknown{}".format(random.randrange(num_lookups))
+        else:
+            name = "User{}".format(random.randrange(num_users))
+        bot_db.get_user_data(name)
+    lookup_time = time.perf_counter() - start
+    rss_end = get_rss()
+    bot_db.close()
+
+    print("{:.3f} {:.3f} {} {}".format(load_time, lookup_time,
+                                       rss_loaded - rss_start,
+                                       rss_end - rss_start))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", dest="num_users", type=int, default=100000,
+                        help="Number of users in the DB.")
+    parser.add_argument("-s", dest="subscribed", type=float, default=0.01,
+                        help="Fraction of users that are subscribed.")
+    parser.add_argument("-l", dest="num_lookups", type=int, default=100000,
+                        help="Number of user lookups after loading.")
+    parser.add_argument("-c", dest="cache_size", type=int, default=10000,
+                        help="Cache size for lazy loading.")
+    parser.add_argument("--run", dest="run", metavar="<db-file>",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_mode(args.run, args.num_users, args.num_lookups,
+                 args.cache_size if args.cache_size > 0 else None)
+        return
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "bench.db3")
+    try:
+        make_db(path, args.num_users, args.subscribed)
+        print("{} users, {:.0%} subscribed, {} lookups".format(
+            args.num_users, args.subscribed, args.num_lookups))
+        for desc, cache_size in (("full load", 0),
+                                 ("lazy, cache {}".format(args.cache_size),
+                                  args.cache_size)):
+            output = subprocess.check_output(
+                [sys.executable, __file__, "--run", path,
+                 "-n", str(args.num_users), "-l", str(args.num_lookups),
+                 "-c", str(cache_size)], universal_newlines=True)
+            load_time, lookup_time, rss_loaded, rss_end = output.split()
+            print("{:>20}: load {}s, {} KiB ({:.0f} bytes/user); lookups "
+                  "{}s, {} KiB".format(desc, load_time, rss_loaded,
+                                       1024 * int(rss_loaded) / args.num_users,
+                                       lookup_time, rss_end))
+
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Measure how many WebTiles frames per second of CPU time beem can inflate and
+decode, for each installed JSON decoder and with and without the chat-only
+ingest filter.
+
+Frames are replayed from a file written by setting `record_frames_file` in the
+webtiles config. Without a file, synthetic game frames are used."""
+
+import argparse
+import base64
+import importlib
+import json
+import os.path
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beem.ingest import IngestStats, decode_frame, get_json_loads
+from beem.ingest import inflate_frame, json_decoders, make_inflater
+from beem.ingest import render_message_types
+
+
+def load_recorded_frames(path):
+    """Return a list of (connection number, frame) tuples from a recording."""
+
+    frames = []
+    with open(path) as fh:
+        for line in fh:
+            entry = json.loads(line)
+            if "data" in entry:
+                frames.append((entry["conn"],
+                               base64.b64decode(entry["data"])))
+            else:
+                frames.append((entry["conn"], entry["text"]))
+    return frames
+
+
+def make_synthetic_frames(num_frames, num_connections=10):
+    """Make compressed frames resembling those of watched games, mostly map
+    and player updates with the occasional chat message."""
+
+    rand = random.Random(0)
+    compressors = {}
+    frames = []
+    for i in range(num_frames):
+        conn = rand.randrange(num_connections)
+        if conn not in compressors:
+            compressors[conn] = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                                 zlib.DEFLATED,
+                                                 -zlib.MAX_WBITS)
+
+        msgs = []
+        roll = rand.random()
+        if roll < 0.05:
+            msgs.append({"msg" : "chat",
+                         "content" : "<span>someone</span>: ??sigmund"})
+        elif roll < 0.08:
+            msgs.append({"msg" : "update_spectators", "count" : 3,
+                         "names" : "a, b, c"})
+        else:
+            cells = [{"x" : rand.randrange(80), "y" : rand.randrange(70),
+                      "g" : rand.choice("#.@$%"),
+                      "t" : {"fg" : rand.randrange(1 << 16),
+                             "bg" : rand.randrange(1 << 16)}}
+                     for _ in range(rand.randrange(10, 300))]
+            msgs.append({"msg" : "map", "cells" : cells})
+            msgs.append({"msg" : "player", "hp" : rand.randrange(100),
+                         "turn" : i, "time" : i * 10})
+            if rand.random() < 0.3:
+                msgs.append({"msg" : "msgs", "messages" : [
+                    {"text" : "You hit the orc.", "turn" : i}]})
+
+        comp = compressors[conn]
+        data = comp.compress(json.dumps({"msgs" : msgs}).encode("utf-8"))
+        data += comp.flush(zlib.Z_SYNC_FLUSH)
+        # The server strips the sync flush trailer.
+        frames.append((conn, data[:-4]))
+
+    return frames
+
+
+def run(frames, loads, drop_types):
+    inflaters = {}
+    stats = IngestStats()
+    start = time.process_time()
+    for conn, data in frames:
+        if isinstance(data, bytes):
+            if conn not in inflaters:
+                inflaters[conn] = make_inflater()
+            data = inflate_frame(inflaters[conn], data)
+        decode_frame(data, drop_types, stats, loads)
+    elapsed = time.process_time() - start
+    return elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("frames_file", nargs="?",
+                        help="A frame recording from record_frames_file.")
+    parser.add_argument("-n", dest="num_frames", type=int, default=20000,
+                        help="Number of synthetic frames to use.")
+    args = parser.parse_args()
+
+    if args.frames_file:
+        frames = load_recorded_frames(args.frames_file)
+    else:
+        frames = make_synthetic_frames(args.num_frames)
+    print("{} frames".format(len(frames)))
+
+    for name in json_decoders:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            print("{:>10}: not installed".format(name))
+            continue
+
+        loads = get_json_loads(name)
+        for desc, drop_types in (("all", None),
+                                 ("chat-only", render_message_types)):
+            elapsed, stats = run(frames, loads, drop_types)
+            print("{:>10} {:>9}: {:8.0f} frames/s per core ({:.2f}s CPU, "
+                  "{} frames undecoded)".format(name, desc,
+                                                len(frames) / elapsed,
+                                                elapsed,
+                                                stats.frames_skipped))
+
+    print("Breakdown: {}".format(stats.describe()))
+
+
+if __name__ == "__main__":
+    main()
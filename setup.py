@@ -37,6 +37,7 @@ setup(
     entry_points={
         'console_scripts': [
             'beem=beem.server:main',
+            'beem-trace-summary=beem.trace_summary:main',
         ],
     },
     classifiers=[
@@ -0,0 +1,160 @@
+"""Tests of the WebTiles manager and connections. Run with:
+python -m unittest discover tests"""
+
+import asyncio
+import json
+import time
+import types
+import unittest
+from unittest import mock
+import zlib
+
+from beem.ingest import IngestStats
+from beem.timers import TimerWheel
+from beem.webtiles import GameConnection, LobbyConnection, WebTilesManager
+
+
+class FakeGameConnection():
+    """A game connection that watches games without a WebSocket, using the
+    real GameConnection methods the manager relies on."""
+
+    watch_game = GameConnection.watch_game
+    get_activity = GameConnection.get_activity
+
+    def __init__(self, manager, player, game_id):
+        self.manager = manager
+        self.player = player
+        self.game_id = game_id
+        self.watching = True
+        self.spectators = set()
+        self.activity = 0
+        self.time_activity = time.time()
+        self.time_watch_start = time.time() - 3600
+        self.ingest_stats = IngestStats()
+
+    @asyncio.coroutine
+    def send_watch_game(self, player, game_id):
+        yield from asyncio.sleep(0)
+
+    def set_request_timer(self):
+        pass
+
+
+class FakeWebSocket():
+    """Serves frames compressed as one deflate stream, the way a WebTiles
+    server sends them."""
+
+    def __init__(self, frames):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                      zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.frames = []
+        for frame in frames:
+            data = (compressor.compress(json.dumps(frame).encode("utf-8"))
+                    + compressor.flush(zlib.Z_SYNC_FLUSH))
+            # The server strips the trailer of each sync flush.
+            self.frames.append(data[:-4])
+        self.open = True
+        self.sent = []
+
+    @asyncio.coroutine
+    def recv(self):
+        yield from asyncio.sleep(0)
+        return self.frames.pop(0)
+
+    @asyncio.coroutine
+    def send(self, data):
+        yield from asyncio.sleep(0)
+        self.sent.append(data)
+
+    @asyncio.coroutine
+    def close(self):
+        yield from asyncio.sleep(0)
+        self.open = False
+
+
+def make_manager(**conf):
+    manager_conf = {"name"                    : "Test",
+                    "server_url"              : "ws://localhost/socket",
+                    "protocol_version"        : 2,
+                    "max_watched_subscribers" : 1,
+                    "max_game_idle"           : 1800}
+    manager_conf.update(conf)
+    dcss_manager = types.SimpleNamespace(managers={})
+    return WebTilesManager(manager_conf, None, dcss_manager, TimerWheel(),
+                           None)
+
+
+class EvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_switching_connection_not_evicted(self):
+        """An eviction pass between watch_game() and the new game's
+        watching_started skips the switching connection."""
+
+        manager = make_manager(watch_eviction_enabled=True)
+        conn = FakeGameConnection(manager, "player1", "game1")
+        manager.connections.add(conn)
+
+        self.loop.run_until_complete(conn.watch_game("player2", "game2"))
+        self.assertTrue(conn.watching)
+        self.assertIsNone(conn.time_watch_start)
+
+        entry = {"username"    : "waiting",
+                 "game_id"     : "game3",
+                 "time_queued" : time.time() - 3600}
+        lobby = {"spectator_count" : 10, "idle_time" : 0}
+        manager.watch_queue.append(entry)
+        self.loop.run_until_complete(
+            manager.check_eviction([(entry, lobby)]))
+
+        self.assertIn(conn, manager.connections)
+        self.assertEqual(manager.time_last_eviction, 0)
+        self.assertEqual(manager.watch_queue, [entry])
+
+
+class ReadMessagesTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_deflate_stream_from_connect(self):
+        """Frames read after connecting inflate with the decompressor made at
+        connect time. The second frame refers back to the first, so this
+        fails if connecting consumed a frame of the stream."""
+
+        entry = {"msg" : "lobby_entry", "username" : "player" * 20,
+                 "game_id" : "dcss-git"}
+        chat = {"msg" : "chat", "content" : "player" * 20}
+        frames = [{"msgs" : [entry]}, {"msgs" : [entry, chat]}]
+        websocket = FakeWebSocket(frames)
+
+        @asyncio.coroutine
+        def connect(*args, **kwargs):
+            yield from asyncio.sleep(0)
+            return websocket
+
+        manager = make_manager()
+        conn = LobbyConnection(manager)
+        with mock.patch("websockets.connect", connect):
+            self.loop.run_until_complete(conn.open_websocket())
+
+        self.assertEqual(self.loop.run_until_complete(conn.read_messages()),
+                         [entry])
+        self.assertEqual(self.loop.run_until_complete(conn.read_messages()),
+                         [entry, chat])
+        self.assertEqual(conn.ingest_stats.kept,
+                         {"lobby_entry" : 2, "chat" : 1})
+
+
+if __name__ == "__main__":
+    unittest.main()